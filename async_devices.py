@@ -0,0 +1,68 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDevice:
+    """
+    asyncio front end for a device module (laser, ccd or their mocks): the blocking calls
+    run one after the other on a thread of the device's own, so the event loop is free to
+    drive the other devices and the processing meanwhile
+    """
+    def __init__(self, device):
+        self.device   = device
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix=device.__name__)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        run func(*args, **kwargs) on the device thread
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class AsyncLaser(AsyncDevice):
+    """
+    asyncio version of the laser API (laser or mock_laser)
+    """
+    async def start(self, power_W=0.120):
+        await self.run(self.device.start, power_W)
+
+    async def stop(self):
+        await self.run(self.device.stop)
+
+    async def set_power(self, power_W):
+        await self.run(self.device.set_power, power_W)
+
+    async def get_power(self):
+        return await self.run(self.device.get_power)
+
+    async def shutdown(self):
+        await self.run(self.device.shutdown)
+
+    async def wait_settled(self, power_W, **kwargs):
+        """
+        wait for the output power to settle on power_W [W] (device.wait_settled, w/ the same
+        keyword arguments) on the device thread
+        returns (settled, time waited [s])
+        """
+        return await self.run(self.device.wait_settled, power_W, **kwargs)
+
+
+class AsyncCCD(AsyncDevice):
+    """
+    asyncio version of the CCD API (ccd or mock_ccd), the readout runs on the device thread
+    """
+    async def set_integration_time(self, inttime_us):
+        await self.run(self.device.set_integration_time, inttime_us)
+
+    async def get_data(self, out=None):
+        return await self.run(self.device.get_data, out=out)
+
+    async def get_frames(self, n, out=None):
+        return await self.run(self.device.get_frames, n, out=out)
+
+    async def shutdown(self):
+        await self.run(self.device.shutdown)
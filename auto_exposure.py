@@ -0,0 +1,120 @@
+import numpy as np
+
+from signal_treatment import CCD_SATURATION_VAL, detect_saturation, detect_lowsignal
+
+
+# constant declarations
+TARGET_LEVEL   = .6*CCD_SATURATION_VAL  # where the highest peak should end up
+PROBE_FACTOR   = 1/16                   # first short probe exposure, relative to a saturated one
+MAX_STEP       = 100                    # max ratio between two successive exposures
+MAX_FRAMES     = 12                     # max nb of frames taken to find the exposure
+
+
+def predict_integration_time(data, int_time, target=TARGET_LEVEL):
+    """
+    predict the integration time that brings the highest peak of an unsaturated
+    frame to the target level, assuming the signal above the offset is linear in time
+    """
+    offset = float(np.min(data))               # as a float: target - offset wraps around w/ uint16
+    signal = max(np.max(data) - offset, 1)
+    ratio  = (target - offset) / signal
+    return int_time * np.clip(ratio, 1/MAX_STEP, MAX_STEP)
+
+
+def auto_exposure(get_data, set_integration_time, int_time, min_time, max_time,
+                  target=TARGET_LEVEL, max_frames=MAX_FRAMES, applied=False):
+    """
+    find an integration time at which the signal is neither low nor saturated
+    - unsaturated frames : jump straight to the time predicted from the measured peak
+    - saturated frames   : nothing can be predicted, so probe a much shorter exposure and
+                           bisect (geometrically) between the known saturated and unsaturated times
+    stops as soon as a frame is in range, when the limits are reached, or after max_frames
+    works just the same for any setting the signal is linear in (e.g. the laser power)
+    applied : int_time is already set (e.g. the laser has settled on that power), the first
+              frame is taken w/o setting it again
+    returns int_time, the last frame, and the nb of frames it took
+    """
+    hi = max_time           # shortest exposure known to saturate
+    lo = min_time           # longest exposure known not to saturate
+    nb_frames = 0
+    applied  = applied and min_time <= int_time <= max_time
+    int_time = np.clip(int_time, min_time, max_time)
+
+    while True:
+        if not applied:
+            set_integration_time(int_time)
+        applied = False
+        data = get_data()
+        nb_frames += 1
+
+        saturated = detect_saturation(data)
+        low       = detect_lowsignal(data)
+        if nb_frames >= max_frames or not (saturated or low):
+            break
+
+        if saturated:
+            hi = min(hi, int_time)
+            if int_time <= min_time:
+                break
+            if lo > min_time:                               # bisect between the bounds
+                new_time = np.sqrt(lo*hi)
+            else:                                           # no unsaturated frame yet: short probe
+                new_time = int_time*PROBE_FACTOR
+        else:
+            lo = max(lo, int_time)
+            if int_time >= max_time:
+                break
+            new_time = predict_integration_time(data, int_time, target)
+            if new_time >= hi:                              # would saturate again
+                new_time = np.sqrt(lo*hi)
+
+        int_time = np.clip(new_time, min_time, max_time)
+
+    return int_time, data, nb_frames
+
+
+
+# BENCHMARK
+if __name__ == "__main__":
+    import glob
+    import time
+    import mock_ccd
+
+    MIN_INT_TIME, MAX_INT_TIME, DEFAULT_INT_TIME = 1, 30e6, 1e4
+
+    def linear_search(get_data, set_integration_time, int_time):
+        """ the original x1.25 search of spectrometer_routines.calibrate """
+        nb_frames = 1
+        set_integration_time(int_time)
+        data = get_data()
+        while detect_lowsignal(data) and (int_time < MAX_INT_TIME):
+            int_time = int_time * 1.25
+            set_integration_time(int_time)
+            data = get_data()
+            nb_frames += 1
+        while detect_saturation(data) and (int_time > MIN_INT_TIME):
+            int_time = int_time / 1.25
+            set_integration_time(int_time)
+            data = get_data()
+            nb_frames += 1
+        return int_time, data, nb_frames
+
+    simulated = [0.]
+    def get_data():
+        simulated[0] += (mock_ccd.integration_time_us + 100)*1e-6    # what the exposure would have cost
+        return mock_ccd.get_data()
+
+    for filename in sorted(glob.glob("./mock_resources/*.txt")):
+        mock_ccd.change_file(filename)
+        for start in [DEFAULT_INT_TIME/100, DEFAULT_INT_TIME, 1e6]:
+            res = []
+            for search in [linear_search, auto_exposure]:
+                simulated[0] = 0.
+                t0 = time.time()
+                args = (MIN_INT_TIME, MAX_INT_TIME) if search is auto_exposure else ()
+                int_time, data, nb_frames = search(get_data, mock_ccd.set_integration_time, start, *args)
+                res.append("{:3d} frames, {:7.3f} s simulated, {:6.3f} s wall -> {:8.1f} us (peak {:5d})".format(
+                           nb_frames, simulated[0], time.time()-t0, int_time, int(np.max(data))))
+            print("{} from {:g} us".format(filename.split("/")[-1], start))
+            print("\tx1.25 search  : " + res[0])
+            print("\tauto exposure : " + res[1])
@@ -0,0 +1,478 @@
+# Benchmarks of the acquisition & signal processing hot paths, on the mock devices
+#   python benchmark.py             : run, print, and append the results to the history file
+#   python benchmark.py --check     : same, and exit w/ an error if anything got slower than its reference
+#   python benchmark.py --full      : also run the 10'000 spectra stacks and the 100'000 references library (slow)
+#   python benchmark.py --check-order : run in order & in reverse, each in a fresh process, and exit w/ an error
+#                                       if a result depends on what ran before it (state left behind)
+# every result is a time in [s] (or a nb of frames), lower is better. the reference for each
+# result is the median of the last REFERENCE_RUNS runs on the same machine.
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+import signal_treatment as st
+from calibration import Calibration
+import spectrum_io
+import dark_library
+
+
+# constant declarations
+HERE                  = os.path.dirname(os.path.abspath(__file__))
+HISTORY_FILE          = os.path.join(HERE, "benchmark_history.jsonl")
+REGRESSION_THRESHOLD  = 1.25    # a result regresses when it is this much worse than its reference
+REFERENCE_RUNS        = 5       # nb of previous runs the reference is taken from
+ORDER_THRESHOLD       = 1.5     # a result depends on the order when the two orders differ by this much
+ORDER_MIN_TIME        = 1e-3    # [s] shorter results are left out of the order check (timer noise)
+STACK_SIZES           = [100, 1000]
+FULL_STACK_SIZES      = [100, 1000, 10000]
+LIBRARY_SIZES         = [10000]
+FULL_LIBRARY_SIZES    = [10000, 100000]
+N_PX                  = 3648
+MOCK_FILES            = [os.path.join(HERE, "mock_resources", f) for f in
+                         ["exc785_Sample1_100pc_p1.txt", "exc785_Sample1_100pc_p2.txt", "exc785_Sample1_100pc_p3.txt"]]
+
+
+def timed(func, repeat=3):
+    """
+    best time [s] of a few calls of func
+    """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def mock_spectra(n, seed=0):
+    """
+    n noisy spectra (n, N_PX) built from the mock resources, at a realistic signal level
+    """
+    rng = np.random.default_rng(seed)
+    templates = np.array([spectrum_io.load_template(f, N_PX)[1] for f in MOCK_FILES])
+    templates = 40000 * templates / np.max(templates, axis=1, keepdims=True)
+    X = templates[np.arange(n) % len(MOCK_FILES)] + 1000
+    return X + rng.normal(0, 1, X.shape) * np.sqrt(X)
+
+
+def bench_signal_treatment(sizes):
+    """
+    every signal_treatment function on one spectrum, and on stacks of spectra
+    """
+    results = {}
+    operations = [
+        ("smooth_median",       lambda x: st.smooth(x, 7, "median")),
+        ("smooth_gaussian",     lambda x: st.smooth(x, 5, "gaussian")),
+        ("smooth_avg",          lambda x: st.smooth(x, 5, "avg")),
+        ("remove_baseline_AsLS",lambda x: st.remove_baseline(x, [10**5, .05], "AsLS")),
+        ("remove_baseline_bandpass", lambda x: st.remove_baseline(x, [2, 50], "bandpass")),
+        ("normalize",           lambda x: st.normalize(x)),
+        ("detect_saturation",   lambda x: st.detect_saturation(x)),
+        ("despike",             lambda x: st.despike(x)),
+    ]
+    x = mock_spectra(1)[0]
+    for name, op in operations:
+        results["signal_treatment/{}/1".format(name)] = timed(lambda: op(x))
+        for n in sizes:
+            X = mock_spectra(n)
+            results["signal_treatment/{}/{}".format(name, n)] = timed(lambda: op(X), repeat=2)
+
+    frames = mock_spectra(5)
+    results["signal_treatment/reject_spikes/5"] = timed(lambda: st.reject_spikes(frames))
+
+    model, guess = np.array([465, 129, 1872]), np.array([-1e-4, .6, 60])
+    clean = st.remove_baseline(st.smooth(x, 7, "median"), [10**5, .05], "AsLS")
+    results["signal_treatment/find_correction/1"] = timed(lambda: st.find_correction(clean, model, guess))
+
+    cal = Calibration([-2e-5, .69, 70], N_PX)
+    cal.operator()                                          # built once per calibration
+    results["calibration/resample/1"] = timed(lambda: cal.resample(x))
+    for n in sizes:
+        X = mock_spectra(n)
+        results["calibration/resample/{}".format(n)] = timed(lambda: cal.resample(X), repeat=2)
+
+    import peak_fitting
+    cleaned = st.remove_baseline(st.smooth(mock_spectra(100), 7, "median"), [10**5, .05], "AsLS")
+    positions = peak_fitting.detect_peaks(cleaned.mean(axis=0))[0]
+    results["peak_fitting/fit_peaks/1"]   = timed(lambda: peak_fitting.fit_peaks(cleaned[0], positions))
+    results["peak_fitting/fit_peaks/100"] = timed(lambda: peak_fitting.fit_peaks(cleaned, positions), repeat=2)
+
+    pipeline = st.Pipeline([("smooth", 7, "median"), ("smooth", 5, "gaussian"),
+                            ("remove_baseline", [10**5, .05], "AsLS")]).compile(N_PX)
+    out = np.empty(N_PX)
+    results["signal_treatment/Pipeline/1"] = timed(lambda: pipeline(x, out=out))
+    return results
+
+
+def bench_library(sizes):
+    """
+    spectral library: top-5 matches of one spectrum and of a batch of 16, among n references
+    """
+    from spectral_library import SpectralLibrary
+    results = {}
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        library = SpectralLibrary("correlation")
+        for i in range(0, n, 10000):
+            library.add(rng.random((min(10000, n - i), library.grid.size)))
+        queries = rng.random((16, library.grid.size))
+        results["spectral_library/query/{}/1".format(n)]  = timed(lambda: library.query(queries[0]))
+        results["spectral_library/query/{}/16".format(n)] = timed(lambda: library.query(queries), repeat=2)
+    return results
+
+
+def bench_mock_ccd():
+    """
+    acquisition of single frames and frame blocks from the mock CCD
+    """
+    import mock_ccd as ccd
+    results = {}
+    ccd.change_file(MOCK_FILES[1])
+    ccd.set_integration_time(10)
+    out = np.empty(ccd.CCD_NB_PXL, dtype=np.uint16)
+    block = np.empty((5, ccd.CCD_NB_PXL), dtype=np.uint16)
+    results["mock_ccd/get_data"]       = timed(lambda: ccd.get_data(), repeat=20)
+    results["mock_ccd/get_data_out"]   = timed(lambda: ccd.get_data(out=out), repeat=20)
+    results["mock_ccd/get_frames/5"]   = timed(lambda: ccd.get_frames(5, out=block), repeat=10)
+    return results
+
+
+def bench_sim_ccd():
+    """
+    frame generation of the simulated CCD (w/o waiting), and a realtime block of frames
+    """
+    import sim_ccd as ccd
+    results = {}
+    ccd.init(0)
+    ccd.set_integration_time(1000)
+    block = np.empty((ccd.BULK_MAX_FRAMES, ccd.CCD_NB_PXL), dtype=np.uint16)
+    ccd.realtime = False
+    results["sim_ccd/simulate/16"]       = timed(lambda: ccd.get_frames(16, out=block), repeat=10)
+    ccd.realtime = True
+    results["sim_ccd/get_frames/16"]     = timed(lambda: ccd.get_frames(16, out=block), repeat=5)
+    return results
+
+
+def bench_ccd_pool(nb_devices=(1, 2, 4), nb_frames=8):
+    """
+    time [s] per acquisition of nb_frames frames on every CCD of a pool of mock CCDs
+    (flat when the throughput scales w/ the nb of CCDs)
+    """
+    from ccd_pool import CCDPool
+    results = {}
+    for n in nb_devices:
+        with CCDPool(["MOCK{:04d}".format(i) for i in range(n)], device="mock_ccd") as pool:
+            pool.call("change_file", MOCK_FILES[1])
+            pool.set_integration_time(10000)
+            pool.acquire(1)
+            results["ccd_pool/{}/acquire/{}".format(n, nb_frames)] = timed(lambda: pool.acquire(nb_frames))
+    return results
+
+
+def bench_archive(nb_spectra=2000):
+    """
+    spectrum archive: appending raw frames + spectra, opening, slicing, reading one spectrum;
+    and reading one spectrum from a text file, for comparison
+    """
+    from spectrum_archive import SpectrumArchive
+    results = {}
+    X = mock_spectra(100).astype(np.float32)
+    raw = np.clip(X, 0, 2**16-1).astype(np.uint16)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.spa")
+        def write():
+            with SpectrumArchive(path, "w") as archive:
+                for i in range(0, nb_spectra, len(X)):
+                    archive.append(raw=raw, spectrum=X, int_time=i)
+        results["archive/append/{}".format(nb_spectra)] = timed(write, repeat=2)
+        results["archive/open"]           = timed(lambda: len(SpectrumArchive(path)))
+        archive = SpectrumArchive(path)
+        results["archive/slice/100"]      = timed(lambda: archive[1000:1100]["spectrum"].sum())
+        results["archive/read/1"]         = timed(lambda: SpectrumArchive(path)[1234]["spectrum"].sum())
+    results["text/read/1"] = timed(lambda: spectrum_io.read_spectrum(MOCK_FILES[0]))
+    return results
+
+
+def reset_routines(sr):
+    """
+    bring the routines & mock devices back to where they start (default integration time &
+    power, laser off and settled), so that a benchmark doesn't depend on the ones run before
+    """
+    sr.init()
+    sr.integration_time, sr.power = sr.DEFAULT_INT_TIME, sr.DEFAULT_POWER
+    sr.laser.stop()
+    sr.settle(0)
+
+
+def bench_cycle():
+    """
+    a full calibrate() + acquire_sample_spectrum() cycle with the mock devices:
+    wall time and nb of frames taken
+    """
+    import spectrometer_routines as sr
+    from dark_library import DarkLibrary
+
+    nb_frames = [0]
+    get_data = sr.ccd.get_data
+    def counting_get_data(*args, **kwargs):
+        nb_frames[0] += 1
+        return get_data(*args, **kwargs)
+
+    results = {}
+    reset_routines(sr)
+    with tempfile.TemporaryDirectory() as tmp:
+        sr.darks = DarkLibrary(tmp)                             # start w/o any dark frame
+        sr.ccd.get_data = counting_get_data
+        try:
+            for name, routine in [("calibrate", sr.calibrate), ("acquire_sample_spectrum", sr.acquire_sample_spectrum)]:
+                sr.ccd.change_file(MOCK_FILES[2])
+                nb_frames[0] = 0
+                t = time.perf_counter()
+                routine()
+                results["cycle/{}/wall".format(name)]   = time.perf_counter() - t
+                results["cycle/{}/frames".format(name)] = nb_frames[0]
+        finally:
+            sr.ccd.get_data = get_data
+    sr.shutdown()
+    return results
+
+
+def bench_cycle_virtual(nb_cycles=10):
+    """
+    nb_cycles calibrate() + acquire_sample_spectrum() cycles on a virtual clock: wall time and
+    the hardware time [s] they stand for, per cycle
+    """
+    import clock
+    import spectrometer_routines as sr
+    from dark_library import DarkLibrary
+
+    results = {}
+    sim = clock.use(clock.VirtualClock())
+    try:
+        reset_routines(sr)
+        with tempfile.TemporaryDirectory() as tmp:
+            sr.darks = DarkLibrary(tmp)
+            t = time.perf_counter()
+            for i in range(nb_cycles):
+                sr.ccd.change_file(MOCK_FILES[2])
+                sr.calibrate()
+                sr.ccd.change_file(MOCK_FILES[i % len(MOCK_FILES)])
+                sr.acquire_sample_spectrum()
+            results["cycle_virtual/wall"]     = (time.perf_counter() - t)/nb_cycles
+            results["cycle_virtual/hardware"] = sim.elapsed()/nb_cycles
+        sr.shutdown()
+    finally:
+        clock.use(clock.RealClock())
+    return results
+
+
+def bench_cycle_async(nb_samples=2):
+    """
+    calibrate + nb_samples sample spectra, serially and w/ the asynchronous routines (which
+    overlap the processing & dark frames w/ the laser warm-up), starting w/o any dark frame
+    """
+    import asyncio
+    import spectrometer_routines as sr
+    from dark_library import DarkLibrary
+
+    def serial():
+        sr.calibrate()
+        for i in range(nb_samples):
+            sr.ccd.change_file(MOCK_FILES[i % len(MOCK_FILES)])
+            sr.acquire_sample_spectrum()
+
+    def overlapped():
+        prepares = [lambda i=i: sr.ccd.change_file(MOCK_FILES[i % len(MOCK_FILES)]) for i in range(nb_samples)]
+        asyncio.run(sr.cycle_async(prepares))
+
+    results = {}
+    reset_routines(sr)
+    for name, cycle in [("serial", serial), ("async", overlapped)]:
+        with tempfile.TemporaryDirectory() as tmp:
+            sr.darks = DarkLibrary(tmp)
+            sr.integration_time, sr.power = sr.DEFAULT_INT_TIME, sr.DEFAULT_POWER
+            sr.ccd.change_file(MOCK_FILES[1])
+            sr.laser.stop()                                 # both start w/ the laser off
+            sr.settle(0)
+            t = time.perf_counter()
+            cycle()
+            results["cycle_async/{}/{}/wall".format(name, nb_samples)] = time.perf_counter() - t
+    sr.shutdown()
+    return results
+
+
+def bench_batch(nb_samples=4):
+    """
+    time per sample [s] of a multi-sample run: serial (acquire & process one after the other),
+    acquisition alone, and run_batch (processing on a worker pool, behind the acquisition);
+    and the processing alone, the most run_batch can save per sample
+    """
+    import spectrometer_routines as sr
+    from dark_library import DarkLibrary
+
+    prepares = [lambda i=i: sr.ccd.change_file(MOCK_FILES[i % len(MOCK_FILES)]) for i in range(nb_samples)]
+    def serial():
+        for prepare in prepares:
+            prepare()
+            sr.acquire_sample_spectrum()
+    def acquisition():
+        for prepare in prepares:
+            prepare()
+            sr.acquire_sample_frames()
+
+    results = {}
+    reset_routines(sr)
+    with tempfile.TemporaryDirectory() as tmp:
+        sr.darks = DarkLibrary(tmp)
+        sr.ccd.change_file(MOCK_FILES[1])
+        sr.calibrate()
+        for name, run in [("serial", serial), ("acquisition", acquisition), ("pipelined", lambda: sr.run_batch(prepares))]:
+            sr.power = sr.DEFAULT_POWER
+            sr.set_power(sr.power)                          # every run starts w/ the laser settled there
+            t = time.perf_counter()
+            run()
+            results["batch/{}/per_sample".format(name)] = (time.perf_counter() - t) / nb_samples
+        data_s = sr.acquire_sample_frames()[1]
+        results["batch/processing/per_sample"] = timed(lambda: sr.sample_pipeline(data_s))
+    sr.shutdown()
+    return results
+
+
+def machine():
+    return "{}/{}".format(platform.node(), platform.machine())
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def load_history(filename=HISTORY_FILE):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_run(results, filename=HISTORY_FILE):
+    record = dict(timestamp=time.time(), commit=git_commit(), machine=machine(), results=results)
+    with open(filename, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def benchmarks(full=False):
+    """
+    every benchmark, in the order they run: (group, function returning a dict of results)
+    """
+    return [("signal", lambda: bench_signal_treatment(FULL_STACK_SIZES if full else STACK_SIZES)),
+            ("signal", lambda: bench_library(FULL_LIBRARY_SIZES if full else LIBRARY_SIZES)),
+            ("ccd",    bench_mock_ccd),
+            ("ccd",    bench_sim_ccd),
+            ("ccd",    bench_ccd_pool),
+            ("io",     bench_archive),
+            ("cycle",  bench_cycle),
+            ("cycle",  bench_cycle_async),
+            ("cycle",  bench_batch),
+            ("cycle",  bench_cycle_virtual)]        # last: it changes the clock
+
+
+def run_process(options):
+    """
+    run the benchmarks in a fresh process (w/ these command line options), returns its results
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        dump = os.path.join(tmp, "results.json")
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--no-save", "--dump", dump] + options,
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(dump) as f:
+            return json.load(f)
+
+
+def order_dependence(forward, reverse, threshold=ORDER_THRESHOLD):
+    """
+    compare the results of a run in order and of a run in reverse order
+    returns one (name, forward, reverse, ratio, dependent) per result (the short ones left out)
+    """
+    rows = []
+    for name in forward:
+        a, b = forward[name], reverse.get(name)
+        if b is None or max(a, b) < ORDER_MIN_TIME:
+            continue
+        ratio = max(a, b) / min(a, b) if min(a, b) > 0 else np.inf
+        rows.append((name, a, b, ratio, ratio > threshold))
+    return rows
+
+
+def compare(results, history, threshold=REGRESSION_THRESHOLD):
+    """
+    compare results to the reference of each of them (median of the last REFERENCE_RUNS runs
+    on this machine). returns one (name, value, reference, ratio, regressed) per result
+    """
+    history = [run for run in history if run["machine"] == machine()]
+    rows = []
+    for name, value in results.items():
+        previous = [run["results"][name] for run in history if name in run["results"]][-REFERENCE_RUNS:]
+        ref = np.median(previous) if previous else None
+        ratio = value / ref if ref else None
+        rows.append((name, value, ref, ratio, ratio is not None and ratio > threshold))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the acquisition & signal processing hot paths")
+    parser.add_argument("--full",    action="store_true", help="include the 10'000 spectra stacks and the 100'000 references library")
+    parser.add_argument("--check",   action="store_true", help="exit w/ an error on any regression")
+    parser.add_argument("--no-save", action="store_true", help="don't append this run to the history")
+    parser.add_argument("--only",    choices=["signal", "ccd", "io", "cycle"], help="run only one group")
+    parser.add_argument("--history", default=HISTORY_FILE)
+    parser.add_argument("--reverse", action="store_true", help="run the benchmarks in reverse order")
+    parser.add_argument("--check-order", action="store_true", help="run in order & in reverse (fresh processes), exit w/ an error if a result depends on the order")
+    parser.add_argument("--dump",    help="also write the results to this JSON file")
+    args = parser.parse_args()
+    args.history = os.path.abspath(args.history)        # paths given relative to where the script is run from
+    args.dump    = args.dump and os.path.abspath(args.dump)
+    os.chdir(HERE)                                      # the mock devices & routines use relative paths
+    tmp = tempfile.TemporaryDirectory()                 # the dark frames of the routines' default library
+    dark_library.DARK_DIR = tmp.name                    # go there, not into the repo
+
+    if args.check_order:
+        options = (["--full"] if args.full else []) + (["--only", args.only] if args.only else [])
+        rows = order_dependence(run_process(options), run_process(options + ["--reverse"]))
+        for name, a, b, ratio, dependent in rows:
+            print("{:50s} {:12.6f} {:12.6f} {:>8s} {}".format(name, a, b, "x{:.2f}".format(ratio),
+                  "ORDER DEPENDENT" if dependent else ""))
+        dependent = [row[0] for row in rows if row[4]]
+        if dependent:
+            print("{} result(s) depend on the order of the benchmarks (beyond x{})".format(len(dependent), ORDER_THRESHOLD))
+            sys.exit(1)
+        sys.exit(0)
+
+    selected = [bench for group, bench in benchmarks(args.full) if args.only in (None, group)]
+    results = {}
+    for bench in selected[::-1] if args.reverse else selected:
+        results.update(bench())
+    results = {name: float(value) for name, value in results.items()}
+    if args.dump:
+        with open(args.dump, "w") as f:
+            json.dump(results, f)
+
+    rows = compare(results, load_history(args.history))
+    for name, value, ref, ratio, regressed in rows:
+        print("{:50s} {:12.6f} {:>12s} {:>8s} {}".format(name, value,
+              "" if ref is None else "{:.6f}".format(ref),
+              "" if ratio is None else "x{:.2f}".format(ratio),
+              "REGRESSION" if regressed else ""))
+
+    if not args.no_save:
+        save_run(results, args.history)
+
+    regressions = [row[0] for row in rows if row[4]]
+    if regressions:
+        print("{} regression(s) beyond x{}".format(len(regressions), REGRESSION_THRESHOLD))
+        if args.check:
+            sys.exit(1)
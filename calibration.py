@@ -0,0 +1,128 @@
+# The pixel -> Raman shift axis of a calibration, computed once, and a sparse linear
+# interpolation operator putting calibrated spectra onto a fixed, uniform shift grid:
+# spectra taken w/ different calibrations can then be compared point by point.
+#   cal = Calibration(calibration_parameters)
+#   cal.axis                            # [cm^-1] shift of every pixel (cached, read-only)
+#   grid, spectra = cal.resample(stack) # (N, CCD_NB_PXL) -> (N, grid size), sparse matmuls
+
+import numpy as np
+from scipy import sparse
+
+from instrumentation import span
+
+
+# constant declarations
+CCD_NB_PXL  = 3648
+GRID_MIN    = 100.      # [cm^-1] first point of the default uniform grid
+GRID_MAX    = 2300.     # [cm^-1] last point of the default uniform grid
+GRID_STEP   = .5        # [cm^-1] finer than the pixel pitch (.5 to .75 cm^-1)
+BLOCK_SIZE  = 32        # nb of spectra of a stack resampled at once (the transposes stay in cache)
+
+
+def uniform_grid(start=GRID_MIN, stop=GRID_MAX, step=GRID_STEP):
+    """
+    the uniform shift grid from start to stop (included if it falls on the grid) [cm^-1]
+    computed as start + i*step, so the same arguments always give the same points
+    """
+    n = int(np.floor((stop - start)/step + 1e-9)) + 1
+    grid = start + step*np.arange(n)
+    grid.setflags(write=False)
+    return grid
+
+
+class Calibration:
+    """
+    a polynomial pixel -> shift [cm^-1] calibration (np.polyval coefficients, as given by
+    find_correction) over a CCD of nb_pxl pixels. the shift axis and the resampling
+    operators are computed on first use and kept: they only depend on the parameters
+    """
+    def __init__(self, parameters, nb_pxl=CCD_NB_PXL):
+        self.parameters = np.array(parameters, dtype=float)
+        self.parameters.setflags(write=False)
+        self.nb_pxl     = nb_pxl
+        self._axis      = None
+        self._operators = {}                # (start, stop, step) -> (grid, operator, covered)
+
+    def __eq__(self, other):
+        return (isinstance(other, Calibration) and self.nb_pxl == other.nb_pxl
+                and np.array_equal(np.trim_zeros(self.parameters, "f"), np.trim_zeros(other.parameters, "f")))
+
+    def __hash__(self):
+        return hash((self.nb_pxl, np.trim_zeros(self.parameters, "f").tobytes()))
+
+    def __repr__(self):
+        return "Calibration({}, nb_pxl={})".format(self.parameters.tolist(), self.nb_pxl)
+
+    def __call__(self, px):
+        """
+        shift [cm^-1] at (fractional) pixel positions px
+        """
+        return np.polyval(self.parameters, px)
+
+    @property
+    def axis(self):
+        """
+        shift [cm^-1] of every pixel (read-only, shared by every caller)
+        """
+        if self._axis is None:
+            axis = np.polyval(self.parameters, np.arange(self.nb_pxl, dtype=float))
+            axis.setflags(write=False)
+            self._axis = axis
+        return self._axis
+
+    def monotonic(self):
+        """
+        check that the shift strictly increases (or decreases) along the CCD
+        """
+        d = np.diff(self.axis)
+        return bool(np.all(d > 0) or np.all(d < 0))
+
+    def operator(self, start=GRID_MIN, stop=GRID_MAX, step=GRID_STEP):
+        """
+        the sparse (grid size, nb_pxl) matrix of the linear interpolation of a spectrum on
+        this calibration's axis at the points of uniform_grid(start, stop, step): 2 weights
+        per grid point, none for the points outside the axis
+        returns grid, operator (CSR), covered (mask of the grid points inside the axis)
+        """
+        key = (float(start), float(stop), float(step))
+        if key not in self._operators:
+            if not self.monotonic():
+                raise ValueError("the calibration is not monotonic over the CCD: {}".format(self))
+            grid = uniform_grid(*key)
+            axis, px = self.axis, np.arange(self.nb_pxl)
+            if axis[0] > axis[-1]:
+                axis, px = axis[::-1], px[::-1]
+            covered = (grid >= axis[0]) & (grid <= axis[-1])
+            rows = np.flatnonzero(covered)
+            i = np.clip(np.searchsorted(axis, grid[rows], side="right") - 1, 0, self.nb_pxl-2)
+            w = (grid[rows] - axis[i]) / (axis[i+1] - axis[i])     # weight of the right neighbour
+            operator = sparse.csr_matrix((np.concatenate([1-w, w]),
+                                          (np.concatenate([rows, rows]), np.concatenate([px[i], px[i+1]]))),
+                                         shape=(grid.size, self.nb_pxl))
+            operator.sum_duplicates()                               # canonical: sorted indices, fixed sum order
+            covered.setflags(write=False)
+            self._operators[key] = (grid, operator, covered)
+        return self._operators[key]
+
+    def resample(self, x, start=GRID_MIN, stop=GRID_MAX, step=GRID_STEP, fill=np.nan, out=None):
+        """
+        put a spectrum, or a (N, nb_pxl) stack of them, onto uniform_grid(start, stop, step)
+        w/ sparse products (one per block of BLOCK_SIZE spectra). the grid points outside the
+        axis are set to fill
+        the result only depends on the inputs: the same spectra and calibration always give
+        bit for bit the same values
+        returns grid, resampled spectra (float64, written into out if given)
+        """
+        grid, operator, covered = self.operator(start, stop, step)
+        x = np.asarray(x)
+        if out is None:
+            out = np.empty(x.shape[:-1] + grid.shape)
+        with span("calibration.resample", nb_spectra=1 if x.ndim == 1 else len(x)):
+            if x.ndim == 1:
+                out[:] = x @ operator.T
+            else:
+                for i in range(0, len(x), BLOCK_SIZE):
+                    out[i:i+BLOCK_SIZE] = x[i:i+BLOCK_SIZE] @ operator.T
+            if fill != 0:
+                out[..., ~covered] = fill
+        return grid, out
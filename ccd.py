@@ -13,15 +13,30 @@ import platform
 import numpy as np
 from ctypes import *
 
+from frame_buffer import FrameRing, FrameReader, STREAM_BUFFER_FRAMES
+from instrumentation import span, traced
+
 
 # constant declarations
 UC_TIMEOUT_DELAY = 10     # [100 ms]
 CCD_NB_PXL       = 3648
 MODE_ONE_SHOT    = 0      # camera modes
+MODE_FREE_RUN    = None   # not given by the USBLC headers: set it from the manual, streaming & bulk reads need it
+BULK_MAX_FRAMES  = 16     # max nb of frames pulled from the pipe in one transfer
+WAIT_MARGIN_MS   = 100    # [ms] added to the expected acquisition time when waiting for the pipe
 
 
 # global variables, because all good programs have global variables
 integration_time_us = 100; # integration time in us
+stream_ring         = None # ring buffer filled while streaming
+stream_reader       = None # background thread filling it
+pipe_frames         = 1    # nb of frames the USB pipe is sized for
+
+
+#exceptions
+class UnconfirmedModeException(Exception):
+    def __str__(self):
+        return "the free-running mode of the CCD is not confirmed: set ccd.MODE_FREE_RUN from the USBLC documentation"
 
 
 # load the library
@@ -36,6 +51,8 @@ else :
     print("unexpected system: " + sys)
     exit()
 ccd.ls_geterrorstring.restype = c_char_p
+ccd.ls_getfps.restype = c_uint
+ccd.ls_getserialnumber.restype = c_char_p
 
 
 
@@ -46,6 +63,14 @@ def log_error(err) :
     exit()
 
 
+def list_devices():
+    """
+    get the serial numbers of the connected CCDs
+    """
+    nb_devices = ccd.ls_enumdevices()
+    return [ccd.ls_getserialnumber(i).decode('ascii') for i in range(nb_devices)]
+
+
 def init(ccd_id):
     """
     establish connection w/ CCD and do a few basic settings
@@ -58,6 +83,30 @@ def init(ccd_id):
     err = ccd.ls_opendevicebyindex(ccd_id)
     if err : log_error(err)
 
+    configure()
+
+
+def init_by_serial(serial_nb):
+    """
+    establish connection w/ the CCD w/ the given serial number (see list_devices),
+    and do a few basic settings
+    """
+    if (ccd.ls_currentdeviceindex() > -1) :	ccd.ls_closedevice()
+
+    err = ccd.ls_setpacketlength(2*CCD_NB_PXL)            # this needs to be done, because datasheet
+    if err : log_error(err)
+
+    ccd.ls_enumdevices()                                  # the library only knows the devices it enumerated
+    err = ccd.ls_opendevicebyserial(c_char_p(serial_nb.encode('ascii')))
+    if err : log_error(err)
+
+    configure()
+
+
+def configure():
+    """
+    basic settings of a freshly opened CCD
+    """
     err = ccd.ls_setmode(MODE_ONE_SHOT, UC_TIMEOUT_DELAY) # software triggered acquisition
     if err : log_error(err)
     err = ccd.ls_setstate(0, UC_TIMEOUT_DELAY)            # acquisition currently off
@@ -67,36 +116,231 @@ def init(ccd_id):
     err = ccd.ls_setinttime(100, UC_TIMEOUT_DELAY);       # set exposure time
     if err : log_error(err)
 
-def get_data():
+def free_run_mode():
     """
-    get raw data from the CCD
+    the value of the free-running camera mode
+    raises UnconfirmedModeException as long as it has not been confirmed, rather than
+    sending the CCD a mode it may hang on, or answer w/ garbage to
     """
-    err = ccd.ls_setstate(1, UC_TIMEOUT_DELAY)             # trigger acquisition
-    if err : log_error(err)
+    if MODE_FREE_RUN is None:
+        raise UnconfirmedModeException()
+    return MODE_FREE_RUN
 
-    data_type = c_ushort
-    buffer = (data_type*CCD_NB_PXL)()
-    bytes_read = c_uint(0)
+
+def get_fps():
+    """
+    get the frame rate measured by the library (0 if nothing measured yet)
+    """
+    return ccd.ls_getfps()
+
+
+def wait_timeout(nb_frames=1):
+    """
+    time [ms] to wait for nb_frames frames to be in the pipe, from the measured frame rate
+    (or from the integration time, as long as there is no measurement)
+    """
+    fps = get_fps()
+    if fps > 0:
+        frame_ms = max(1000./fps, integration_time_us/1000)
+    else:
+        frame_ms = integration_time_us/1000
+    return c_uint(int(WAIT_MARGIN_MS + nb_frames*frame_ms))
+
+
+def set_pipe_frames(nb_frames):
+    """
+    size the USB pipe for nb_frames frames, so they can be pulled in a single transfer
+    """
+    global pipe_frames
+    if nb_frames == pipe_frames : return
+    ccd.ls_initialize(c_int(nb_frames*2*CCD_NB_PXL), c_int(2*CCD_NB_PXL))
+    pipe_frames = nb_frames
+
+
+def output_buffer(out, shape):
+    """
+    check that out can be read into directly (C-contiguous uint16 of the given shape),
+    or allocate a new buffer if out is None
+    """
+    if out is None:
+        return np.empty(shape, dtype=np.uint16)
+    if out.shape != shape or out.dtype != np.uint16 or not out.flags.c_contiguous:
+        raise ValueError("output buffer must be a C-contiguous uint16 array of shape {}".format(shape))
+    return out
+
+
+def read_pipe(buffer):
+    """
+    read len(buffer) pixels from the USB pipe straight into buffer (no copy)
+    returns the number of bytes read
+    """
+    ptr = buffer.ctypes.data_as(c_void_p)
+    nb_bytes = buffer.nbytes
 
     if sys == 'Windows':	# read data (Windows)
-        err = ccd.ls_waitforpipe(c_uint(100+int(integration_time_us/1000)))       # wait for acquisition completion
+        bytes_read = c_uint(0)
+        err = ccd.ls_getpipe(ptr, c_uint(nb_bytes), pointer(bytes_read))
         if err : log_error(err)
+        return bytes_read.value
+    else:	                # read data (Linux)
+        return ccd.ls_getpipe(ptr, c_uint(nb_bytes))
 
-        err = ccd.ls_getpipe(buffer, c_uint(sizeof(data_type)*len(buffer)), pointer(bytes_read))
-        bytes_read = bytes_read.value
-        if err : log_error(err)
 
-    elif sys == 'Linux':	# read data (Linux)
-        ccd.ls_waitforpipe(c_uint(100+int(integration_time_us/1000)))       	  # wait for acquisition completion
+@traced("ccd.get_data")
+def get_data(out=None):
+    """
+    get raw data from the CCD
+    out : optional preallocated uint16 array of CCD_NB_PXL (e.g. a row of a frame block)
+          to read the frame into, instead of allocating a new one
+    """
+    out = output_buffer(out, (CCD_NB_PXL,))
+    set_pipe_frames(1)
+
+    with span("ccd.trigger"):
+        err = ccd.ls_setstate(1, UC_TIMEOUT_DELAY)         # trigger acquisition
+    if err : log_error(err)
+
+    with span("ccd.wait", integration_time_us=integration_time_us):
+        err = ccd.ls_waitforpipe(wait_timeout(1))                             # wait for acquisition completion
+    if err and sys == 'Windows' : log_error(err)                              # (returns nothing on Linux)
+
+    with span("ccd.read"):
+        bytes_read = read_pipe(out)
+    if not (bytes_read == out.nbytes):
+        print("ERROR: wrong number of bytes read: expected"+str(out.nbytes)+", got "+str(bytes_read))
+        ccd.ls_closedevice()
+        exit()
+
+    return out
+
 
-        bytes_read = ccd.ls_getpipe(buffer, c_uint(sizeof(data_type)*len(buffer)))
+@traced("ccd.get_bulk")
+def get_bulk(out):
+    """
+    acquire len(out) consecutive frames with a single trigger, and pull them all from
+    the pipe in one transfer into out (a (k, CCD_NB_PXL) uint16 block)
+    needs MODE_FREE_RUN: on the hardware it raises UnconfirmedModeException as long as the
+    mode is not confirmed (get_frames reads one frame at a time meanwhile)
+    """
+    mode = free_run_mode()
+    k = out.shape[0]
+    set_pipe_frames(k)
+
+    try:
+        with span("ccd.trigger", nb_frames=k):
+            err = ccd.ls_resetfifo(UC_TIMEOUT_DELAY)     # nothing stale in the pipe
+            if err : log_error(err)
+            err = ccd.ls_setmode(mode, UC_TIMEOUT_DELAY)
+            if err : log_error(err)
+            err = ccd.ls_setstate(1, UC_TIMEOUT_DELAY)    # trigger acquisition
+            if err : log_error(err)
+
+        with span("ccd.wait", integration_time_us=integration_time_us, nb_frames=k):
+            err = ccd.ls_waitforpipe(wait_timeout(k))     # wait for all k frames
+        if err and sys == 'Windows' : log_error(err)
+        with span("ccd.read", nb_frames=k):
+            bytes_read = read_pipe(out)
+    finally:                                              # back to one-shot, w/o the frames integrated meanwhile
+        err = ccd.ls_setstate(0, UC_TIMEOUT_DELAY)
+        if err : log_error(err)
+        err = ccd.ls_setmode(MODE_ONE_SHOT, UC_TIMEOUT_DELAY)
+        if err : log_error(err)
+        err = ccd.ls_resetfifo(UC_TIMEOUT_DELAY)
+        if err : log_error(err)
 
-    if not (bytes_read == sizeof(data_type)*CCD_NB_PXL):
-        print("ERROR: wrong number of bytes read: expected"+str(sizeof(data_type)*CCD_NB_PXL)+", got "+str(bytes_read))
+    if not (bytes_read == out.nbytes):
+        print("ERROR: wrong number of bytes read: expected"+str(out.nbytes)+", got "+str(bytes_read))
         ccd.ls_closedevice()
         exit()
 
-    return np.ctypeslib.as_array(buffer)
+    return out
+
+
+def get_frames(n, out=None):
+    """
+    get n raw frames from the CCD, BULK_MAX_FRAMES at a time
+    (one at a time as long as the free-running mode is not confirmed)
+    out : optional preallocated (n, CCD_NB_PXL) uint16 block, filled in place
+    """
+    out = output_buffer(out, (n, CCD_NB_PXL))
+    if n == 1 or MODE_FREE_RUN is None:
+        for frame in out:
+            get_data(out=frame)
+        return out
+    for i in range(0, n, BULK_MAX_FRAMES):
+        get_bulk(out[i:i+BULK_MAX_FRAMES])
+    return out
+
+
+def read_frame(buffer):
+    """
+    read the next frame the CCD has ready straight into buffer (a uint16 array of CCD_NB_PXL)
+    does not trigger; returns True if a full frame was read
+    """
+    ccd.ls_waitforpipe(wait_timeout(1))
+    return read_pipe(buffer) == buffer.nbytes
+
+
+def start_stream(nb_frames=STREAM_BUFFER_FRAMES):
+    """
+    put the CCD in free-running acquisition, and start filling a ring buffer of
+    nb_frames frames in the background. get_data() must not be used while streaming
+    needs MODE_FREE_RUN: on the hardware it raises UnconfirmedModeException as long as the
+    mode is not confirmed
+    """
+    global stream_ring, stream_reader
+    mode = free_run_mode()
+    if stream_reader is not None : stop_stream()
+    set_pipe_frames(1)
+
+    err = ccd.ls_setmode(mode, UC_TIMEOUT_DELAY)
+    if err : log_error(err)
+    err = ccd.ls_setstate(1, UC_TIMEOUT_DELAY)            # start acquiring
+    if err : log_error(err)
+
+    stream_ring   = FrameRing(nb_frames, CCD_NB_PXL, np.uint16)
+    stream_reader = FrameReader(stream_ring, read_frame)
+    stream_reader.start()
+
+
+def stop_stream():
+    """
+    stop the background acquisition and go back to software triggered acquisition
+    """
+    global stream_reader
+    if stream_reader is None : return
+    stream_reader.stop()
+    stream_reader = None
+
+    err = ccd.ls_setstate(0, UC_TIMEOUT_DELAY)
+    if err : log_error(err)
+    err = ccd.ls_resetfifo(UC_TIMEOUT_DELAY)             # throw away what's left in the pipe
+    if err : log_error(err)
+    err = ccd.ls_setmode(MODE_ONE_SHOT, UC_TIMEOUT_DELAY)
+    if err : log_error(err)
+
+
+def stream(n_frames=None):
+    """
+    iterate over the frames as the CCD produces them (starts streaming if needed)
+    yields frame, timestamp [s], nb of frames dropped since the previous one
+    needs MODE_FREE_RUN (see start_stream)
+    """
+    own = stream_reader is None
+    if own : start_stream()
+    try:
+        yield from stream_ring.stream(n_frames, timeout=1+2e-6*integration_time_us)
+    finally:
+        if own : stop_stream()
+
+
+def latest_frame():
+    """
+    get the most recent streamed frame without waiting
+    returns frame, timestamp [s], frame number (or None)
+    """
+    if stream_ring is None : return None
+    return stream_ring.latest()
 
 
 def set_integration_time(inttime_us):
@@ -113,6 +357,7 @@ def shutdown():
     """
     shut down CCD
     """
+    stop_stream()
     ccd.ls_closedevice()
 
 
@@ -121,6 +366,8 @@ def shutdown():
 ### DEMO
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
+    from auto_exposure import auto_exposure, predict_integration_time
+    from signal_treatment import detect_saturation, detect_lowsignal
 
     nb_dev = ccd.ls_enumdevices()
     print(str(nb_dev)+" devices connected")
@@ -131,13 +378,19 @@ if __name__ == "__main__":
 
     ax = plt.plot(np.zeros((1,CCD_NB_PXL)))
 
-    while True:
-    	data = get_data()
+    inttime, data, nb_frames = auto_exposure(get_data, set_integration_time, integration_time_us, 4, 1e6)
+    print("exposure set to {:.0f} us in {} frames".format(inttime, nb_frames))
+
+    def triggered():                                           # one frame at a time, w/o the free-running mode
+        while True:
+            yield get_data(), None, 0
+
+    frames = triggered() if MODE_FREE_RUN is None else stream()  # free-running: at the sensor's frame rate
+    for data, timestamp, dropped in frames:
+    	if dropped : print("{} frames dropped".format(dropped))
 
-    	if (np.max(data) > 55000) and integration_time_us > 4:
-    	    set_integration_time(0.75*integration_time_us)
-    	elif (np.max(data) < 15000)  and integration_time_us < 1e6:
-    	    set_integration_time(1.25*integration_time_us)
+    	if detect_saturation(data) or detect_lowsignal(data):    # scene changed, follow it
+    	    set_integration_time(np.clip(predict_integration_time(data, integration_time_us), 4, 1e6))
 
     	plt.cla()
     	plt.plot(data)
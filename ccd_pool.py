@@ -0,0 +1,222 @@
+# Several CCDs at once: the library talks to a single "current device" per process, so every
+# CCD gets a worker process of its own, which opens it by serial number. the frames come back
+# through a block of shared memory per CCD, only the commands and their status are pickled.
+#   with CCDPool(device="mock_ccd") as pool:
+#       pool.set_integration_time(1000)
+#       frames = pool.acquire(5)        # one (5, CCD_NB_PXL) block per CCD
+
+import importlib
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+import numpy as np
+
+from instrumentation import span
+
+
+# constant declarations
+POOL_MAX_FRAMES = 16        # frames per CCD the shared blocks can hold
+POOL_TIMEOUT    = 60.       # [s] max time to wait for a worker
+
+
+class DeviceError(Exception):
+    def __init__(self, serial_nb, message):
+        self.serial_nb = serial_nb
+        self.message   = message
+    def __str__(self):
+        return "CCD {} : {}".format(self.serial_nb, self.message)
+
+
+def worker(device, serial_nb, shm_name, max_frames, conn):
+    """
+    worker process of one CCD: open it, then run the commands from conn until told to stop
+        ("acquire", n)          : read n frames into the shared block
+        ("call", name, args)    : call any other function of the device module
+        ("stop",)
+    every command is answered w/ ("ok", result) or ("error", message)
+    """
+    ccd   = importlib.import_module(device)
+    shm   = shared_memory.SharedMemory(name=shm_name)
+    block = np.ndarray((max_frames, ccd.CCD_NB_PXL), dtype=np.uint16, buffer=shm.buf)
+    try:
+        try:
+            ccd.init_by_serial(serial_nb)
+        except Exception as e:
+            conn.send(("error", repr(e)))
+            return
+        conn.send(("ok", None))
+        while True:
+            command = conn.recv()
+            try:
+                if command[0] == "stop":
+                    break
+                if command[0] == "acquire":
+                    ccd.get_frames(command[1], out=block[:command[1]])
+                    conn.send(("ok", None))
+                else:
+                    conn.send(("ok", getattr(ccd, command[1])(*command[2])))
+            except Exception as e:
+                conn.send(("error", repr(e)))
+        ccd.shutdown()
+        conn.send(("ok", None))
+    finally:
+        del block
+        shm.close()
+
+
+class CCDPool:
+    """
+    one worker process per CCD, found by serial number (all the connected ones by default)
+    device is the name of the module driving them ("ccd", or "mock_ccd" to test w/o hardware)
+    every command goes to all the CCDs at once, and the frames of all of them are gathered
+    in shared memory: acquisition time doesn't grow w/ the nb of CCDs
+    """
+    def __init__(self, serials=None, device="ccd", max_frames=POOL_MAX_FRAMES, timeout=POOL_TIMEOUT):
+        module = importlib.import_module(device)
+        self.serials    = list(module.list_devices() if serials is None else serials)
+        self.nb_pxl     = module.CCD_NB_PXL
+        self.max_frames = max_frames
+        self.timeout    = timeout
+        self.nb_frames  = 0                     # nb of frames of the last acquisition
+        self.broken     = None                  # serial nbs of the CCDs that didn't answer in time
+        self.shms, self.blocks, self.conns, self.workers = [], [], [], []
+
+        context = mp.get_context("spawn")       # nothing of the parent's library state in the workers
+        try:
+            for serial_nb in self.serials:
+                shm = shared_memory.SharedMemory(create=True, size=max_frames*self.nb_pxl*2)
+                self.shms.append(shm)
+                self.blocks.append(np.ndarray((max_frames, self.nb_pxl), dtype=np.uint16, buffer=shm.buf))
+                conn, child = context.Pipe()
+                process = context.Process(target=worker, args=(device, serial_nb, shm.name, max_frames, child),
+                                          name="ccd " + serial_nb, daemon=True)
+                process.start()
+                child.close()                   # only the worker's end left: its exit reads as EOF
+                self.conns.append(conn)
+                self.workers.append(process)
+            self.gather()                       # wait for all the CCDs to be open
+        except:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.serials)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def send(self, command):
+        if self.broken:
+            raise DeviceError(self.broken, "late answers pending, close the pool")
+        for serial_nb, conn in zip(self.serials, self.conns):
+            try:
+                conn.send(command)
+            except (BrokenPipeError, EOFError):
+                raise DeviceError(serial_nb, "worker died")
+
+    def gather(self):
+        """
+        wait for every worker to answer the last command, returns their results
+        raises DeviceError if a CCD failed (or its worker died)
+        after a timeout, the pool is broken: the late answers would be read as the answers
+        to the next command, so every command raises until the pool is closed
+        """
+        results = [None]*len(self.conns)
+        pending = dict(zip(self.conns, range(len(self.conns))))
+        errors  = []
+        while pending:
+            ready = wait(list(pending), self.timeout)
+            if not ready:
+                self.broken = ", ".join(self.serials[i] for i in pending.values())
+                raise DeviceError(self.broken, "no answer")
+            for r in ready:
+                i = pending.pop(r)
+                try:
+                    status, results[i] = r.recv()
+                except EOFError:                # the worker ended w/o answering
+                    errors.append(DeviceError(self.serials[i], "worker died"))
+                    continue
+                if status == "error":
+                    errors.append(DeviceError(self.serials[i], results[i]))
+        if errors:
+            raise errors[0]
+        return results
+
+    def call(self, name, *args):
+        """
+        call a function of the device module on every CCD, returns the results (in order)
+        """
+        self.send(("call", name, args))
+        return self.gather()
+
+    def set_integration_time(self, inttime_us):
+        self.call("set_integration_time", inttime_us)
+
+    def trigger(self, n=1):
+        """
+        start the acquisition of n frames on every CCD (doesn't wait for them)
+        """
+        if n > self.max_frames:
+            raise ValueError("at most {} frames per acquisition".format(self.max_frames))
+        self.nb_frames = n
+        self.send(("acquire", n))
+
+    def frames(self):
+        """
+        wait for the acquisition started by trigger() to complete on every CCD
+        returns one (n, CCD_NB_PXL) uint16 block per CCD: views of the shared memory,
+        overwritten by the next acquisition (copy them to keep them)
+        """
+        with span("ccd_pool.gather", nb_devices=len(self)):
+            self.gather()
+        return [block[:self.nb_frames] for block in self.blocks]
+
+    def acquire(self, n=1):
+        """
+        acquire n frames on every CCD at once (see frames)
+        """
+        with span("ccd_pool.acquire", nb_devices=len(self), nb_frames=n):
+            self.trigger(n)
+            return self.frames()
+
+    def close(self):
+        """
+        shut every CCD down and free the shared memory
+        """
+        for conn, process in zip(self.conns, self.workers):
+            if process.is_alive():
+                try:
+                    conn.send(("stop",))
+                    while wait([conn, process.sentinel], self.timeout) and conn.poll():
+                        conn.recv()             # any late answers, then the stop's, until EOF
+                except (EOFError, OSError):
+                    pass
+            process.join(self.timeout)
+            if process.is_alive():
+                process.terminate()
+        self.blocks = []
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms, self.conns, self.workers = [], [], []
+
+
+
+# BENCHMARK
+if __name__ == "__main__":
+    import time
+
+    for nb_devices in [1, 2, 4]:
+        with CCDPool(["MOCK{:04d}".format(i) for i in range(nb_devices)], device="mock_ccd") as pool:
+            pool.set_integration_time(10000)
+            pool.acquire(1)                                 # first frame: templates parsed
+            t = time.perf_counter()
+            for i in range(5):
+                frames = pool.acquire(8)
+            dt = time.perf_counter() - t
+            print("{} CCD(s): {:6.1f} frames/s ({:5.1f} frames/s per CCD)".format(
+                  nb_devices, 5*8*nb_devices/dt, 5*8/dt))
@@ -0,0 +1,129 @@
+# The clock the routines, the mock devices and the demos wait on. By default it is the real
+# one; a virtual clock makes every wait return at once while advancing the simulated time, so
+# full calibration & acquisition cycles run as fast as the processing allows, and still tell
+# how long they would have taken on the hardware.
+#   sim = clock.use(clock.VirtualClock())
+#   ... calibrate(), run_batch(...), ...
+#   print(sim.elapsed(), sim.nb_sleeps)                 # [s] of hardware time, nb of waits
+#   clock.use(clock.RealClock())
+# timestamps (dark library, archive, laser state cache) are taken on the same clock. the
+# modules keeping times for later register w/ on_change, to bring them over to a new clock:
+# after a virtual run, nothing is left in the future of the real clock.
+
+import time
+import asyncio
+import threading
+
+
+class RealClock:
+    """
+    the system clock: waits really wait
+    """
+    def now(self):
+        """
+        wall time [s since the epoch]
+        """
+        return time.time()
+
+    def perf_counter(self):
+        """
+        monotonic time [s], for durations
+        """
+        return time.perf_counter()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    async def sleep_async(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    a simulated clock, which only moves when something waits on it: sleep returns at once
+    and advances the time by the duration of the wait
+    the waits of concurrent threads add up, so elapsed() is the hardware time of the waits
+    as if they ran one after the other (an upper bound when they would overlap)
+    """
+    def __init__(self, start=None):
+        self.start     = time.time() if start is None else start   # timestamps stay plausible
+        self.t         = self.start
+        self.nb_sleeps = 0
+        self.lock      = threading.Lock()
+
+    def now(self):
+        return self.t
+
+    def perf_counter(self):
+        return self.t
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        with self.lock:
+            self.t += seconds
+            self.nb_sleeps += 1
+
+    async def sleep_async(self, seconds):
+        self.sleep(seconds)
+        await asyncio.sleep(0)                  # still let the other tasks run
+
+    def elapsed(self):
+        """
+        [s] of simulated time since the clock started
+        """
+        return self.t - self.start
+
+
+# global variables
+current   = RealClock()
+listeners = []      # functions called w/ (old clock, new clock) whenever the clock changes
+
+
+def use(new_clock):
+    """
+    make every module wait on new_clock (a RealClock or a VirtualClock), returns it
+    the listeners (see on_change) bring their times over to it
+    """
+    global current
+    old, current = current, new_clock
+    if new_clock is not old:
+        for listener in listeners:
+            listener(old, new_clock)
+    return new_clock
+
+
+def on_change(listener):
+    """
+    register listener(old clock, new clock), called when use() changes the clock (a decorator)
+    """
+    listeners.append(listener)
+    return listener
+
+
+def now():
+    """
+    wall time [s since the epoch] of the current clock
+    """
+    return current.now()
+
+
+def perf_counter():
+    """
+    monotonic time [s] of the current clock
+    """
+    return current.perf_counter()
+
+
+def sleep(seconds):
+    """
+    wait for seconds [s] on the current clock
+    """
+    current.sleep(seconds)
+
+
+async def sleep_async(seconds):
+    """
+    wait for seconds [s] on the current clock, without blocking the event loop
+    """
+    await current.sleep_async(seconds)
@@ -0,0 +1,125 @@
+import os
+import glob
+import weakref
+import numpy as np
+
+import clock
+
+
+# constant declarations
+DARK_DIR        = "./dark_frames"
+DARK_MAX_AGE    = 3600.     # [s]   older dark frames are re-acquired
+DARK_REL_TOL    = 2e-2      # relative difference under which two integration times are the same
+DARK_MAX_EXTRAP = .25       # max relative distance to the closest stored time when extrapolating
+
+
+# global variables
+libraries       = weakref.WeakSet()     # every open library, for change_clock
+
+
+class DarkLibrary:
+    """
+    averaged dark frames, kept on disk and keyed by integration time.
+    each entry is a small .npz (float32 frame + integration time, timestamp and nb of
+    averaged frames). dark frames at integration times in between two stored ones are
+    interpolated with a per-pixel offset + dark current model:
+        dark(t) = offset + current * t
+    the model assumes a constant CCD temperature (the CCD does not report it): only the
+    age limit max_age [s] catches a drift of the dark current
+    """
+    def __init__(self, path=None, max_age=DARK_MAX_AGE):
+        self.path      = DARK_DIR if path is None else path     # looked up now: can be redirected
+        self.max_age   = max_age
+        self.entries   = {}                 # integration time [us] -> dict(frame, timestamp, nb_frames)
+        libraries.add(self)
+        os.makedirs(self.path, exist_ok=True)
+        for filename in glob.glob(os.path.join(self.path, "dark_*.npz")):
+            with np.load(filename) as f:
+                self.entries[float(f["int_time"])] = dict(
+                    frame       = f["frame"],
+                    timestamp   = float(f["timestamp"]),
+                    nb_frames   = int(f["nb_frames"]))
+
+    def filename(self, int_time):
+        return os.path.join(self.path, "dark_{:.3f}us.npz".format(int_time))
+
+    def store(self, int_time, frame, nb_frames=1):
+        """
+        add (or replace) the averaged dark frame for int_time [us]
+        """
+        int_time = float(int_time)
+        entry = dict(frame       = np.asarray(frame, dtype=np.float32),
+                     timestamp   = clock.now(),
+                     nb_frames   = nb_frames)
+        for t in [t for t in self.entries if self.same(t, int_time)]:
+            self.remove(t)
+        np.savez(self.filename(int_time), int_time=int_time, **entry)
+        self.entries[int_time] = entry
+
+    def remove(self, int_time):
+        """
+        forget the dark frame for int_time [us]
+        """
+        del self.entries[int_time]
+        if os.path.exists(self.filename(int_time)):
+            os.remove(self.filename(int_time))
+
+    def same(self, t1, t2):
+        return abs(t1 - t2) <= DARK_REL_TOL*max(t1, t2)
+
+    def fresh(self, entry):
+        """
+        check that an entry is recent enough
+        """
+        age = clock.now() - entry["timestamp"]
+        return 0 <= age <= self.max_age                      # from the future: stored on another clock
+
+    def lookup(self, int_time):
+        """
+        get the dark frame for int_time [us] from the library: either a fresh stored one,
+        or one interpolated between the two closest fresh ones around it (or extrapolated
+        from the two closest on one side, if int_time is not too far from them)
+        returns None if there is nothing usable
+        """
+        times = sorted(t for t, e in self.entries.items() if self.fresh(e))
+        for t in times:
+            if self.same(t, int_time):
+                return self.entries[t]["frame"].astype(float)
+
+        below = [t for t in times if t < int_time]
+        above = [t for t in times if t > int_time]
+        if below and above:
+            t1, t2 = below[-1], above[0]
+        elif len(below) >= 2 and int_time - below[-1] <= DARK_MAX_EXTRAP*below[-1]:
+            t1, t2 = below[-2], below[-1]
+        elif len(above) >= 2 and above[0] - int_time <= DARK_MAX_EXTRAP*int_time:
+            t1, t2 = above[0], above[1]
+        else:
+            return None
+        d1, d2 = self.entries[t1]["frame"].astype(float), self.entries[t2]["frame"].astype(float)
+        current = (d2 - d1) / (t2 - t1)                 # [counts/us] per pixel
+        offset  = d1 - current*t1
+        return offset + current*int_time
+
+    def get(self, int_time, acquire, nb_frames=1):
+        """
+        get the dark frame for int_time [us], calling acquire() to take (and store) a
+        new one only if the library has nothing usable
+        """
+        dark = self.lookup(int_time)
+        if dark is None:
+            dark = acquire()
+            self.store(int_time, dark, nb_frames)
+        return dark
+
+
+@clock.on_change
+def change_clock(old, new):
+    """
+    move the timestamps of the dark frames of the open libraries over to a new clock
+    (the files keep the old ones: once reloaded, frames from the future count as stale)
+    """
+    shift = new.now() - old.now()
+    for library in libraries:
+        for entry in library.entries.values():
+            entry["timestamp"] += shift
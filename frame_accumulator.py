@@ -0,0 +1,91 @@
+import numpy as np
+import scipy.signal as signal
+
+
+# constant declarations
+SNR_NB_PEAKS    = 5         # nb of strongest pixels the SNR target applies to
+SNR_PEAK_SPACE  = 20        # [px] min distance between two of those pixels
+SNR_MIN_FRAMES  = 4         # nb of frames before the SNR is trusted (a variance on 1 degree of freedom is not)
+BLOCK_FRAMES    = 16        # default max nb of frames asked for at once
+
+
+class FrameAccumulator:
+    """
+    running per-pixel mean and variance of frames (Welford's algorithm, float64 sums),
+    so averaging any number of frames takes the memory of a few frames
+    """
+    def __init__(self, nb_pxl=3648):
+        self.n     = 0
+        self.mean  = np.zeros(nb_pxl)
+        self.m2    = np.zeros(nb_pxl)       # sum of squared deviations from the mean
+        self.delta = np.zeros(nb_pxl)       # scratch
+
+    def add(self, frame):
+        """
+        add one (uint16) frame to the statistics
+        """
+        self.n += 1
+        np.subtract(frame, self.mean, out=self.delta)
+        self.mean += self.delta / self.n
+        self.m2   += self.delta * (frame - self.mean)
+
+    def add_block(self, frames):
+        """
+        add a (k, nb_pxl) block of frames to the statistics at once (Chan's merge of the
+        block's mean & variance w/ the running ones)
+        """
+        k = len(frames)
+        if k == 0:
+            return
+        frames = np.asarray(frames, dtype=float)
+        mean   = frames.mean(axis=0)
+        m2     = ((frames - mean)**2).sum(axis=0)
+        n      = self.n + k
+        np.subtract(mean, self.mean, out=self.delta)
+        self.m2   += m2 + self.delta**2 * (self.n*k/n)
+        self.mean += self.delta * (k/n)
+        self.n     = n
+
+    def variance(self):
+        """
+        per-pixel variance of the frames (unbiased)
+        """
+        if self.n < 2:
+            return np.full(self.mean.shape, np.inf)
+        return self.m2 / (self.n - 1)
+
+    def snr(self, dark=0):
+        """
+        per-pixel signal-to-noise ratio of the mean: (mean - dark) / standard error of the mean
+        """
+        stderr = np.sqrt(self.variance() / max(self.n, 1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(stderr > 0, (self.mean - dark) / stderr, np.inf)
+
+    def peak_snr(self, dark=0, nb_peaks=SNR_NB_PEAKS, spacing=SNR_PEAK_SPACE):
+        """
+        lowest SNR among the nb_peaks strongest pixels of the mean (at least spacing px apart)
+        """
+        data  = self.mean - dark
+        peaks = signal.find_peaks(data, distance=spacing)[0]
+        if peaks.size == 0:
+            peaks = np.array([np.argmax(data)])
+        peaks = peaks[np.argsort(data[peaks])[::-1][:nb_peaks]]
+        return np.min(self.snr(dark)[peaks])
+
+
+def accumulate(get_frames, max_frames, target_snr=None, min_frames=SNR_MIN_FRAMES, block=BLOCK_FRAMES, dark=0, nb_pxl=3648):
+    """
+    average blocks of frames from get_frames(k) (a (k, nb_pxl) block) as they come, until the
+    SNR of the strongest peaks reaches target_snr (after at least min_frames), or max_frames
+    have been taken. the first block has min_frames frames, the next ones up to block frames
+    returns the accumulator (mean, variance, snr, n)
+    """
+    acc = FrameAccumulator(nb_pxl)
+    k = min(min_frames, max_frames)
+    while acc.n < max_frames:
+        acc.add_block(get_frames(k))
+        if target_snr is not None and acc.n >= min_frames and acc.peak_snr(dark) >= target_snr:
+            break
+        k = min(block, max_frames - acc.n)
+    return acc
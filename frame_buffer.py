@@ -0,0 +1,111 @@
+import threading
+import numpy as np
+
+import clock
+
+
+# constant declarations
+STREAM_BUFFER_FRAMES = 64       # frames kept in the ring buffer
+STREAM_WAIT_TIMEOUT  = 5.       # [s] max time a consumer waits for a new frame
+
+
+class FrameRing:
+    """
+    preallocated ring buffer of CCD frames, written by one reader thread and read by
+    any number of consumers. every frame gets a sequence number and a timestamp; a
+    consumer that falls more than `capacity` frames behind loses the oldest ones,
+    and is told how many it lost.
+    """
+    def __init__(self, capacity=STREAM_BUFFER_FRAMES, nb_pxl=3648, dtype=np.uint16):
+        self.frames     = np.zeros((capacity, nb_pxl), dtype=dtype)
+        self.timestamps = np.zeros(capacity)
+        self.capacity   = capacity
+        self.next_seq   = 0             # sequence number of the next frame to be written
+        self.oldest     = 0             # oldest sequence number that is still readable
+        self.read_errors = 0            # frames the reader failed to get from the device
+        self.cond       = threading.Condition()
+
+    def slot(self):
+        """
+        get the buffer the next frame should be written to (writer side).
+        the frame previously held there is no longer readable from this point on
+        """
+        with self.cond:
+            self.oldest = max(self.oldest, self.next_seq - self.capacity + 1)
+            return self.frames[self.next_seq % self.capacity]
+
+    def commit(self, timestamp=None):
+        """
+        publish the frame written to slot() (writer side)
+        """
+        with self.cond:
+            self.timestamps[self.next_seq % self.capacity] = clock.now() if timestamp is None else timestamp
+            self.next_seq += 1
+            self.cond.notify_all()
+
+    def latest(self):
+        """
+        get a copy of the most recent frame without waiting
+        returns frame, timestamp, seq (or None if no frame has arrived yet)
+        """
+        with self.cond:
+            if self.next_seq == 0:
+                return None
+            seq = self.next_seq - 1
+            i = seq % self.capacity
+            return self.frames[i].copy(), self.timestamps[i], seq
+
+    def get(self, seq, timeout=STREAM_WAIT_TIMEOUT):
+        """
+        get a copy of frame number seq, waiting for it if it has not arrived yet.
+        if it has already been overwritten, the oldest frame still available is returned instead
+        returns frame, timestamp, seq of the returned frame (or None on timeout)
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.next_seq > seq, timeout):
+                return None
+            seq = max(seq, self.oldest)
+            i = seq % self.capacity
+            return self.frames[i].copy(), self.timestamps[i], seq
+
+    def stream(self, n_frames=None, timeout=STREAM_WAIT_TIMEOUT):
+        """
+        iterate over the frames as they arrive, starting with the next one
+        yields frame, timestamp, nb of frames dropped since the previous one
+        stops after n_frames (never if None) or when no frame arrived within timeout
+        """
+        seq = self.next_seq
+        count = 0
+        while n_frames is None or count < n_frames:
+            res = self.get(seq, timeout)
+            if res is None:
+                return
+            frame, timestamp, got = res
+            yield frame, timestamp, got - seq
+            seq = got + 1
+            count += 1
+
+
+class FrameReader(threading.Thread):
+    """
+    background thread that fills a FrameRing using read_frame(buffer) -> bool,
+    a function that acquires one frame straight into the given buffer
+    """
+    def __init__(self, ring, read_frame):
+        super().__init__(daemon=True)
+        self.ring = ring
+        self.read_frame = read_frame
+        self.running = threading.Event()
+
+    def run(self):
+        self.running.set()
+        while self.running.is_set():
+            buffer = self.ring.slot()
+            if self.read_frame(buffer):
+                self.ring.commit()
+            else:
+                self.ring.read_errors += 1
+
+    def stop(self):
+        self.running.clear()
+        self.join()
@@ -0,0 +1,149 @@
+# Opt-in timing instrumentation of the laser, the CCD, the signal processing and the routines.
+#   instrumentation.enable()
+#   ... calibrate(), acquire_sample_spectrum(), ...
+#   instrumentation.export_chrome_trace("trace.json")    # open in chrome://tracing or ui.perfetto.dev
+#   instrumentation.summary()                           # per span: count, total, mean, percentiles
+# while disabled (the default), spans cost a flag check and nothing is recorded.
+
+import os
+import json
+import inspect
+import time
+import functools
+import threading
+import numpy as np
+
+
+# global variables
+enabled   = False
+events    = []      # complete ("X") events of the chrome trace-event format
+durations = {}      # span name -> list of durations [s]
+t0        = time.perf_counter()
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_no_span = _NoSpan()
+
+
+class _Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+def enable(on=True):
+    """
+    start (or stop) recording spans
+    """
+    global enabled
+    enabled = on
+
+
+def reset():
+    """
+    forget everything recorded so far
+    """
+    events.clear()
+    durations.clear()
+
+
+def span(name, **args):
+    """
+    context manager timing the enclosed block as `name` (args end up in the trace)
+    """
+    if not enabled:
+        return _no_span
+    return _Span(name, args)
+
+
+def traced(name=None):
+    """
+    decorator timing every call of a function (or coroutine) as a span (named after the function by default)
+    """
+    def decorator(func):
+        span_name = name or "{}.{}".format(func.__module__, func.__qualname__)
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not enabled:
+                    return await func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    record(span_name, start, time.perf_counter())
+            return async_wrapper
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(span_name, start, time.perf_counter())
+        return wrapper
+    return decorator
+
+
+def record(name, start, stop, args=None):
+    """
+    record a span that ran from start to stop (time.perf_counter() values)
+    """
+    durations.setdefault(name, []).append(stop - start)
+    event = dict(name=name, ph="X", ts=1e6*(start - t0), dur=1e6*(stop - start),
+                 pid=os.getpid(), tid=threading.get_ident())
+    if args:
+        event["args"] = {k: str(v) for k, v in args.items()}
+    events.append(event)
+
+
+def export_chrome_trace(filename):
+    """
+    write the recorded spans as a chrome trace-event JSON file
+    """
+    with open(filename, "w") as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
+
+
+def histograms(bins=20):
+    """
+    histogram of the durations [s] of each span: name -> (counts, bin edges)
+    """
+    return {name: np.histogram(d, bins=bins) for name, d in durations.items()}
+
+
+def summary():
+    """
+    per span name: count, total, mean, p50, p95 and max duration [s]
+    """
+    res = {}
+    for name, d in durations.items():
+        d = np.array(d)
+        res[name] = dict(count=d.size, total=d.sum(), mean=d.mean(),
+                         p50=np.percentile(d, 50), p95=np.percentile(d, 95), max=d.max())
+    return res
+
+
+def report():
+    """
+    summary() as a table, slowest total first
+    """
+    lines = ["{:45s} {:>6s} {:>10s} {:>10s} {:>10s} {:>10s}".format("span", "count", "total[ms]", "mean[ms]", "p95[ms]", "max[ms]")]
+    for name, s in sorted(summary().items(), key=lambda item: -item[1]["total"]):
+        lines.append("{:45s} {:6d} {:10.3f} {:10.3f} {:10.3f} {:10.3f}".format(
+                     name, s["count"], 1e3*s["total"], 1e3*s["mean"], 1e3*s["p95"], 1e3*s["max"]))
+    return "\n".join(lines)
@@ -1,6 +1,9 @@
 import serial               # pyserial to communicate w/ laser
 from serial.tools import list_ports
 
+import clock
+from instrumentation import span
+
 # laser_commands = {
 #     "l?" :  "get laser on/off state"
 #     "lo" :  "laser off "
@@ -11,15 +14,36 @@ from serial.tools import list_ports
 #     "ci" : "Enter constant current mode"
 #     }
 
+# settling of the output power
+SETTLE_TOL      = 1e-3      # [W]   max deviation from the setpoint
+SETTLE_HOLD     = .1        # [s]   time the power has to stay within tolerance
+SETTLE_RATE     = 50        # [Hz]  polling rate
+SETTLE_TIMEOUT  = 5         # [s]
+
+# serial session
+MAX_POWER       = 0.120     # [W]
+EOL             = "\r\n"
+CACHED_QUERIES  = ("l?", "p?", "gsn?")  # queries whose answer only changes through commands
+STATE_MAX_AGE   = 1.        # [s]   cached answers older than this are asked again
 
 # global variables
 laser_serial = serial.Serial();
+session      = None;    # LaserSession on laser_serial
 
 #exceptions
 class FailureToOpenPortException(Exception):
     def __str__(self):
         return "laser port not open"
 
+class LaserCommandException(Exception):
+    def __init__(self, command, reply):
+        self.command = command
+        self.reply   = reply
+    def __str__(self):
+        if not self.reply:
+            return "no reply from laser to '{}'".format(self.command)
+        return "laser replied '{}' to '{}'".format(self.reply, self.command)
+
 # laser faults
 faults = {
     0 : "no error",
@@ -27,18 +51,159 @@ faults = {
     3 : "remote interlock error",
     4 : "constant power timeout" }
 
+class LaserSession:
+    """
+    command session w/ the laser over a serial port, which
+    - keeps track of the laser state (mode, power setpoint, on/off) and skips the
+      commands that would not change it, and the queries answered less than max_age [s] ago
+      (the state is forgotten after max_age [s], on any communication error, and on a restart:
+      a laser that resets by itself is commanded again)
+    - sends several commands in a single write, and matches the replies (one line each, in order)
+    - measures the latency of every command (write -> its reply), in latencies
+    port is anything w/ pyserial's write/readline/reset_input_buffer: a serial.Serial
+    (on the laser, or on the pty of mock_laser.serve_pty), or a mock_laser.MockSerial
+    """
+    def __init__(self, port, max_age=STATE_MAX_AGE):
+        self.port       = port
+        self.max_age    = max_age
+        self.answers    = {}        # query -> (answer, time)
+        self.mode       = None      # "cp" / "ci", None if unknown
+        self.setpoint   = None      # [W], None if unknown
+        self.state_time = 0.        # [s]  when mode & setpoint were last commanded
+        self.latencies  = {}        # command name -> list of latencies [s]
+        self.nb_sent    = 0
+        self.nb_skipped = 0
+
+    def invalidate(self):
+        """
+        forget the laser state (e.g. after it was commanded outside of this session)
+        """
+        self.answers.clear()
+        self.mode     = None
+        self.setpoint = None
+
+    def send(self, *commands):
+        """
+        send commands in a single write and return their replies, in order
+        raises LaserCommandException on a missing reply, or a setting that was not OK
+        the laser state is forgotten on any error: it is not known what the laser got
+        """
+        if not commands:
+            return []
+        with span("laser.send", commands=" ; ".join(commands)):
+            try:
+                self.port.reset_input_buffer()
+                start = clock.perf_counter()
+                self.port.write("".join(command + EOL for command in commands).encode("ascii"))
+                self.nb_sent += len(commands)
+                replies = []
+                for command in commands:
+                    reply = self.port.readline().decode("ascii").strip()
+                    self.latencies.setdefault(command.split()[0], []).append(clock.perf_counter() - start)
+                    self.update(command, reply)
+                    replies.append(reply)
+            except Exception:
+                self.invalidate()
+                raise
+        return replies
+
+    def update(self, command, reply):
+        """
+        update the laser state w/ a command and its reply
+        """
+        if not reply:
+            raise LaserCommandException(command, reply)
+        name, _, arg = command.partition(" ")
+        now = clock.now()
+        if name.endswith("?"):
+            if name in CACHED_QUERIES:
+                self.answers[name] = (reply, now)
+            return
+        if not "OK" in reply:
+            raise LaserCommandException(command, reply)
+        if name in ("cp", "ci"):
+            self.mode       = name
+            self.state_time = now
+        elif name == "p":
+            self.setpoint   = float(arg)
+            self.state_time = now
+            self.answers["p?"] = (arg, now)
+        elif name in ("l0", "l1"):
+            self.answers["l?"] = (name[1], now)
+        else:                                               # restart, current setting, ...
+            self.invalidate()
+
+    def query(self, query):
+        """
+        answer to a query, from the cache if it was asked less than max_age [s] ago
+        """
+        answer, t = self.answers.get(query, (None, 0.))
+        if answer is not None and clock.now() - t <= self.max_age:
+            self.nb_skipped += 1
+            return answer
+        return self.send(query)[0]
+
+    def set_power(self, power_W):
+        """
+        set the power setpoint [W] in constant power mode, in one write (or none at all)
+        """
+        power_W  = float("{:.4f}".format(min(max(power_W, 0.), MAX_POWER)))
+        if clock.now() - self.state_time > self.max_age:  # may have reset since: command it again
+            self.mode     = None
+            self.setpoint = None
+        commands = []
+        if self.mode != "cp":
+            commands.append("cp")
+        if self.setpoint != power_W:
+            commands.append("p {:.4f}".format(power_W))
+        self.nb_skipped += 2 - len(commands)
+        self.send(*commands)
+
+    def get_power(self):
+        """
+        current output power [W] (always measured)
+        """
+        return float(self.send("pa?")[0])
+
+    def start(self):
+        """
+        restart the laser, returns its fault code and interlock state
+        the queries only go once the restart is answered: the laser may drop (or answer out
+        of order) what arrives while it restarts
+        """
+        self.send("@cob1")
+        fault, ilk = self.send("f?", "ilk?")
+        self.invalidate()                                   # whatever was answered during the restart
+        return int(fault), int(ilk)
+
+    def off(self):
+        """
+        turn the laser off
+        """
+        if self.query("l?") != "0":
+            self.send("l0")
+
+    def latency(self):
+        """
+        per command name: nb of commands, mean and max latency [s]
+        """
+        return {name: (len(l), sum(l)/len(l), max(l)) for name, l in self.latencies.items()}
+
+
 # functions
 def init(laser_id):
     """
     initialize the serial port through which we will communicate with the laser
     """
     global laser_serial
+    global session
     baud = 112500
     try :
         # Connect to the slected port port, baudrate, timeout in milliseconds
         laser_serial = serial.Serial( list_ports.comports()[laser_id].device, baud, timeout=1)
         if not laser_serial.is_open:
             raise FailureToOpenPortException()
+        session = LaserSession(laser_serial)
 
     except Exception as e:
         print("Exception: " + str(e))
@@ -46,6 +211,14 @@ def init(laser_id):
             laser_serial.close()
         exit()
 
+@clock.on_change
+def change_clock(old, new):
+    """
+    forget the laser state cached on the old clock
+    """
+    if session is not None:
+        session.invalidate()
+
 def cmd(command):
     """
     send a string as a command to the laser via the serial port
@@ -54,10 +227,13 @@ def cmd(command):
     try:
         if (not laser_serial) or (not laser_serial.is_open):
             raise FailureToOpenPortException()
-        laser_serial.reset_input_buffer()
-        laser_serial.write( (command + "\r\n").encode('ascii') ) # encode('ascii') converts python string to a binary ascii representation
+        with span("laser.cmd", command=command):
+            laser_serial.reset_input_buffer()
+            laser_serial.write( (command + "\r\n").encode('ascii') ) # encode('ascii') converts python string to a binary ascii representation
 
-        result = laser_serial.readline().decode('ascii')
+            result = laser_serial.readline().decode('ascii')
+        if session is not None and not command.endswith("?"):
+            session.invalidate()    # the state may have changed behind the session's back
         return result
 
     except Exception as e:
@@ -79,14 +255,18 @@ def start(power_W=0.120):
     """
     start the laser
     """
-    cmd("@cob1")    # force restart
+    try:
+        fault, ilk = session.start()    # force restart, get fault & remote interlock state
+    except LaserCommandException as e:
+        print("ERROR: " + str(e))
+        shutdown()
+        exit()
 
-    fault = int(cmd("f?"))
     if fault:
         print("ERROR: Laser fault {} : {}".format(fault, faults[fault]))
         exit()
 
-    if int(cmd("ilk?")): # get remote interlock state
+    if ilk:
         print("ERROR: interlock not closed")
         return
 
@@ -102,15 +282,12 @@ def stop():
 def set_power(power_W):
     """
     set the power setpoint for the laser to track in [W]
+    (constant power mode & setpoint are only sent if they changed)
     """
-    if power_W > 0.120 : power_W = 0.120
-    elif power_W < 0.  : power_W = 0.
-    if not ("OK" in cmd("cp")):
-        print(answer)
-        shutdown()
-        exit()
-    if not ("OK" in cmd("p {:.4f}".format(float(power_W)))):
-        print(answer)
+    try:
+        session.set_power(power_W)
+    except LaserCommandException as e:
+        print("ERROR: " + str(e))
         shutdown()
         exit()
 
@@ -119,14 +296,36 @@ def get_power():
     """
     get the current output power in [W]
     """
-    return float(cmd("pa?"))
+    return session.get_power()
+
+
+def wait_settled(power_W, tol=SETTLE_TOL, hold=SETTLE_HOLD, rate=SETTLE_RATE, timeout=SETTLE_TIMEOUT, get_power=get_power):
+    """
+    wait for the output power to settle on power_W [W] : poll it at rate [Hz] and
+    return as soon as it has stayed within tol [W] of the setpoint for hold [s]
+    get_power : function measuring the output power [W] (the mock laser passes its own)
+    returns (settled, time waited [s]), settled is False if timeout [s] ran out first
+    """
+    power_W = min(max(power_W, 0.), MAX_POWER)
+    start = clock.perf_counter()            # monotonic: a change of the wall time doesn't end the wait
+    in_tol_since = None
+    while True:
+        now = clock.perf_counter()
+        if abs(get_power() - power_W) <= tol:
+            if in_tol_since is None : in_tol_since = now
+            if now - in_tol_since >= hold:
+                return True, now - start
+        else:
+            in_tol_since = None
+        if now - start >= timeout:
+            return False, now - start
+        clock.sleep(1./rate)
 
 
 
 # DEMO
 if __name__ == "__main__" :
     import os
-    import time
 
     try:
         devices_found = list()
@@ -153,16 +352,18 @@ if __name__ == "__main__" :
 
     print("getting laser status: ")
     while True:
-        if int(cmd("l?")) == 1 : status = "ON"
-        else :                   status = "OFF"
-        print("laser is {}, \n\twith power setpoint at {} mW. ".format(status, 1e3*float(cmd("p?"))))
-        print("\tcurrent output power is {} mW".format(1e3*float(cmd("pa?"))))
+        if int(session.query("l?")) == 1 : status = "ON"
+        else :                             status = "OFF"
+        print("laser is {}, \n\twith power setpoint at {} mW. ".format(status, 1e3*float(session.query("p?"))))
+        print("\tcurrent output power is {} mW".format(1e3*get_power()))
+        for name, (n, mean, worst) in session.latency().items():
+            print("\t{:6s} : {:4d} commands, {:6.2f} ms mean, {:6.2f} ms max latency".format(name, n, 1e3*mean, 1e3*worst))
         fault = int(cmd("f?"))
         if fault:
             print(fault)
             break;
 
-        time.sleep(.5)
+        clock.sleep(.5)
         os.system('cls' if os.name=='nt' else 'clear')
 
     print("shutting down")
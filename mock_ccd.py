@@ -1,35 +1,25 @@
-import re
-import scipy.interpolate    as interpolate
-
-
-import time
-import platform
 import numpy as np
-from ctypes import *
+
+import clock
+import spectrum_io
+from frame_buffer import FrameRing, FrameReader, STREAM_BUFFER_FRAMES
+from instrumentation import span, traced
 
 
 # constant declarations
 UC_TIMEOUT_DELAY = 10     # [100 ms]
 CCD_NB_PXL       = 3648
 MODE_ONE_SHOT    = 0      # camera modes
+BULK_MAX_FRAMES  = 16     # max nb of frames pulled from the pipe in one transfer
+MOCK_DEVICES     = 4      # nb of CCDs list_devices pretends are connected
 
 
 # global variables, because all good programs have global variables
 integration_time_us = 100; # integration time in us
 filename = "./mock_resources/exc785_Sample1_100pc_p2.txt"
-
-# load the library
-sys = platform.system()
-WL = sizeof(c_voidp)*8
-if sys == 'Windows':
-    ccd = CDLL(".\\USBLC_DLL\\"+str(WL)+"Bit\\usblc"+str(WL)+".dll")
-elif sys == 'Linux':
-# ccd = CDLL("./USBLC_SO_Linux/"+str(WL)+"Bit/libusblc"+str(WL)+".so") # for the VM
-    ccd = CDLL("./USBLC_SO_Jetson/libusblcjtn.so.1.2.0")
-else :
-    print("unexpected OS: " + sys)
-    exit()
-ccd.ls_geterrorstring.restype = c_char_p
+stream_ring         = None
+stream_reader       = None
+device_serial       = None   # serial nb of the CCD opened by init_by_serial
 
 # mock functions
 def init(ccd_id):
@@ -39,26 +29,109 @@ def init(ccd_id):
     pass
 
 
-def get_data():
+def list_devices():
     """
-    get raw data from the CCD
+    get the serial numbers of the connected CCDs
     """
-    f = open(filename, 'r')
-    s = np.array(re.findall(r'(\d+\.\d+)', f.read()), dtype = np.float32)
-    f.close();
+    return ["MOCK{:04d}".format(i) for i in range(MOCK_DEVICES)]
+
 
-    x, y = [], []
-    for i in range(int(s.size/2)) :
-        x.append(s[2*i])
-        y.append(s[2*i+1])
+def init_by_serial(serial_nb):
+    """
+    establish connection w/ the CCD w/ the given serial number
+    """
+    global device_serial
+    if serial_nb not in list_devices():
+        raise ValueError("no CCD w/ serial number " + serial_nb)
+    device_serial = serial_nb
+
+
+@traced("ccd.get_data")
+def get_data(out=None):
+    """
+    get raw data from the CCD, a uint16 array clipped to full scale like the real readout
+    out : optional preallocated uint16 array of CCD_NB_PXL to write the frame into
+    """
+    template = spectrum_io.load_template(filename, CCD_NB_PXL)[1]     # parsed once, cached
 
-    y = np.flip((np.array(y)*(integration_time_us))[0:-15])
-    y = interpolate.interp1d(np.linspace(0, CCD_NB_PXL-1, y.size), y)(np.linspace(0, CCD_NB_PXL-1, CCD_NB_PXL))
-    y = y + np.random.randint(0,500, y.size)
-    y = np.maximum( y, 2*16-1).astype(int)
+    if out is None:
+        out = np.empty(CCD_NB_PXL, dtype=np.uint16)
+    y = template*integration_time_us + np.random.randint(0,500, CCD_NB_PXL)
+    np.clip(y, 0, 2**16-1, out=out, casting="unsafe")   # a real uint16 readout can't go beyond full scale
 
-    time.sleep((integration_time_us+100)*1e-6)  # simulate integration vor verisimilitude
-    return y
+    with span("ccd.wait", integration_time_us=integration_time_us):
+        clock.sleep((integration_time_us+100)*1e-6)  # simulate integration vor verisimilitude
+    return out
+
+
+def get_fps():
+    """
+    get the frame rate the CCD would run at
+    """
+    return int(1e6/(integration_time_us+100))
+
+
+def get_frames(n, out=None):
+    """
+    get n raw frames from the CCD
+    out : optional preallocated (n, CCD_NB_PXL) uint16 block, filled in place
+    """
+    if out is None:
+        out = np.empty((n, CCD_NB_PXL), dtype=np.uint16)
+    for i in range(n):
+        get_data(out=out[i])
+    return out
+
+
+def read_frame(buffer):
+    """
+    read the next frame straight into buffer
+    """
+    get_data(out=buffer)
+    return True
+
+
+def start_stream(nb_frames=STREAM_BUFFER_FRAMES):
+    """
+    start filling a ring buffer of nb_frames frames in the background
+    """
+    global stream_ring, stream_reader
+    if stream_reader is not None : stop_stream()
+    stream_ring   = FrameRing(nb_frames, CCD_NB_PXL, np.uint16)
+    stream_reader = FrameReader(stream_ring, read_frame)
+    stream_reader.start()
+
+
+def stop_stream():
+    """
+    stop the background acquisition
+    """
+    global stream_reader
+    if stream_reader is None : return
+    stream_reader.stop()
+    stream_reader = None
+
+
+def stream(n_frames=None):
+    """
+    iterate over the frames as the CCD produces them (starts streaming if needed)
+    yields frame, timestamp [s], nb of frames dropped since the previous one
+    """
+    own = stream_reader is None
+    if own : start_stream()
+    try:
+        yield from stream_ring.stream(n_frames, timeout=1+2e-6*integration_time_us)
+    finally:
+        if own : stop_stream()
+
+
+def latest_frame():
+    """
+    get the most recent streamed frame without waiting
+    returns frame, timestamp [s], frame number (or None)
+    """
+    if stream_ring is None : return None
+    return stream_ring.latest()
 
 
 def set_integration_time(inttime_us):
@@ -72,7 +145,7 @@ def shutdown():
     """
     shut down CCD
     """
-    pass
+    stop_stream()
 
 
 def change_file(newfile):
@@ -82,19 +155,22 @@ def change_file(newfile):
 ### DEMO
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
+    from auto_exposure import auto_exposure, predict_integration_time
+    from signal_treatment import detect_saturation, detect_lowsignal
 
     init(0)
     print("Device 0 initialized. Starting main loop")
 
     ax = plt.plot(np.zeros((1,CCD_NB_PXL)))
 
+    inttime, data, nb_frames = auto_exposure(get_data, set_integration_time, integration_time_us, 4, 1e6)
+    print("exposure set to {:.0f} us in {} frames".format(inttime, nb_frames))
+
     for i in range(30) :
         data = get_data()
 
-        if (np.max(data) > 55000) and integration_time_us > 4:
-            set_integration_time(integration_time_us*.75)
-        elif (np.max(data) < 15000)  and integration_time_us < 1e6:
-            set_integration_time(integration_time_us/.75)
+        if detect_saturation(data) or detect_lowsignal(data):
+            set_integration_time(np.clip(predict_integration_time(data, integration_time_us), 4, 1e6))
 
         plt.cla()
         plt.plot(data)
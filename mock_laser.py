@@ -1,7 +1,15 @@
 import re
+import math
+import collections
 import serial               # pyserial to communicate w/ laser
 from serial.tools import list_ports
 
+import clock
+from instrumentation import traced
+import laser
+from laser import LaserSession, LaserCommandException, MAX_POWER
+from laser import SETTLE_TOL, SETTLE_HOLD, SETTLE_RATE, SETTLE_TIMEOUT
+
 #exceptions
 class FailureToOpenPortException(Exception):
     def __str__(self):
@@ -15,6 +23,10 @@ faults = {
     4 : "constant power timeout"
 }
 
+# serial link
+LINK_LATENCY    = 1e-3      # [s]   round trip over the USB-serial link, per write
+LINK_TIMEOUT    = 1         # [s]   readline timeout
+
 
 # mock functions & variables
 
@@ -23,6 +35,10 @@ l_ilk   = 1
 l_fault = 0
 l_power_set = 0.12
 l_power_out = 0.
+l_settle_tau = .05      # [s] time constant w/ which the output power follows the setpoint
+l_power_from = 0.       # output power when the setpoint last changed
+l_set_time   = 0.       # when the setpoint last changed
+session      = None     # LaserSession on a MockSerial
 
 cmd_resp = {
     "@cob1"     : "OK",
@@ -38,7 +54,7 @@ cmd_resp = {
 }
 
 def init(laser_id):
-    global l_ilk, cmd_resp
+    global l_ilk, l_status, l_power_out, cmd_resp, session
     l_ilk = 0
     l_status = 1
     l_power_out = l_power_set
@@ -47,10 +63,46 @@ def init(laser_id):
     cmd_resp["l?"]  = str(l_status)
     cmd_resp["pa?"] = str(l_power_out)
 
+    session = LaserSession(MockSerial())
+
+def get_session():
+    """
+    the LaserSession on the mock serial port, opened on first use (the mock works w/o init)
+    """
+    global session
+    if session is None:
+        session = LaserSession(MockSerial())
+    return session
+
+
+@clock.on_change
+def change_clock(old, new):
+    """
+    carry the settling of the output power over to a new clock, and forget the cached state
+    and the link latency measured on the old one
+    """
+    global l_set_time
+    l_set_time += new.now() - old.now()
+    if session is not None:
+        session.invalidate()
+        session.port.ready = 0.
+
+
+def output_power():
+    """
+    output power [W], approaching the setpoint exponentially after every change
+    """
+    if not l_status:
+        return 0.
+    return l_power_set + (l_power_from - l_power_set)*math.exp(-(clock.now() - l_set_time)/l_settle_tau)
+
+@traced("laser.cmd")
 def cmd(command):
-    global l_power_set, l_status, cmd_resp
+    global l_power_set, l_power_out, l_power_from, l_set_time, l_status, cmd_resp
 
     if "p " in command:
+        l_power_from = output_power()
+        l_set_time   = clock.now()
         l_power_set = float(re.findall(r"\d+\.\d+", command)[0])
         cmd_resp["p?"] = "{:.4f}".format(l_power_set)
         command = "p"
@@ -59,16 +111,95 @@ def cmd(command):
         l_power_out = 0.
         cmd_resp["l?"]  = str(l_status)
         cmd_resp["pa?"] = str(l_power_out)
+    elif command == "pa?" and l_status:
+        cmd_resp["pa?"] = "{:.4f}".format(output_power())
 
     return cmd_resp[command]
 
+def reply(command):
+    """
+    what the laser answers to a command (incl. the ones it does not know)
+    """
+    try:
+        return cmd(command)
+    except (KeyError, IndexError):
+        return "Syntax error: illegal command"
+
 def shutdown():
     cmd("l0")
+    if session is not None:
+        session.invalidate()
+
+
+# simulate the serial port
+class MockSerial:
+    """
+    stand-in for the laser's serial port (pyserial interface), answering w/ the mock laser.
+    the replies to a write can only be read latency [s] after it, like over the real link
+    """
+    def __init__(self, latency=LINK_LATENCY, timeout=LINK_TIMEOUT):
+        self.latency = latency
+        self.timeout = timeout
+        self.is_open = True
+        self.replies = collections.deque()
+        self.ready   = 0.       # when the replies to the last write arrive
+        self.nb_writes = 0
+
+    def write(self, data):
+        for command in data.decode("ascii").splitlines():
+            if command.strip():
+                self.replies.append((reply(command.strip()) + "\r\n").encode("ascii"))
+        self.ready = clock.perf_counter() + self.latency
+        self.nb_writes += 1
+        return len(data)
+
+    def readline(self):
+        if not self.replies:
+            clock.sleep(self.timeout)
+            return b""
+        wait = self.ready - clock.perf_counter()
+        if wait > 0:
+            clock.sleep(wait)
+        return self.replies.popleft()
+
+    def reset_input_buffer(self):
+        self.replies.clear()
+
+    def close(self):
+        self.is_open = False
+
+
+def serve_pty():
+    """
+    serve the mock laser on a pseudo-terminal (POSIX only), so that it can be opened
+    just like the real one:   laser.LaserSession(serial.Serial(serve_pty(), timeout=1))
+    returns the name of the device
+    """
+    import os
+    import pty
+    import tty
+    import threading
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)                       # no echo, no line editing
+    def serve():
+        pending = b""
+        while True:
+            try:
+                pending += os.read(master, 1024)
+            except OSError:
+                return
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                os.write(master, (reply(line.decode("ascii").strip()) + "\r\n").encode("ascii"))
+    threading.Thread(target=serve, daemon=True).start()
+    serve_pty.fds = (master, slave)         # keep the pty open
+    return os.ttyname(slave)
 
 
 # simulate key box
 def turn_key():
-    global l_ilk, cmd_resp
+    global l_ilk, l_status, l_power_out, cmd_resp
     l_ilk ^= 1
     cmd_resp["ilk?"] = str(l_ilk)
 
@@ -88,15 +219,12 @@ def turn_key():
 def set_power(power_W):
     """
     set the power setpoint for the laser to track in [W]
+    (constant power mode & setpoint are only sent if they changed)
     """
-    if power_W > 0.120 : power_W = 0.120
-    elif power_W < 0.  : power_W = 0.
-    if not ("OK" in cmd("cp")):
-        print(answer)
-        shutdown()
-        exit()
-    if not ("OK" in cmd("p {:.4f}".format(float(power_W)))):
-        print(answer)
+    try:
+        get_session().set_power(power_W)
+    except LaserCommandException as e:
+        print("ERROR: " + str(e))
         shutdown()
         exit()
 
@@ -105,21 +233,33 @@ def get_power():
     """
     get the current output power in [W]
     """
-    return float(cmd("pa?"))
+    return get_session().get_power()
+
+
+def wait_settled(power_W, tol=SETTLE_TOL, hold=SETTLE_HOLD, rate=SETTLE_RATE, timeout=SETTLE_TIMEOUT):
+    """
+    wait for the output power to settle on power_W [W], see laser.wait_settled
+    returns (settled, time waited [s])
+    """
+    return laser.wait_settled(power_W, tol, hold, rate, timeout, get_power=get_power)
 
 
 def start(power_W=0.120):
     """
     start the laser
     """
-    cmd("@cob1")    # force restart
+    try:
+        fault, ilk = get_session().start()    # force restart, get fault & remote interlock state
+    except LaserCommandException as e:
+        print("ERROR: " + str(e))
+        shutdown()
+        exit()
 
-    fault = int(cmd("f?"))
     if fault:
         print("ERROR: Laser fault {} : {}".format(fault, faults[fault]))
         exit()
 
-    if int(cmd("ilk?")): # get remote interlock state
+    if ilk:
         print("ERROR: interlock not closed")
         return
 
@@ -135,7 +275,6 @@ def stop():
 # DEMO
 if __name__ == "__main__":
     import os
-    import time
 
     print("Starting laser")
     init(0)
@@ -158,7 +297,7 @@ if __name__ == "__main__":
             print(fault)
             break;
 
-        time.sleep(.1)
+        clock.sleep(.1)
         os.system('cls' if os.name=='nt' else 'clear')
 
     print("shutting down")
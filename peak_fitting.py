@@ -0,0 +1,268 @@
+# Joint fit of all the peaks of a spectrum, for a whole batch of spectra at once, w/ Lorentzian
+# or pseudo-Voigt profiles. the residuals are evaluated on windows around the peaks, the same
+# ones in every spectrum of the batch, so the residuals, the (analytic) Jacobians and the
+# Levenberg-Marquardt steps of all the spectra are computed together. overlapping peaks are
+# fitted together, the clusters of peaks that don't overlap are fitted one after the other.
+#   res = fit_peaks(data_clean)                  # peaks detected on the spectrum
+#   res["position"], res["width"], res["area"], res["sigma_area"], ...
+#   res = fit_peaks(next_spectrum, init=res)     # time series: warm start from the last fit
+#   series = fit_series(stack)                   # the same, spectrum after spectrum
+
+import warnings
+import numpy as np
+import scipy.signal as signal
+
+from signal_treatment import refine_peaks, MAD_TO_STD
+from instrumentation import span, traced
+
+
+# constant declarations
+FIT_WINDOW    = 15      # [px] half-width of the window fitted around each peak
+FIT_REACH     = 2       # peaks closer than this many windows contribute to each other's windows
+FIT_MIN_WIDTH = .5      # [px] bounds of the fitted widths (FWHM)
+FIT_MAX_WIDTH = 100.    # [px]
+FIT_MAX_ITER  = 50      # max nb of Levenberg-Marquardt iterations
+FIT_TOL       = 1e-6    # relative decrease of the cost under which a fit has converged
+FIT_WIDTH     = 5.      # [px] initial width of the peaks whose width can't be measured, and expected linewidth
+FIT_PROMINENCE = 8      # a peak stands out of its surroundings by this many times the noise (std)
+PROFILES      = ("lorentzian", "voigt")
+RESULTS       = ("position", "width", "height", "area", "eta", "offset", "sigma_position", "sigma_width",
+                 "sigma_height", "sigma_area", "sigma_eta", "sigma_offset")    # per peak, see fit_peaks (+ cost)
+
+LN2 = np.log(2)
+
+
+def profile(u, eta):
+    """
+    pseudo-Voigt profile of unit height at u = (x - position)/width (FWHM), and its derivative
+    eta = 1 : Lorentzian, eta = 0 : Gaussian
+    returns value, d/du, L(u) - G(u) (the derivative w/ respect to eta)
+    """
+    lor = 1/(1 + 4*u*u)
+    gau = np.exp(-4*LN2*u*u)
+    value = eta*lor + (1-eta)*gau
+    du = -8*u*(eta*lor*lor + (1-eta)*LN2*gau)
+    return value, du, lor - gau
+
+
+def area_factor(eta):
+    """
+    area of a pseudo-Voigt profile of unit height and width
+    """
+    return eta*np.pi/2 + (1-eta)*np.sqrt(np.pi/LN2)/2
+
+
+def detect_peaks(x, thresh=.5, linewidth=FIT_WIDTH):
+    """
+    sub-pixel positions and FWHM [px] of the peaks of a spectrum, above the height threshold of
+    find_correction. maxima closer than half the expected linewidth [px] are taken for the same
+    band (bands that close don't make two maxima), and a peak must stand FIT_PROMINENCE times
+    the noise out of its surroundings: close and overlapping bands are kept, noise is not
+    """
+    noise = MAD_TO_STD/np.sqrt(2) * np.median(np.abs(np.diff(x)))         # from the steps between pixels
+    peaks = signal.find_peaks(x, height=np.mean(x)+thresh*np.std(x), prominence=FIT_PROMINENCE*noise,
+                              distance=max(1, linewidth/2))[0]
+    widths = signal.peak_widths(x, peaks, rel_height=.5)[0]
+    return refine_peaks(x, peaks), widths
+
+
+def clusters(centers, window=FIT_WINDOW):
+    """
+    split the peaks into groups that share no pixel: a pixel sees the peaks within FIT_REACH
+    windows, so peaks more than FIT_REACH+1 windows apart don't interact
+    returns a list of arrays of peak indices (none w/o any peak)
+    """
+    if np.size(centers) == 0:
+        return []
+    order = np.argsort(centers)
+    gaps = np.flatnonzero(np.diff(centers[order]) > (FIT_REACH + 1)*window) + 1
+    return np.split(order, gaps)
+
+
+class _Windows:
+    """
+    the pixels the residuals are evaluated on: the union of the windows around the peaks, each
+    w/ the peaks within reach (pairs), plus a constant offset (the one of the closest peak)
+    parameters of a spectrum: heights, positions, widths, (etas), offsets (P each)
+    """
+    def __init__(self, centers, L, voigt, window):
+        self.P      = centers.size
+        self.voigt  = voigt
+        self.blocks = 4 if voigt else 3                         # profile parameters per peak
+        self.nb_params = (self.blocks + 1)*self.P
+        pixels = (np.round(centers)[:, None] + np.arange(-window, window+1)).ravel()
+        self.pixels  = np.unique(pixels[(pixels >= 0) & (pixels < L)]).astype(int)
+        self.S       = self.pixels.size
+        self.nearest = np.argmin(np.abs(self.pixels[:, None] - centers), axis=1)
+        self.pair_s, self.pair_p = np.nonzero(np.abs(self.pixels[:, None] - centers) <= FIT_REACH*window)
+        self.pair_x  = self.pixels[self.pair_s].astype(float)
+        self.columns = np.arange(self.blocks)[:, None]*self.P + self.pair_p     # Jacobian column of each pair
+
+    def evaluate(self, theta, jacobian=False):
+        """
+        model on the pixels for the (m, nb_params) parameters, and its (m, S, nb_params) Jacobian
+        """
+        m = len(theta)
+        t = theta.reshape(m, -1, self.P)
+        h, c, w = t[:, 0, self.pair_p], t[:, 1, self.pair_p], t[:, 2, self.pair_p]
+        eta = t[:, 3, self.pair_p] if self.voigt else 1.
+        u = (self.pair_x - c) / w
+        value, du, deta = profile(u, eta)
+        pixel = np.arange(m)[:, None]*self.S + self.pair_s       # sum the pairs of each pixel
+        model = np.bincount(pixel.ravel(), (h*value).ravel(), m*self.S).reshape(m, self.S) + t[:, -1, self.nearest]
+        if not jacobian:
+            return model
+        J = np.zeros((m, self.S, self.nb_params))
+        d = [value, -h*du/w, -h*du*u/w] + ([h*deta] if self.voigt else [])     # d/dh, d/dc, d/dw, d/deta
+        for i, di in enumerate(d):
+            J[:, self.pair_s, self.columns[i]] = di
+        J[:, np.arange(self.S), self.blocks*self.P + self.nearest] = 1.
+        return model, J
+
+
+def _levenberg_marquardt(windows, data, theta, lower, upper):
+    """
+    fit the (m, nb_params) parameters of m spectra at once (projected on the bounds)
+    returns the parameters, the residuals and the Jacobian at the solution
+    """
+    m = len(theta)
+    lam = np.full(m, 1e-3)
+    active = np.ones(m, dtype=bool)
+    model, J = windows.evaluate(theta, jacobian=True)
+    r = model - data
+    cost = .5*np.sum(r*r, axis=1)
+    for it in range(FIT_MAX_ITER):
+        a = np.flatnonzero(active)
+        if a.size == 0:
+            break
+        JT  = J[a].transpose(0, 2, 1)
+        JTJ = JT @ J[a]
+        g   = (JT @ r[a][..., None])[..., 0]
+        diag = np.diagonal(JTJ, axis1=1, axis2=2)
+        A = JTJ + (lam[a, None]*np.maximum(diag, 1e-12))[..., None]*np.eye(windows.nb_params)
+        step = np.linalg.solve(A, -g[..., None])[..., 0]
+        trial = np.clip(theta[a] + step, lower[a], upper[a])
+        step  = trial - theta[a]                                # what is left of it on the bounds
+        r_trial = windows.evaluate(trial) - data[a]
+        cost_trial = .5*np.sum(r_trial*r_trial, axis=1)
+
+        better = cost_trial < cost[a]
+        ok = a[better]
+        predicted = -np.sum(step*g, axis=1) - .5*np.einsum("bi,bij,bj->b", step, JTJ, step)
+        converged = np.zeros(m, dtype=bool)
+        converged[a] = predicted <= FIT_TOL*cost[a]          # at the minimum: nothing left to gain
+        converged[ok] |= cost[ok] - cost_trial[better] <= FIT_TOL*cost[ok]
+        theta[ok], cost[ok] = trial[better], cost_trial[better]
+        lam[ok] /= 10
+        lam[a[~better]] *= 10
+        if ok.size:
+            model, J[ok] = windows.evaluate(theta[ok], jacobian=True)
+            r[ok] = model - data[ok]
+        active &= ~converged
+    return theta, r, J
+
+
+@traced("peak_fitting.fit_peaks")
+def fit_peaks(x, positions=None, widths=None, profile="lorentzian", init=None, window=FIT_WINDOW, thresh=.5, linewidth=FIT_WIDTH):
+    """
+    fit all the peaks of a spectrum (or of each spectrum of a (B, L) stack) jointly
+    positions : initial sub-pixel positions of the peaks (P,) or (B, P) (by default the peaks
+                detected on the spectrum, or on the mean spectrum of the stack)
+    widths    : initial FWHM [px] (by default measured on the spectrum)
+    profile   : "lorentzian", or "voigt" (pseudo-Voigt, w/ the Lorentzian fraction eta fitted)
+    init      : the result of a previous fit to start from (e.g. the last spectrum of a time
+                series): positions, widths, heights (and etas) are taken from it
+    linewidth : expected FWHM [px] of the bands, when detecting them (see detect_peaks)
+    returns a dict of (P,) arrays for a spectrum, (B, P) for a stack:
+        position, width [px], height, area, eta, offset, their sigma_* (standard errors)
+        and cost (per spectrum). P is 0 if no peak is found (e.g. a dark or blank spectrum)
+    """
+    if profile not in PROFILES:
+        raise ValueError("profile should be one of {}".format(PROFILES))
+    voigt  = profile == "voigt"
+    single = np.ndim(x) == 1
+    x = np.array(x, dtype=float, ndmin=2)
+    B, L = x.shape
+    mean = x.mean(axis=0)
+
+    heights, etas = None, None
+    if init is not None:
+        positions, widths, heights = init["position"], init["width"], init["height"]
+        etas = init["eta"] if voigt else None
+    elif positions is None:
+        positions, measured = detect_peaks(mean, thresh, linewidth)
+        widths = measured if widths is None else widths
+    positions = np.broadcast_to(np.asarray(positions, dtype=float), (B, np.shape(positions)[-1]))
+    centers = np.median(positions, axis=0)
+    P = centers.size
+    if widths is None:
+        peaks = np.clip(np.round(centers).astype(int), 0, L-1)
+        with warnings.catch_warnings():                         # not a local max: width 0, see below
+            warnings.simplefilter("ignore", RuntimeWarning)
+            widths = signal.peak_widths(mean, peaks, rel_height=.5)[0]
+    widths = np.where(np.asarray(widths) > 0, widths, FIT_WIDTH)
+    widths = np.clip(np.broadcast_to(np.asarray(widths, dtype=float), (B, P)), FIT_MIN_WIDTH, FIT_MAX_WIDTH)
+    if heights is None:
+        heights = np.take_along_axis(x, np.clip(np.round(positions).astype(int), 0, L-1), axis=1)
+    heights = np.maximum(np.broadcast_to(np.asarray(heights, dtype=float), (B, P)), 0)
+    etas = np.broadcast_to(.5 if etas is None else np.asarray(etas, dtype=float), (B, P))
+
+    full  = lambda value: np.full((B, P), value)
+    stack = lambda params: np.stack(params, axis=1)          # (B, parameters per peak, P)
+    lower = stack([full(0.), positions - window, full(FIT_MIN_WIDTH)] + ([full(0.)] if voigt else []) + [full(-np.inf)])
+    upper = stack([full(np.inf), positions + window, full(FIT_MAX_WIDTH)] + ([full(1.)] if voigt else []) + [full(np.inf)])
+    params = np.clip(stack([heights, positions, widths] + ([etas] if voigt else []) + [full(0.)]), lower, upper)
+    sigma  = np.zeros(params.shape)
+    sigma_area = np.zeros((B, P))
+    cost   = np.zeros(B)
+
+    # the clusters share no pixel: fitting them one by one is the same as fitting all at once
+    with span("peak_fitting.levenberg_marquardt", nb_spectra=B, nb_peaks=P):
+        for cluster in clusters(centers, window):
+            windows = _Windows(centers[cluster], L, voigt, window)
+            n, Pc = windows.nb_params, cluster.size
+            theta, r, J = _levenberg_marquardt(windows, x[:, windows.pixels], params[:, :, cluster].reshape(B, n),
+                                               lower[:, :, cluster].reshape(B, n), upper[:, :, cluster].reshape(B, n))
+            t = params[:, :, cluster] = theta.reshape(B, -1, Pc)
+
+            # standard errors: (J'J)^-1 * residual variance
+            c_cost = .5*np.sum(r*r, axis=1)
+            cost += c_cost
+            cov = np.linalg.pinv(J.transpose(0, 2, 1) @ J, hermitian=True) * (2*c_cost / max(windows.S - n, 1))[:, None, None]
+            sigma[:, :, cluster] = np.sqrt(np.maximum(np.diagonal(cov, axis1=1, axis2=2), 0)).reshape(B, -1, Pc)
+
+            # area = h*w*area_factor(eta), its variance from the covariance of (h, w, eta) of each peak
+            h, w = t[:, 0], t[:, 2]
+            eta = t[:, 3] if voigt else 1.
+            idx  = [0, 2] + ([3] if voigt else [])
+            grad = np.stack([w*area_factor(eta), h*area_factor(eta)] + ([h*w*(np.pi/2 - np.sqrt(np.pi/LN2)/2)] if voigt else []), axis=1)
+            cov_peak = np.diagonal(cov.reshape(B, -1, Pc, n // Pc, Pc)[:, idx][..., idx, :], axis1=2, axis2=4)
+            sigma_area[:, cluster] = np.sqrt(np.maximum(np.einsum("bip,bijp,bjp->bp", grad, cov_peak, grad), 0))
+
+    h, c, w, off = params[:, 0], params[:, 1], params[:, 2], params[:, -1]
+    eta = params[:, 3] if voigt else np.ones((B, P))
+    k = area_factor(eta)
+    res = dict(position=c, width=w, height=h, area=h*w*k, eta=eta, offset=off,
+               sigma_position=sigma[:, 1], sigma_width=sigma[:, 2], sigma_height=sigma[:, 0],
+               sigma_area=sigma_area, sigma_eta=sigma[:, 3] if voigt else np.zeros((B, P)),
+               sigma_offset=sigma[:, -1], cost=cost)
+    if single:
+        res = {key: value[0] for key, value in res.items()}
+    return res
+
+
+def fit_series(x, positions=None, widths=None, profile="lorentzian", window=FIT_WINDOW, thresh=.5, linewidth=FIT_WIDTH):
+    """
+    fit a time series of spectra (N, L) one after the other, each fit starting from the last
+    (the peaks are detected on the first one if positions is None)
+    returns the results of fit_peaks, stacked: (N, P) arrays (N = 0 for an empty series)
+    """
+    results = []
+    init = None
+    for spectrum in x:
+        init = fit_peaks(spectrum, positions, widths, profile, init, window, thresh, linewidth)
+        results.append(init)
+    if not results:
+        P = 0 if positions is None else np.shape(positions)[-1]
+        return dict({key: np.zeros((0, P)) for key in RESULTS}, cost=np.zeros(0))
+    return {key: np.stack([r[key] for r in results]) for key in results[0]}
@@ -1,109 +1,555 @@
+import math
+import time
+import functools
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 import numpy                as np
 from scipy import sparse
+import scipy.linalg         as linalg
 import scipy.signal         as signal
 import scipy.ndimage        as filter
+import scipy.optimize       as optimize
+
+import instrumentation
+from instrumentation import traced
 
 CCD_SATURATION_VAL = 2**16-1
 epsil = -10000
 
-def detect_saturation(x):
+ASLS_TOL      = 0       # fraction of weights allowed to still flip when AsLS is considered converged
+ASLS_MAX_ITER = 20      # upper bound on AsLS iterations
+
+SPIKE_THRESH  = 8       # robust z-score above which a pixel is taken for a cosmic ray
+SPIKE_WIDTH   = 5       # [px] neighbourhood for single-frame spike detection
+SPIKE_MAX_PX  = 2       # [px] widest excursion taken for a cosmic ray in a single frame (bands are wider)
+SPIKE_EDGE    = 3       # robust z-score above which a pixel counts as part of an excursion
+SPIKE_REL     = .25     # ... and fraction of the excess of the spike (bands: over .6 next to the apex)
+MAD_TO_STD    = 1.4826  # median absolute deviation -> standard deviation, for gaussian noise
+
+CAL_MAX_ERROR   = 10.   # [cm^-1] max residual of a detected peak assigned to a model peak
+CAL_RANSAC_ITER = 200   # max nb of minimal subsets of peaks tried when fitting the correction
+
+
+#exceptions
+class CalibrationError(Exception):
+    def __init__(self, nb_pairs, deg):
+        self.nb_pairs = nb_pairs
+        self.deg      = deg
+    def __str__(self):
+        return "{} detected peak(s) agree w/ the model, a degree {} correction needs {}".format(
+               self.nb_pairs, self.deg, self.deg+1)
+
+
+@traced("signal_treatment.detect_saturation")
+def detect_saturation(x, axis=-1):
     """
     detect if the CCD is saturated
+    for a stack of spectra, one flag is returned per spectrum (along axis)
     """
-    if np.max(x) >= (CCD_SATURATION_VAL + epsil):
-        return True
-    else:
-        return False
+    saturated = np.max(x, axis=axis) >= (CCD_SATURATION_VAL + epsil)
+    return bool(saturated) if np.ndim(saturated) == 0 else saturated
 
-def detect_lowsignal(x):
+@traced("signal_treatment.detect_lowsignal")
+def detect_lowsignal(x, axis=-1):
     """
     detect if the CCD singal is low
+    for a stack of spectra, one flag is returned per spectrum (along axis)
     """
-    if np.max(x) <= (CCD_SATURATION_VAL/3):
-        return True
-    else:
-        return False
+    low = np.max(x, axis=axis) <= (CCD_SATURATION_VAL/3)
+    return bool(low) if np.ndim(low) == 0 else low
 
-def normalize(x, ord=np.inf):
-    """ normalize the spectrum
+@traced("signal_treatment.normalize")
+def normalize(x, ord=np.inf, axis=-1):
+    """ normalize the spectrum (or each spectrum of a stack, along axis)
         - ord = 1   : normalize the area under the spectrum
         - ord = 2   : normalize the energy of the spectrum
         - ord = inf (default) : normalize the peak of the spectrum
     """
-    y = x/np.linalg.norm(x, ord)
+    y = x/np.linalg.norm(x, ord, axis=axis, keepdims=True)
     return y
 
 
-def smooth(x, size, type="median"):
-    """ smooth the spectrum to remove noise
+@traced("signal_treatment.smooth")
+def smooth(x, size, type="median", axis=-1):
+    """ smooth the spectrum (or each spectrum of a stack, along axis) to remove noise
         - type = "median" (default)
         - type = "gaussian"   : gaussian filter
         - type = "avg"        : moving avverage
     """
     if type=="median":
-        y = signal.medfilt(x, size)
+        kernel = [1]*np.ndim(x)
+        kernel[axis] = size
+        y = signal.medfilt(x, kernel)
     elif type=="gaussian":
-        y = filter.gaussian_filter1d(x, size)
+        y = filter.gaussian_filter1d(x, size, axis=axis)
     elif type=="avg":
-        y = filter.uniform_filter1d(x, size)
+        y = filter.uniform_filter1d(x, size, axis=axis)
     else:
         error("no such smoothing filter currently implemented")
     return y
 
 
-def remove_baseline(x, pow, type="AsLS"):
-    """ remove the baseline of a spectrum
-        - type = "AsLS" (default) : "Asymmetric Least Squares Smoothing" by Eilers & Boelens (2005) (pow = [lambda, p])
+@traced("signal_treatment.remove_baseline")
+def remove_baseline(x, pow, type="AsLS", axis=-1, workers=None):
+    """ remove the baseline of a spectrum (or each spectrum of a stack, along axis)
+        - type = "AsLS" (default) : "Asymmetric Least Squares Smoothing" by Eilers & Boelens (2005) (pow = [lambda, p] or [lambda, p, tol])
         - type = "polysub"  : subtract minimum polynomial background (pow = degree of polynomial)
         - type = "bandpass" : apply bandpass filter of 2 gaussians (power = [sigma1 sigma2])
+        workers : for AsLS on a stack, spread the spectra over a pool of this many processes
+        every spectrum of a stack gets exactly the same result as if it were processed on its own
     """
     if type=="AsLS":
-        # Eilers, P. and Boelens, H., Baseline Correction with Asymmetric Least Squares Smoothing, 2005
-        # https://stackoverflow.com/questions/29156532/python-baseline-correction-library
-        L = len(x)
-        D = sparse.diags([1,-2,1],[0,-1,-2], shape=(L,L-2))
-        w = np.ones(L)
-        for i in range(20): # arbitrary iteration value. should iterate until stabilisation, but at 10 iterations it's close enough
-            W = sparse.spdiags(w, 0, L, L)
-            Z = W + pow[0] * D.dot(D.transpose())
-            z = sparse.linalg.spsolve(Z, w*x)
-            w = pow[1] * (x > z) + (1-pow[1]) * (x < z)
+        tol = pow[2] if len(pow) > 2 else ASLS_TOL
+        z, n_iter = asls_stack(x, pow[0], pow[1], tol, axis=axis, workers=workers)
         y = x - z
     elif type=="polysub":
-        idx = np.concatenate((np.array([0, x.size-1]), signal.find_peaks(-x)[0]))
-        p = np.polyfit(x, -x[idx], np.minimum(pow, x.size-1))
-        y = x + np.polyval(p, np.linspace(0, x.size-1, x.size))
+        y = np.apply_along_axis(_polysub, axis, x, pow)
     elif type=="bandpass":
-        y = filter.gaussian_filter1d(x, np.min(pow)) - filter.gaussian_filter1d(x, np.max(pow))
+        y = filter.gaussian_filter1d(x, np.min(pow), axis=axis) - filter.gaussian_filter1d(x, np.max(pow), axis=axis)
     else:
         error("no such baseline removal filter currently implemented")
     return y
 
 
-def find_correction(x, model, initial_guess, thresh=.5, deg=2):
+def _polysub(x, pow):
+    idx = np.concatenate((np.array([0, x.size-1]), signal.find_peaks(-x)[0]))    # the minima
+    p = np.polyfit(idx, -x[idx], np.minimum(pow, idx.size-1))
+    return x + np.polyval(p, np.arange(x.size))
+
+
+@functools.lru_cache(maxsize=8)
+def asls_penalty(L, lam):
+    """ lam * D'D, the second-difference penalty of AsLS, in the upper banded
+        storage expected by scipy.linalg.solveh_banded (shape (3, L)).
+        cached per (L, lam), so it is only built once per spectrum length
+    """
+    ab = np.zeros((3, L))
+    if L < 3:
+        return ab
+    D  = sparse.diags([1.,-2.,1.],[0,-1,-2], shape=(L,L-2))
+    DD = D.dot(D.transpose())
+    ab[0, 2:] = DD.diagonal(2)              # 2nd super-diagonal
+    ab[1, 1:] = DD.diagonal(1)              # 1st super-diagonal
+    ab[2, :]  = DD.diagonal(0)              # main diagonal
+    ab *= lam
+    ab.setflags(write=False)                # shared between calls, don't touch
+    return ab
+
+
+def asls_workspace(L):
+    """ scratch buffers for asls() on spectra of length L, so repeated calls don't allocate """
+    return dict(ab=np.empty((3, L)), b=np.empty(L), w=np.empty(L), w_new=np.empty(L),
+                tmp=np.empty(L), gt=np.empty(L, dtype=bool), lt=np.empty(L, dtype=bool))
+
+
+@traced("signal_treatment.asls")
+def asls(x, lam, p, tol=ASLS_TOL, max_iter=ASLS_MAX_ITER, work=None):
+    """ Asymmetric Least Squares baseline estimate
+        Eilers, P. and Boelens, H., Baseline Correction with Asymmetric Least Squares Smoothing, 2005
+        https://stackoverflow.com/questions/29156532/python-baseline-correction-library
+        - lam      : smoothness of the baseline
+        - p        : asymmetry (weight of the points above the baseline)
+        - tol      : stop once at most tol*len(x) weights flip between two iterations
+        - max_iter : hard cap on the number of iterations
+        - work     : scratch buffers from asls_workspace(len(x)); the returned baseline then
+                     lives in them, and is overwritten by the next call with the same workspace
+        returns the baseline z and the number of iterations it took
+    """
+    x  = np.asarray(x, dtype=float)
+    if work is None:
+        work = asls_workspace(x.size)
+    P  = asls_penalty(x.size, float(lam))
+    ab, b, tmp, gt, lt = work["ab"], work["b"], work["tmp"], work["gt"], work["lt"]
+    w, w_new = work["w"], work["w_new"]
+    w[:] = 1.
+    z  = x
+    n_iter = 0
+    while n_iter < max_iter:
+        n_iter += 1
+        np.copyto(ab, P)                    # W + lam*D'D is symmetric pentadiagonal
+        ab[2] += w
+        np.multiply(w, x, out=b)
+        z = linalg.solveh_banded(ab, b, overwrite_ab=True, overwrite_b=True, check_finite=False)
+
+        np.multiply(np.greater(x, z, out=gt), p, out=w_new)       # w = p*(x > z) + (1-p)*(x < z)
+        np.multiply(np.less(x, z, out=lt), 1-p, out=tmp)
+        w_new += tmp
+        changed = np.count_nonzero(np.not_equal(w_new, w, out=gt))
+        w, w_new = w_new, w
+        if changed <= tol * x.size:
+            break
+    return z, n_iter
+
+
+def _asls_rows(rows, lam, p, tol, max_iter):
+    """ AsLS on every row of a 2-D block. module level so process pools can pickle it """
+    z      = np.empty(rows.shape)
+    n_iter = np.empty(rows.shape[0], dtype=int)
+    work   = asls_workspace(rows.shape[1])
+    for i in range(rows.shape[0]):
+        z[i], n_iter[i] = asls(rows[i], lam, p, tol, max_iter, work)
+    return z, n_iter
+
+
+pool         = None     # process pool of asls_stack, started on first use and kept for the next calls
+pool_workers = 0
+
+
+def process_pool(workers):
+    """ the process pool of asls_stack, w/ this many workers """
+    global pool, pool_workers
+    if pool is None or pool_workers != workers:
+        if pool is not None:
+            pool.shutdown()
+        pool, pool_workers = ProcessPoolExecutor(max_workers=workers), workers
+    return pool
+
+
+@traced("signal_treatment.asls_stack")
+def asls_stack(x, lam, p, tol=ASLS_TOL, max_iter=ASLS_MAX_ITER, axis=-1, workers=None):
+    """ AsLS baseline of every spectrum of a stack (spectra along axis)
+        the spectra are solved one after the other, sharing the cached penalty matrix and the
+        scratch buffers: it takes as long as the same spectra one by one (the banded solves,
+        ~.2 ms per spectrum and iteration, are the floor; laying the systems end to end into
+        one solve doesn't beat it). with workers > 1 the stack is split into chunks that
+        are solved in a process pool, kept between calls: only a gain on several cores
+        returns the baselines (same shape as x) and the iterations it took for each spectrum
+    """
+    x = np.asarray(x, dtype=float)
+    if x.ndim == 1:
+        return asls(x, lam, p, tol, max_iter)
+
+    rows = np.moveaxis(x, axis, -1)
+    shape = rows.shape
+    rows = rows.reshape(-1, shape[-1])
+
+    if workers and workers > 1 and rows.shape[0] > 1:
+        chunks = np.array_split(rows, min(workers, rows.shape[0]))
+        args   = [itertools.repeat(a) for a in (lam, p, tol, max_iter)]
+        results = list(process_pool(workers).map(_asls_rows, chunks, *args))
+        z      = np.concatenate([r[0] for r in results])
+        n_iter = np.concatenate([r[1] for r in results])
+    else:
+        z, n_iter = _asls_rows(rows, lam, p, tol, max_iter)
+
+    z = np.moveaxis(z.reshape(shape), -1, axis)
+    return z, n_iter.reshape(shape[:-1])
+
+
+@traced("signal_treatment.reject_spikes")
+def reject_spikes(frames, thresh=SPIKE_THRESH, axis=0):
+    """ remove cosmic ray spikes from a (nb_frames, nb_pxl) block of frames of the same scene (frames along axis)
+        each pixel of each frame gets a robust z-score against the median of that pixel over
+        all frames; pixels above thresh are replaced by that median
+        with fewer than 3 frames there is no usable median, so each frame is despiked on its own
+        returns the cleaned frames and the mask of the replaced pixels
+    """
+    frames = np.asarray(frames, dtype=float)
+    if frames.shape[axis] < 3:
+        return despike(frames, thresh, axis=1 - axis % 2)
+
+    med   = np.median(frames, axis=axis, keepdims=True)
+    dev   = frames - med
+    mad   = MAD_TO_STD * np.median(np.abs(dev), axis=axis, keepdims=True)
+    scale = np.maximum(mad, np.median(mad))           # few frames: don't trust a tiny per-pixel spread
+    scale = np.maximum(scale, np.sqrt(np.maximum(med, 1)))    # nor anything below shot noise
+    mask  = dev > thresh * scale
+    return np.where(mask, med, frames), mask
+
+
+@traced("signal_treatment.despike")
+def despike(x, thresh=SPIKE_THRESH, size=SPIKE_WIDTH, max_px=SPIKE_MAX_PX, axis=-1):
+    """ remove cosmic ray spikes from a single spectrum (or each spectrum of a stack, along axis)
+        a candidate pixel stands out from the median of its neighbourhood (size px) by more than
+        thresh times the local noise level (robust, from the steps between pixels, and never
+        below shot noise). it is a spike if the excursion it belongs to is at most max_px pixels
+        wide, above the line through the medians of the 3 pixels just beyond max_px on either
+        side (pixels count if they are significantly and comparably elevated): real bands, even
+        narrow ones, are elevated over more pixels. spiked pixels are replaced by the
+        neighbourhood median
+        returns the cleaned spectrum and the mask of the replaced pixels
+    """
+    x     = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    L     = x.shape[-1]
+    med   = smooth(x, size, "median")
+    scale = MAD_TO_STD/np.sqrt(2) * _local_median(np.abs(np.diff(x, append=x[..., -1:])), 8*size)
+    scale = np.maximum(scale, np.median(scale, axis=-1, keepdims=True))
+    scale = np.maximum(scale, np.sqrt(np.maximum(med, 1)))      # shot noise (in DN, for a gain >= 1 e-/DN)
+    mask  = np.zeros(x.shape, dtype=bool)
+
+    # the few candidates: baseline and elevated pixels (> SPIKE_EDGE) of the excursion around each
+    *row, c = np.nonzero(x - med > thresh*scale)
+    row   = tuple(r[:, None] for r in row)
+    cols  = c[:, None] + np.arange(-max_px, max_px+1)
+    inside = (cols >= 0) & (cols < L)
+    cols  = np.clip(cols, 0, L-1)
+    ring  = np.arange(max_px+1, max_px+4)
+    left  = np.median(x[row + (np.clip(c[:, None] - ring, 0, L-1),)], axis=-1)
+    right = np.median(x[row + (np.clip(c[:, None] + ring, 0, L-1),)], axis=-1)
+    base  = left[:, None] + (right - left)[:, None] * (np.arange(2*max_px+1) + 2)/(2*max_px+4)
+    excess = x[row + (cols,)] - base
+    up    = inside & (excess > np.maximum(SPIKE_EDGE*scale[row + (cols,)], SPIKE_REL*excess[:, max_px:max_px+1]))
+
+    # a spike: no run of max_px+1 elevated pixels through the candidate
+    wide  = np.zeros(c.shape, dtype=bool)
+    for start in range(max_px+1):
+        wide |= up[:, start:start+max_px+1].all(axis=-1)
+    spike = ~wide
+    mask[tuple(r[spike, 0] for r in row) + (c[spike],)] = True
+    for side in (-1, 1):                                        # the rest of the excursion of a spike
+        run = spike.copy()
+        for d in range(1, max_px):
+            run &= up[:, max_px + side*d]
+            mask[tuple(r[run, 0] for r in row) + (cols[run, max_px + side*d],)] = True
+
+    return np.moveaxis(np.where(mask, med, x), -1, axis), np.moveaxis(mask, -1, axis)
+
+
+def _local_median(x, block, axis=-1):
+    """ median of x over consecutive blocks of pixels along axis, spread back over each block """
+    x  = np.moveaxis(x, axis, -1)
+    L  = x.shape[-1]
+    nb = -(-L // block)
+    padded = np.pad(x, [(0, 0)]*(x.ndim-1) + [(0, nb*block - L)], mode="edge")
+    med = np.median(padded.reshape(x.shape[:-1] + (nb, block)), axis=-1)
+    return np.moveaxis(np.repeat(med, block, axis=-1)[..., :L], -1, axis)
+
+
+def refine_peaks(x, peaks):
+    """ sub-pixel positions of peaks (indices of local maxima of x): vertex of the parabola
+        through each peak and its two neighbours
+    """
+    p = np.clip(peaks, 1, x.size-2)
+    y0, y1, y2 = x[p-1], x[p], x[p+1]
+    curvature = y0 - 2*y1 + y2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        offset = np.where(curvature < 0, .5*(y0 - y2)/curvature, 0.)
+    return p + np.clip(offset, -.5, .5)
+
+
+def ransac_polyfit(px, wn, deg, max_error=CAL_MAX_ERROR, n_iter=CAL_RANSAC_ITER, seed=0):
+    """ polynomial wn(px) robust to wrong pairs: every minimal subset of deg+1 points (or
+        n_iter random ones, if there are more) is fitted exactly, all at once, and the least
+        squares fit of the points within max_error of the subset w/ the most of them is kept
+        a wrong pair can only be told apart w/ at least deg+3 points: w/ deg+1, the fit is
+        exact and nothing is checked; w/ deg+2, a wrong pair shows but not which one it is
+        returns the polynomial, and the mask of the points it was fitted on
+        raises CalibrationError w/ fewer than deg+1 points
+    """
+    n, k = px.size, deg+1
+    if n < k:
+        raise CalibrationError(n, deg)
+    if n == k:
+        return np.polyfit(px, wn, deg), np.ones(n, dtype=bool)
+    if math.comb(n, k) <= n_iter:
+        subsets = np.array(list(itertools.combinations(range(n), k)))
+    else:
+        subsets = np.argsort(np.random.default_rng(seed).random((n_iter, n)), axis=1)[:, :k]
+    V = np.vander(px, k)
+    coefs = np.linalg.solve(V[subsets], wn[subsets][..., None])[..., 0]    # (subsets, k)
+    errors = np.abs(wn - coefs @ V.T)                               # (subsets, n)
+    inliers = errors <= max_error
+    score = inliers.sum(1) - np.where(inliers, errors, 0).sum(1)/(max_error*n)   # ties: smallest error
+    inliers = inliers[np.argmax(score)]
+    return np.polyfit(px[inliers], wn[inliers], deg), inliers        # the subset's own k points at least
+
+
+@traced("signal_treatment.find_correction")
+def find_correction(x, model, initial_guess, thresh=.5, deg=2, max_error=CAL_MAX_ERROR, full_output=False):
     """ find the polynomial geometric distortion on the signal, using prior
         knowledge of the peak locations and heights for this substance.
         model=[peaks_location, peaks_height] for a known substance
         initial_guess : rough à priori estimate of the correction_parameters
         calculate correction_parameters and return for future use
+        - the detected peaks are located to a fraction of a pixel, and assigned to the model
+          peaks all at once (closest under the initial guess, largest first)
+        - the wrong pairs are rejected (RANSAC), then every detected peak is assigned again
+          w/ the fitted correction, and the pairs within max_error [cm^-1] give the final fit
+          (only checked w/ at least deg+3 model peaks, see ransac_polyfit)
+        full_output : also return the residual [cm^-1] of each model peak, and the position [px]
+                      of the detected peak assigned to it (NaN for the peaks left out)
+        raises CalibrationError when fewer than deg+1 peaks are found or agree w/ the model,
+        rather than fitting a polynomial of lower degree
     """
+    model = np.asarray(model, dtype=float)
+
     # find the peaks in the data and sort them by size
-    unsorted_peaks=signal.find_peaks(x, height=np.mean(x)+thresh*np.std(x), distance=20)[0]
-    peaks_px = unsorted_peaks[x[unsorted_peaks].argsort()[::-1]]
-    peak_wn_guess = np.polyval(initial_guess, peaks_px.astype(float))
-
-    # find the closest and largest detected peak to each peak of the model
-    corresponiding_detected_peak_idx = [];
-    size_penalty = np.linspace(0, peak_wn_guess.size-1, peak_wn_guess.size)**2
-    M = np.minimum(peaks_px.size, model.size)
-    for m in range(M):
-        closeness_penalty = np.abs(peak_wn_guess - model[m])
-        optimum = np.argmin(closeness_penalty + size_penalty)
-        peak_wn_guess[optimum] = np.inf                 # make cost = inf, so we don't use the same peak twice
-        corresponiding_detected_peak_idx.append(optimum)
-
-    # calculate the correction correction_parameters
-    N = np.minimum(deg, M-1)
-    correction_parameters = np.polyfit(peaks_px[corresponiding_detected_peak_idx], model[0:M], N);
+    unsorted_peaks = signal.find_peaks(x, height=np.mean(x)+thresh*np.std(x), distance=20)[0]
+    peaks_px = refine_peaks(x, unsorted_peaks[x[unsorted_peaks].argsort()[::-1]])
+    residuals, assigned = np.full(model.size, np.nan), np.full(model.size, np.nan)
+    if min(peaks_px.size, model.size) < deg+1:
+        raise CalibrationError(min(peaks_px.size, model.size), deg)
+
+    # optimal assignment of the detected peaks to the model ones: closest and largest
+    size_penalty = np.arange(peaks_px.size)**2
+    cost = np.abs(np.polyval(initial_guess, peaks_px) - model[:, None]) + size_penalty
+    rows, cols = optimize.linear_sum_assignment(cost)
+    correction_parameters = ransac_polyfit(peaks_px[cols], model[rows], deg, max_error)[0]
 
+    # assign again w/ the correction, keep the pairs that agree w/ it
+    cost = np.abs(np.polyval(correction_parameters, peaks_px) - model[:, None])
+    rows, cols = optimize.linear_sum_assignment(cost)
+    rows, cols = rows[cost[rows, cols] <= max_error], cols[cost[rows, cols] <= max_error]
+    if rows.size < deg+1:
+        raise CalibrationError(rows.size, deg)
+    correction_parameters = np.polyfit(peaks_px[cols], model[rows], deg)
+    residuals[rows] = model[rows] - np.polyval(correction_parameters, peaks_px[cols])
+    assigned[rows]  = peaks_px[cols]
+
+    if full_output:
+        return correction_parameters, residuals, assigned
     return correction_parameters
+
+
+def gaussian_kernel(sigma, truncate=4.0):
+    """ the normalized kernel gaussian_filter1d uses for sigma """
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius+1)
+    phi = np.exp(-0.5 / (sigma*sigma) * x**2)
+    return phi / phi.sum()
+
+
+class Pipeline:
+    """ a chain of processing stages, compiled once for a given spectrum length:
+        filter kernels, AsLS penalty and every scratch buffer are prepared in advance, so
+        running it only fills preallocated buffers (and records how long each stage took)
+        stages are given as (function name, *arguments), with the arguments the function takes, e.g.
+            Pipeline([("smooth", 7, "median"), ("smooth", 5, "gaussian"), ("remove_baseline", [10**5, .05], "AsLS")])
+        any other function of this module can be used too, it just won't run in place
+    """
+    def __init__(self, stages):
+        self.stages  = [tuple(stage) for stage in stages]
+        self.names   = ["{}({})".format(s[0], ", ".join(str(a) for a in s[1:])) for s in self.stages]
+        self.length  = None
+        self.timings = np.zeros(len(self.stages))    # [s] per stage, last run
+        self.iterations = 0                          # AsLS iterations, last run
+
+    def compile(self, length, dtype=float):
+        """ prepare the stages for spectra of the given length (and input dtype) """
+        self.length = length
+        self.dtype  = np.result_type(dtype, float)
+        self.bufs   = [np.empty(length, dtype=self.dtype) for i in range(2)]
+        self.ops    = [self._compile_stage(*stage) for stage in self.stages]
+        return self
+
+    def _compile_stage(self, name, *args):
+        if name == "smooth":
+            size, type = args[0], (args[1] if len(args) > 1 else "median")
+            if type == "median":
+                return lambda src, dst: filter.median_filter(src, size, mode="constant", output=dst)
+            if type == "gaussian":
+                kernel = gaussian_kernel(size)
+                return lambda src, dst: filter.correlate1d(src, kernel, mode="reflect", output=dst)
+            if type == "avg":
+                return lambda src, dst: filter.uniform_filter1d(src, size, output=dst)
+
+        if name == "remove_baseline" and (len(args) < 2 or args[1] == "AsLS"):
+            pow  = args[0]
+            lam, p = float(pow[0]), pow[1]
+            tol  = pow[2] if len(pow) > 2 else ASLS_TOL
+            asls_penalty(self.length, lam)              # factor it now, not on the first spectrum
+            work = asls_workspace(self.length)
+            def op(src, dst):
+                z, self.iterations = asls(src, lam, p, tol, work=work)
+                np.subtract(src, z, out=dst)
+            return op
+
+        if name == "normalize":
+            ord = args[0] if args else np.inf
+            return lambda src, dst: np.divide(src, np.linalg.norm(src, ord), out=dst)
+
+        func = globals()[name]                         # anything else: plain call
+        def op(src, dst):
+            y = func(src, *args)
+            dst[:] = y[0] if isinstance(y, tuple) else y    # (despike also returns its mask)
+        return op
+
+    def __call__(self, x, out=None):
+        """ run all the stages on spectrum x, into out if given """
+        if self.length != np.size(x):
+            self.compile(np.size(x), np.asarray(x).dtype)
+        src, dst = self.bufs
+        src[:] = x
+        for i, op in enumerate(self.ops):
+            t = time.perf_counter()
+            op(src, dst)
+            t_end = time.perf_counter()
+            self.timings[i] = t_end - t
+            if instrumentation.enabled:
+                instrumentation.record("Pipeline." + self.names[i], t, t_end)
+            src, dst = dst, src
+        if out is None:
+            return src.copy()
+        out[:] = src
+        return out
+
+    def report(self):
+        """ timings of the last run, one line per stage """
+        return "\n".join("{:50s} {:8.3f} ms".format(n, 1e3*t) for n, t in zip(self.names, self.timings))
+
+
+# BENCHMARK
+if __name__ == "__main__":
+    import glob
+    import timeit
+    import scipy.sparse.linalg
+
+    def asls_legacy(x, pow):
+        """ the original AsLS: sparse rebuild + spsolve, fixed 20 iterations """
+        L = len(x)
+        D = sparse.diags([1,-2,1],[0,-1,-2], shape=(L,L-2))
+        w = np.ones(L)
+        for i in range(20):
+            W = sparse.spdiags(w, 0, L, L)
+            Z = W + pow[0] * D.dot(D.transpose())
+            z = sparse.linalg.spsolve(Z, w*x)
+            w = pow[1] * (x > z) + (1-pow[1]) * (x < z)
+        return x - z
+
+    N_PX = 3648
+    for filename in sorted(glob.glob("./mock_resources/exc785_*.txt")):
+        y = np.flip(np.loadtxt(filename)[:, 1][0:-15])
+        x = np.interp(np.linspace(0, y.size-1, N_PX), np.arange(y.size), y)
+
+        t_old = min(timeit.repeat(lambda: asls_legacy(x, [10**5, .05]),           number=1, repeat=3))
+        t_new = min(timeit.repeat(lambda: remove_baseline(x, [10**5, .05], "AsLS"), number=1, repeat=3))
+        n_iter = asls(x, 10**5, .05)[1]
+        err = np.max(np.abs(asls_legacy(x, [10**5, .05]) - remove_baseline(x, [10**5, .05], "AsLS")))
+
+        print("{} : legacy {:7.1f} ms, banded {:6.1f} ms ({} iterations), x{:.1f}, max abs diff {:.2e}".format(
+              filename.split("/")[-1], 1e3*t_old, 1e3*t_new, n_iter, t_old/t_new, err))
+
+    # stacks: one call for the whole block, serial and over a process pool
+    X = np.stack([x + np.random.normal(0, 50, x.size) for i in range(100)])
+    t_loop  = min(timeit.repeat(lambda: [remove_baseline(xi, [10**5, .05], "AsLS") for xi in X], number=1, repeat=3))
+    t_stack = min(timeit.repeat(lambda: remove_baseline(X, [10**5, .05], "AsLS"), number=1, repeat=3))
+    t_pool  = min(timeit.repeat(lambda: remove_baseline(X, [10**5, .05], "AsLS", workers=4), number=1, repeat=3))
+    print("AsLS on {} spectra : loop {:.0f} ms, stack {:.0f} ms, stack w/ 4 workers {:.0f} ms".format(
+          X.shape[0], 1e3*t_loop, 1e3*t_stack, 1e3*t_pool))
+
+    # cosmic rays: spikes injected into noisy frames of the mock spectra
+    rng = np.random.default_rng(0)
+    for filename in sorted(glob.glob("./mock_resources/exc785_*.txt")):
+        y = np.flip(np.loadtxt(filename)[:, 1][0:-15])
+        x = np.interp(np.linspace(0, y.size-1, N_PX), np.arange(y.size), y)
+        x = 40000 * x / np.max(x)
+        frames = rng.poisson(x + 1000, (5, N_PX)).astype(float)
+        spikes = np.zeros(frames.shape, dtype=bool)
+        spikes[rng.integers(0, 5, 50), rng.integers(0, N_PX, 50)] = True
+        frames[spikes] += rng.uniform(2000, 20000, np.count_nonzero(spikes))
+
+        t_block  = min(timeit.repeat(lambda: reject_spikes(frames), number=1, repeat=5))
+        t_single = min(timeit.repeat(lambda: despike(frames, axis=1), number=1, repeat=5))
+        for name, t, (clean, mask) in [("block ", t_block,  reject_spikes(frames)),
+                                       ("single", t_single, despike(frames, axis=1))]:
+            print("{} {} : {:5.1f} ms, {}/{} spikes found, {} false positives, max error of the mean {:.0f}".format(
+                  filename.split("/")[-1], name, 1e3*t, np.count_nonzero(mask & spikes), np.count_nonzero(spikes),
+                  np.count_nonzero(mask & ~spikes), np.max(np.abs(np.mean(clean, 0) - (x + 1000)))))
+
+    # narrow real bands must go through a single frame untouched (no spike on them)
+    px = np.arange(N_PX)
+    for sigma in [1, 1.5, 2, 3, 5]:
+        frame = rng.poisson(1000 + 40000*np.exp(-(px - 1800.3)**2/(2*sigma**2))).astype(float)
+        clean, mask = despike(frame)
+        print("band of sigma {} px : apex {:.0f} -> {:.0f}, {} px replaced{}".format(
+              sigma, frame.max(), clean.max(), np.count_nonzero(mask), "" if not mask.any() else "  <- CLIPPED"))
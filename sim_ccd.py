@@ -0,0 +1,312 @@
+# Simulated CCD w/ the interface of ccd.py, for load tests of the acquisition & processing
+# without hardware: unlike mock_ccd, the frames have the noise, dark current, offset and
+# saturation of a real readout, and take the time a real one does (integration, CCD readout
+# and USB transfer). k frames are generated at once, from a seeded generator.
+#   import sim_ccd as ccd
+#   ccd.init(0); ccd.seed(1)                    # reproducible frames
+#   ccd.excitation = lambda: laser.get_power()/laser.MAX_POWER     # signal follows the laser
+#   frames = ccd.get_frames(16)
+# the scene is the spectrum of a file, in [DN/us] at full excitation, like mock_ccd.
+
+import time
+import zlib
+import numpy as np
+
+import clock
+import spectrum_io
+from frame_buffer import FrameRing, FrameReader, STREAM_BUFFER_FRAMES
+from instrumentation import span, traced
+
+
+# constant declarations
+UC_TIMEOUT_DELAY = 10       # [100 ms]
+CCD_NB_PXL       = 3648
+MODE_ONE_SHOT    = 0        # camera modes
+MODE_FREE_RUN    = 1
+BULK_MAX_FRAMES  = 16       # max nb of frames pulled from the pipe in one transfer
+SIM_DEVICES      = 4        # nb of CCDs list_devices pretends are connected
+SIM_SEED         = 0        # default seed of the frame noise
+
+ADC_MAX          = 2**16-1  # [DN] full scale of the 16 bit ADC
+GAIN             = 1.5      # [e-/DN]
+OFFSET           = 250.     # [DN] bias of the readout
+READ_NOISE       = 15.      # [e- rms]
+DARK_CURRENT     = 500.     # [e-/s] mean dark current of a pixel
+DARK_SPREAD      = .3       # spread (log-normal sigma) of the dark current over the pixels
+HOT_PIXELS       = 1e-3     # fraction of pixels w/ 20x the dark current
+PRNU             = .01      # pixel response non-uniformity (rms)
+PIXEL_CLOCK      = 2e6      # [px/s] CCD readout rate
+USB_RATE         = 30e6     # [B/s] sustained USB 2.0 bulk transfer rate
+USB_LATENCY      = 5e-4     # [s] per transfer
+TRIGGER_LATENCY  = 1e-4     # [s] from the trigger to the start of the integration
+
+
+# global variables, because all good programs have global variables
+integration_time_us = 100;  # integration time in us
+filename      = "./mock_resources/exc785_Sample1_100pc_p2.txt"
+excitation    = None        # function giving the relative excitation (laser power) [0-1], 1 if None
+realtime      = True        # wait as long as the real CCD would (False: as fast as possible)
+rng           = None        # frame noise generator, see seed()
+device_serial = "SIM0000"
+dark_rate     = None        # [e-/s] dark current of each pixel  (fixed pattern of the device)
+response      = None        # relative response of each pixel    (fixed pattern of the device)
+stream_ring   = None
+stream_reader = None
+
+
+# functions
+def seed(s=SIM_SEED):
+    """
+    restart the frame noise from seed s (same seed, device and settings: same frames)
+    """
+    global rng
+    rng = np.random.default_rng((s, zlib.crc32(device_serial.encode())))
+
+
+def fixed_pattern(serial_nb):
+    """
+    dark current and response of each pixel of the CCD w/ this serial nb (always the same)
+    """
+    global dark_rate, response
+    pattern = np.random.default_rng(zlib.crc32(serial_nb.encode()))
+    dark_rate = DARK_CURRENT * pattern.lognormal(-DARK_SPREAD**2/2, DARK_SPREAD, CCD_NB_PXL)
+    dark_rate[pattern.random(CCD_NB_PXL) < HOT_PIXELS] *= 20
+    response  = 1 + PRNU*pattern.standard_normal(CCD_NB_PXL)
+
+
+def init(ccd_id):
+    """
+    establish connection w/ CCD and do a few basic settings
+    """
+    init_by_serial(list_devices()[ccd_id])
+
+
+def list_devices():
+    """
+    get the serial numbers of the connected CCDs
+    """
+    return ["SIM{:04d}".format(i) for i in range(SIM_DEVICES)]
+
+
+def init_by_serial(serial_nb):
+    """
+    establish connection w/ the CCD w/ the given serial number
+    """
+    global device_serial
+    if serial_nb not in list_devices():
+        raise ValueError("no CCD w/ serial number " + serial_nb)
+    device_serial = serial_nb
+    fixed_pattern(serial_nb)
+    seed()
+
+
+def readout_time(nb_frames=1):
+    """
+    [s] to shift a frame out of the CCD, and to transfer nb_frames frames over USB
+    """
+    return CCD_NB_PXL/PIXEL_CLOCK, USB_LATENCY + nb_frames*2*CCD_NB_PXL/USB_RATE
+
+
+def frame_period():
+    """
+    [s] between two frames in free-running mode: the next frame integrates during the readout
+    """
+    return max(integration_time_us*1e-6, readout_time()[0])
+
+
+def get_fps():
+    """
+    get the frame rate the CCD runs at
+    """
+    return int(1/frame_period())
+
+
+def wait(seconds):
+    if realtime:
+        clock.sleep(seconds)
+
+
+def output_buffer(out, shape):
+    """
+    check that out can be written into (C-contiguous uint16 of the given shape),
+    or allocate a new buffer if out is None
+    """
+    if out is None:
+        return np.empty(shape, dtype=np.uint16)
+    if out.shape != shape or out.dtype != np.uint16 or not out.flags.c_contiguous:
+        raise ValueError("output buffer must be a C-contiguous uint16 array of shape {}".format(shape))
+    return out
+
+
+def simulate(out):
+    """
+    fill out, a (k, CCD_NB_PXL) uint16 block, w/ k frames of the scene at the current
+    integration time: photo-electrons and dark electrons (Poisson), read noise, offset,
+    then quantization and saturation of the ADC
+    """
+    if dark_rate is None:
+        fixed_pattern(device_serial)
+    if rng is None:
+        seed()
+    t = integration_time_us*1e-6
+    scene = spectrum_io.load_template(filename, CCD_NB_PXL)[1]       # [DN/us], parsed once, cached
+    level = 1. if excitation is None else max(excitation(), 0.)
+    electrons = (level*integration_time_us*GAIN) * scene * response + dark_rate*t
+    dn = rng.poisson(electrons, size=out.shape).astype(np.float32)
+    dn += rng.standard_normal(out.shape, dtype=np.float32) * np.float32(READ_NOISE)
+    dn *= np.float32(1/GAIN)
+    dn += np.float32(OFFSET)
+    np.clip(dn, 0, ADC_MAX, out=dn)
+    np.copyto(out, dn, casting="unsafe")                            # truncated, like the ADC
+    return out
+
+
+@traced("ccd.get_data")
+def get_data(out=None):
+    """
+    get raw data from the CCD
+    out : optional preallocated uint16 array of CCD_NB_PXL to write the frame into
+    """
+    out = output_buffer(out, (CCD_NB_PXL,))
+    shift, transfer = readout_time(1)
+    with span("ccd.wait", integration_time_us=integration_time_us):
+        wait(TRIGGER_LATENCY + integration_time_us*1e-6 + shift)
+    with span("ccd.read"):
+        simulate(out[None])
+        wait(transfer)
+    return out
+
+
+@traced("ccd.get_bulk")
+def get_bulk(out):
+    """
+    acquire len(out) consecutive frames with a single trigger, and pull them all from
+    the pipe in one transfer into out (a (k, CCD_NB_PXL) uint16 block)
+    """
+    k = out.shape[0]
+    shift, transfer = readout_time(k)
+    with span("ccd.wait", integration_time_us=integration_time_us, nb_frames=k):
+        wait(TRIGGER_LATENCY + integration_time_us*1e-6 + (k-1)*frame_period() + shift)
+    with span("ccd.read", nb_frames=k):
+        simulate(out)
+        wait(transfer)
+    return out
+
+
+def get_frames(n, out=None):
+    """
+    get n raw frames from the CCD, BULK_MAX_FRAMES at a time
+    out : optional preallocated (n, CCD_NB_PXL) uint16 block, filled in place
+    """
+    out = output_buffer(out, (n, CCD_NB_PXL))
+    if n == 1:
+        get_data(out=out[0])
+        return out
+    for i in range(0, n, BULK_MAX_FRAMES):
+        get_bulk(out[i:i+BULK_MAX_FRAMES])
+    return out
+
+
+def read_frame(buffer):
+    """
+    read the next frame of the free-running CCD straight into buffer
+    """
+    wait(frame_period())
+    simulate(buffer[None])
+    wait(readout_time(1)[1])
+    return True
+
+
+def start_stream(nb_frames=STREAM_BUFFER_FRAMES):
+    """
+    start filling a ring buffer of nb_frames frames in the background
+    """
+    global stream_ring, stream_reader
+    if stream_reader is not None : stop_stream()
+    stream_ring   = FrameRing(nb_frames, CCD_NB_PXL, np.uint16)
+    stream_reader = FrameReader(stream_ring, read_frame)
+    stream_reader.start()
+
+
+def stop_stream():
+    """
+    stop the background acquisition
+    """
+    global stream_reader
+    if stream_reader is None : return
+    stream_reader.stop()
+    stream_reader = None
+
+
+def stream(n_frames=None):
+    """
+    iterate over the frames as the CCD produces them (starts streaming if needed)
+    yields frame, timestamp [s], nb of frames dropped since the previous one
+    """
+    own = stream_reader is None
+    if own : start_stream()
+    try:
+        yield from stream_ring.stream(n_frames, timeout=1+2e-6*integration_time_us)
+    finally:
+        if own : stop_stream()
+
+
+def latest_frame():
+    """
+    get the most recent streamed frame without waiting
+    returns frame, timestamp [s], frame number (or None)
+    """
+    if stream_ring is None : return None
+    return stream_ring.latest()
+
+
+def set_integration_time(inttime_us):
+    """
+    set the integration time of the ccd
+    """
+    global integration_time_us
+    integration_time_us = inttime_us
+
+
+def shutdown():
+    """
+    shut down CCD
+    """
+    stop_stream()
+
+
+def change_file(newfile):
+    """
+    change the scene (a spectrum file)
+    """
+    global filename
+    filename = newfile
+
+
+
+# BENCHMARK
+if __name__ == "__main__":
+    from auto_exposure import auto_exposure
+    from signal_treatment import detect_saturation
+
+    init(0)
+    realtime = False
+    block = np.empty((BULK_MAX_FRAMES, CCD_NB_PXL), dtype=np.uint16)
+    t = time.perf_counter()
+    for i in range(100):
+        get_frames(BULK_MAX_FRAMES, out=block)
+    dt = time.perf_counter() - t
+    print("generation: {:.0f} frames/s".format(100*BULK_MAX_FRAMES/dt))
+
+    realtime = True
+    for int_time in [100, 1000, 10000]:
+        set_integration_time(int_time)
+        t = time.perf_counter()
+        get_frames(BULK_MAX_FRAMES, out=block)
+        dt = time.perf_counter() - t
+        print("{:6d} us: {:6.1f} frames/s (free-running CCD: {} frames/s)".format(int_time, BULK_MAX_FRAMES/dt, get_fps()))
+
+    set_integration_time(1000)
+    int_time, data, nb_frames = auto_exposure(get_data, set_integration_time, 1000, 1, 30e6)
+    print("auto exposure: {:.1f} us in {} frames, peak at {} DN, saturated: {}".format(
+          int_time, nb_frames, data.max(), detect_saturation(get_data())))
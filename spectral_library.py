@@ -0,0 +1,164 @@
+# Library of reference spectra to identify a sample by: every reference is put on a common
+# shift grid, preprocessed (optionally derived, centered for correlation) and normalized once,
+# and kept as a row of one contiguous float32 matrix. a query is a single matrix product.
+#   library = SpectralLibrary(metric="correlation")
+#   library.add_file("./mock_resources/exc785_Sample1_100pc_p1.txt", "sample 1")
+#   library.add(clean_spectra, calibration, names)      # CCD spectra w/ their Calibration
+#   indices, scores = library.query(data_clean, calibration, k=5)
+#   library.save("library.npz") ... SpectralLibrary.load("library.npz")
+
+import numpy as np
+
+import spectrum_io
+from calibration import uniform_grid, GRID_MIN, GRID_MAX
+from instrumentation import span, traced
+
+
+# constant declarations
+LIBRARY_STEP     = 2.       # [cm^-1] grid step of the library, well under the width of the Raman bands
+LIBRARY_CAPACITY = 1024     # initial nb of rows of the matrix, doubled whenever it is full
+QUERY_BLOCK      = 16384    # nb of references scored at once (bounds the memory of the scores)
+METRICS          = ("cosine", "correlation")
+
+
+class SpectralLibrary:
+    """
+    reference spectra on uniform_grid(start, stop, step), preprocessed for metric:
+        - "cosine"      : normalized (L2)
+        - "correlation" : centered then normalized, the score is Pearson's correlation
+    w/ derivative, the first difference along the grid is taken first (insensitive to
+    what is left of the baseline, and to the intensity scale)
+    the references are added in place to a matrix that grows by doubling its capacity,
+    so adding some never reprocesses the others
+    """
+    def __init__(self, metric="cosine", derivative=False, start=GRID_MIN, stop=GRID_MAX, step=LIBRARY_STEP,
+                 capacity=LIBRARY_CAPACITY):
+        if metric not in METRICS:
+            raise ValueError("metric should be one of {}".format(METRICS))
+        self.metric     = metric
+        self.derivative = derivative
+        self.step       = step
+        self.grid       = uniform_grid(start, stop, step)
+        self.width      = self.grid.size - 1 if derivative else self.grid.size
+        self.matrix     = np.zeros((capacity, self.width), dtype=np.float32)
+        self.names      = []
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def references(self):
+        """
+        the preprocessed references, one per row (a view of the matrix)
+        """
+        return self.matrix[:len(self)]
+
+    def preprocess(self, x, calibration=None):
+        """
+        bring spectra (a spectrum or a stack) to the rows the library compares:
+            - calibration given (a calibration.Calibration): x is on the CCD pixels, resampled
+              onto the grid (the grid points outside the calibrated range count as 0)
+            - otherwise x is already on the grid
+        returns a (N, width) float32 array
+        """
+        if calibration is not None:
+            x = calibration.resample(x, self.grid[0], self.grid[-1], self.step, fill=0.)[1]
+        x = np.array(x, dtype=np.float32, ndmin=2)
+        if x.shape[-1] != self.grid.size:
+            raise ValueError("spectra of {} points, the grid has {}".format(x.shape[-1], self.grid.size))
+        if self.derivative:
+            x = np.diff(x, axis=-1)
+        if self.metric == "correlation":
+            x -= x.mean(axis=-1, keepdims=True)
+        norm = np.linalg.norm(x, axis=-1, keepdims=True)
+        np.divide(x, norm, out=x, where=norm > 0)           # flat spectra stay 0: they match nothing
+        return x
+
+    def append(self, rows, names):
+        """
+        add already preprocessed rows, growing the matrix if needed
+        """
+        n, size = len(rows), len(self)
+        if size + n > len(self.matrix):
+            capacity = max(2*len(self.matrix), size + n)
+            matrix = np.zeros((capacity, self.width), dtype=np.float32)
+            matrix[:size] = self.matrix[:size]
+            self.matrix = matrix
+        self.matrix[size:size+n] = rows
+        self.names.extend(names)
+
+    @traced("spectral_library.add")
+    def add(self, x, calibration=None, names=None):
+        """
+        add a reference spectrum, or a stack of them (see preprocess for calibration)
+        names : one name per spectrum (by default their index in the library)
+        """
+        rows = self.preprocess(x, calibration)
+        if names is None:
+            names = [str(i) for i in range(len(self), len(self) + len(rows))]
+        elif isinstance(names, str):
+            names = [names]
+        if len(names) != len(rows):
+            raise ValueError("{} names for {} spectra".format(len(names), len(rows)))
+        self.append(rows, names)
+
+    def add_file(self, filename, name=None, clean=None):
+        """
+        add the spectrum of a two-column (wavenumber, intensity) text file
+        clean : function cleaning up the intensities before they are resampled, to compare them
+                w/ samples cleaned the same way (e.g. smoothed & w/o baseline)
+        """
+        shift, y = spectrum_io.read_spectrum(filename)
+        if clean is not None:
+            y = clean(y)
+        order = np.argsort(shift)
+        self.add(np.interp(self.grid, shift[order], y[order], left=0., right=0.),
+                 names=filename if name is None else name)
+
+    @traced("spectral_library.query")
+    def query(self, x, calibration=None, k=5):
+        """
+        the k best matching references of a spectrum, or of each spectrum of a stack (see
+        preprocess for calibration)
+        returns indices, scores : (k,) arrays for a spectrum, (N, k) for a stack, best first
+        (self.names[i] is the name of reference i)
+        """
+        q = self.preprocess(x, calibration)
+        refs = self.references
+        k = min(k, len(refs))
+        indices = np.empty((len(q), 0), dtype=np.intp)
+        scores  = np.empty((len(q), 0), dtype=np.float32)
+        with span("spectral_library.scores", nb_queries=len(q), nb_references=len(refs)):
+            for start in range(0, len(refs), QUERY_BLOCK):
+                s = q @ refs[start:start+QUERY_BLOCK].T                     # (N, block)
+                best = np.argpartition(s, -k, axis=1)[:, -k:] if k < s.shape[1] else np.broadcast_to(np.arange(s.shape[1]), s.shape)
+                indices = np.hstack([indices, best + start])
+                scores  = np.hstack([scores, np.take_along_axis(s, best, axis=1)])
+                if scores.shape[1] > k:                                     # keep the k best so far
+                    keep = np.argpartition(scores, -k, axis=1)[:, -k:]
+                    indices = np.take_along_axis(indices, keep, axis=1)
+                    scores  = np.take_along_axis(scores, keep, axis=1)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        indices = np.take_along_axis(indices, order, axis=1)
+        scores  = np.take_along_axis(scores, order, axis=1)
+        if np.ndim(x) == 1:
+            return indices[0], scores[0]
+        return indices, scores
+
+    def save(self, filename):
+        """
+        save the library (its preprocessed references) to a .npz file
+        """
+        np.savez(filename, references=self.references, names=np.array(self.names), metric=self.metric,
+                 derivative=self.derivative, start=self.grid[0], stop=self.grid[-1], step=self.step)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        load a library saved by save()
+        """
+        with np.load(filename) as f:
+            library = cls(str(f["metric"]), bool(f["derivative"]), float(f["start"]), float(f["stop"]), float(f["step"]),
+                          capacity=max(len(f["names"]), 1))
+            library.append(f["references"], f["names"].tolist())
+        return library
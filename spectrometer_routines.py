@@ -1,38 +1,75 @@
 # imports
-import time
+import queue
+import weakref
+import warnings
+import asyncio
+import threading
 import numpy                as np
+from concurrent.futures import ThreadPoolExecutor
 
+import clock
 import mock_laser as laser
 import mock_ccd as ccd
+import spectrum_io
 from signal_treatment import *
+from auto_exposure import auto_exposure
+from dark_library import DarkLibrary
+from frame_accumulator import accumulate
+from calibration import Calibration
+from instrumentation import span, traced
+from async_devices import AsyncLaser, AsyncCCD
 
 
 # declare constants
 LASER_PORT       =    1     #TODO: real value
 CCD_PORT         =    1     #TODO: real value
-STABILIZE_DELAY  =    1     # [s]   #TODO: real value
+STABILIZE_DELAY  =    1     # [s]   max time to wait for the laser to settle  #TODO: real value
 MIN_INT_TIME     =    1     # [us]
 MAX_INT_TIME     =   30e6   # [us]
 DEFAULT_INT_TIME =   1e4    # [us]  #TODO: real value
 MIN_POWER        =   2e-3   # [us]
 MAX_POWER        = 120e-3   # [us]
 DEFAULT_POWER    =   5e-2   # [W]   #TODO: real value
-NB_AVGS          =   5      #TODO: real value
+NB_AVGS          =   5      # max nb of frames averaged  #TODO: real value
+TARGET_SNR       = 200      # averaging stops once the strongest peaks reach this SNR  #TODO: real value
+BATCH_WORKERS    =   2      # nb of threads processing the spectra of a batch
+BATCH_QUEUE_SIZE =   2      # nb of spectra waiting for processing before the acquisition waits
+CAL_DEG          =   2      # degree of the geometric correction of the calibration
 
 init_calibration_params = np.array([-1e-4, .6, 60])  # TODO: experimental
-calibration_ref_peaks   = np.array([465, 129, 1872]) # TODO: experimental
+calibration_ref_peaks   = np.array([465, 129, 1872]) # TODO: experimental, at least CAL_DEG+3 peaks to reject a wrong one
+
+# signal processing: cleanup of the calibration & sample spectra (smooth & remove baseline)
+calibration_pipeline    = Pipeline([("smooth", 7, "median"),
+                                    ("remove_baseline", [10**5, .05], "AsLS")]).compile(ccd.CCD_NB_PXL)
+sample_pipeline         = Pipeline([("smooth", 7, "median"),
+                                    ("smooth", 5, "gaussian"),
+                                    ("remove_baseline", [10**5, .05], "AsLS")]).compile(ccd.CCD_NB_PXL)
 
 # global variables
 integration_time        = DEFAULT_INT_TIME;
 power                   = DEFAULT_POWER;
 calibration_parameters  = np.array([0, 1, 0]);
+calibration             = Calibration(calibration_parameters, ccd.CCD_NB_PXL);  # shift axis & resampling of the parameters
 dark_noise              = np.array([]);
+darks                   = None; # library of dark frames, by integration time
+frames                  = np.empty((NB_AVGS, ccd.CCD_NB_PXL), dtype=np.uint16)  # reused for every average
+nb_averaged             = 0;    # nb of frames the last spectrum was averaged over
+settle_times            = [];   # [s] how long each laser power change took to settle, for tuning
+
+# asynchronous routines
+aio_laser               = AsyncLaser(laser)
+aio_ccd                 = AsyncCCD(ccd)
+processor               = ThreadPoolExecutor(1, thread_name_prefix="processing")   # the pipelines are not reentrant
+device_locks            = weakref.WeakKeyDictionary()   # event loop -> lock held by the routine using the laser & CCD
 
 
 def init():
     """
     initialize all devices
     """
+    global darks
+
     # start laser
     laser.init(LASER_PORT)              # establish connection w/ laser
     laser.stop()                        # make sure laser is off
@@ -40,92 +77,437 @@ def init():
     # start CCD, load init settings
     ccd.init(CCD_PORT)                  # establish connection w/ CCD
 
+    # load the dark frames taken during previous runs
+    darks = DarkLibrary()
+
+
+def settle(power_W):
+    """
+    wait until the laser output has settled on power_W (at most STABILIZE_DELAY)
+    """
+    with span("laser.settle", power_W=power_W):
+        settled, waited = laser.wait_settled(power_W, timeout=STABILIZE_DELAY)
+    settle_times.append(waited)
+    return settled
+
+
+def set_power(power_W):
+    """
+    change the laser power and wait for it to settle
+    """
+    laser.set_power(power_W)
+    settle(power_W)
+
+
+def acquire_dark():
+    """
+    average NB_AVGS frames with the laser off, at the current integration time,
+    then bring the laser back to its power
+    """
+    laser.stop()
+    settle(0)
+    sample_file = ccd.filename                                                  #TODO: remove this
+    ccd.change_file("./mock_resources/dark_noise.txt")                              #TODO: remove this
+    data_dn     = ccd.get_frames(NB_AVGS, out=frames)
+    dark        = np.mean(reject_spikes(data_dn)[0], 0)
+    ccd.change_file(sample_file)                                                #TODO: remove this
+
+    set_power(power)
+    return dark
+
+
+def average_frames(dark):
+    """
+    average frames as they come until the peaks are clean enough (TARGET_SNR, above dark) or
+    NB_AVGS frames have been taken. the frames are read in blocks (bulk transfers)
+    each block is cleaned of cosmic rays against all the frames taken so far (a cosmic ray is
+    absent from the other frames), before it goes into the average
+    """
+    global nb_averaged
+    taken = 0
+    def get_block(n):
+        nonlocal taken
+        ccd.get_frames(n, out=frames[taken:taken+n])
+        taken += n
+        return reject_spikes(frames[:taken])[0][-n:]
+    acc = accumulate(get_block, NB_AVGS, TARGET_SNR, block=ccd.BULK_MAX_FRAMES, dark=dark, nb_pxl=ccd.CCD_NB_PXL)
+    nb_averaged = acc.n
+    return acc.mean
+
+
+def average_spectrum(dark):
+    """
+    average frames (see average_frames) and subtract the dark noise
+    """
+    return average_frames(dark) - dark
 
+
+@traced("calibrate")
 def calibrate():
     """
     calibrate the spectrometer on a sample of known composition
     """
     global integration_time
     global calibration_parameters
+    global calibration
     global dark_noise
 
     # start laser and give it time to thermally stabilize
-    laser.start(power)              # start laser
-    time.sleep(STABILIZE_DELAY)     # wait for it to warm up
+    with span("calibrate.warmup"):
+        laser.start(power)              # start laser
+        settle(power)                   # wait for it to warm up
 
     # find optimal integration time on calibration sample
-    ccd.set_integration_time(integration_time)
-    data_raw = ccd.get_data()
-    while detect_lowsignal(data_raw) and (integration_time < MAX_INT_TIME):
-        integration_time = integration_time * 1.25;
-        ccd.set_integration_time(integration_time)
-        data_raw = ccd.get_data()
-    while detect_saturation(data_raw) and (integration_time > MIN_INT_TIME):
-        integration_time = integration_time / 1.25;
-        ccd.set_integration_time(integration_time)
-        data_raw = ccd.get_data()
-
-    # get dark noise for this integration time
-    laser.stop()
-    time.sleep(STABILIZE_DELAY)
-    ccd.change_file("./../spectra/dark_noise.txt")                              #TODO: remove this
-    data_dn     = np.array([ccd.get_data() for i in range(NB_AVGS)])
-    dark_noise  = np.mean(data_dn, 0)
+    with span("calibrate.exposure"):
+        integration_time, data_raw, nb_frames = auto_exposure(ccd.get_data, ccd.set_integration_time,
+                                                              integration_time, MIN_INT_TIME, MAX_INT_TIME)
+
+    # get dark noise for this integration time (only measured if the library has none)
+    with span("calibrate.dark", int_time=integration_time):
+        dark_noise  = darks.get(integration_time, acquire_dark, nb_frames=NB_AVGS)
 
     # calibration
     # 1) get spectrum of calibration sample
-    laser.set_power(power)
-    time.sleep(STABILIZE_DELAY)
-    ccd.change_file("./../spectra/MySamples1/exc785_Sample1_100pc_p2.txt")      #TODO: remove this
-    data_cs     = np.array([ccd.get_data() for i in range(NB_AVGS)])
-    data_c      = np.mean(data_cs, 0) - dark_noise
+    ccd.change_file("./mock_resources/exc785_Sample1_100pc_p2.txt")      #TODO: remove this
+    with span("calibrate.average"):
+        data_c      = average_spectrum(dark_noise)
 
     # 2) cleanup: smooth & remove baseline
-    data_smooth = smooth(data_c, 7, "median")
-    data_clean  = remove_baseline(data_smooth, [10**5, .05], "AsLS")
+    with span("calibrate.cleanup"):
+        data_clean  = calibration_pipeline(data_c)
 
     # 3) calculate geometric correction
-    calibration_parameters = find_correction(data_clean, calibration_ref_peaks, init_calibration_params, thresh=.5, deg=2)
+    with span("calibrate.correction"):
+        calibration_parameters = fit_calibration(data_clean)
+        calibration = Calibration(calibration_parameters, ccd.CCD_NB_PXL)
 
     return data_raw, data_clean, dark_noise, calibration_parameters
 
 
+def fit_calibration(data_clean):
+    """
+    geometric correction of the cleaned up calibration spectrum; the current one is kept if
+    too few peaks agree w/ calibration_ref_peaks to fit it
+    w/o at least CAL_DEG+3 agreeing peaks, a wrongly assigned peak can't be rejected: the
+    correction is used, w/ a warning
+    """
+    try:
+        parameters, residuals, assigned = find_correction(data_clean, calibration_ref_peaks, init_calibration_params,
+                                                          thresh=.5, deg=CAL_DEG, full_output=True)
+    except CalibrationError as e:
+        print("ERROR: " + str(e) + ", calibration kept")
+        return calibration_parameters
+    nb_pairs = np.count_nonzero(~np.isnan(residuals))
+    if nb_pairs < CAL_DEG+3:
+        warnings.warn("calibration unverified: {} peaks for a degree {} correction, a wrong peak can only "
+                      "be rejected w/ {}".format(nb_pairs, CAL_DEG, CAL_DEG+3))
+    return parameters
+
+
+@traced("acquire_sample_spectrum")
 def acquire_sample_spectrum():
     """
     acquire sample spectra from the CCD
     """
+    data_raw, data_s = acquire_sample_frames()
+
+    # cleanup: smooth & remove baseline
+    with span("acquire.cleanup"):
+        data_clean   = sample_pipeline(data_s)
+
+    return data_raw, data_clean
+
+
+def acquire_sample_frames():
+    """
+    the acquisition part of acquire_sample_spectrum: returns the last frame of the power
+    search, and the averaged spectrum of the sample (dark noise subtracted)
+    """
     global power
     global dark_noise
 
     # start laser and give it time to thermally stabilize
-    laser.start(power)              # make sure laser is on
-    time.sleep(STABILIZE_DELAY)
-
-    # find optimal laser power for sample
-    data_raw = ccd.get_data()
-    while detect_lowsignal(data_raw) and (power < MAX_POWER):
-        power = power * 1.25;
-        laser.set_power(power)
-        time.sleep(STABILIZE_DELAY)
-        data_raw = ccd.get_data()
-    while detect_saturation(data_raw) and (power > MIN_POWER):
-        power = power / 1.25;
-        laser.set_power(power)
-        time.sleep(STABILIZE_DELAY)
-        data_raw = ccd.get_data()
+    with span("acquire.warmup"):
+        laser.start(power)              # make sure laser is on
+        settle(power)
+
+    # find optimal laser power for sample (the signal is linear in the power too)
+    with span("acquire.power"):
+        power, data_raw, nb_frames = auto_exposure(ccd.get_data, set_power, power, MIN_POWER, MAX_POWER,
+                                                   applied=True)     # settled on it just above
+
+    # get dark noise for this integration time (only measured if the library has none)
+    with span("acquire.dark", int_time=integration_time):
+        dark_noise  = darks.get(integration_time, acquire_dark, nb_frames=NB_AVGS)
 
     # get spectrum of sample
-    data_ss     = np.array([ccd.get_data() for i in range(NB_AVGS)])
-    data_s      = np.mean(data_ss, 0) - dark_noise
+    with span("acquire.average"):
+        data_s      = average_spectrum(dark_noise)
+
+    return data_raw, data_s
+
+
+def identify(data_clean, library, k=5):
+    """
+    best matches of a cleaned sample spectrum in a SpectralLibrary, on the current calibration
+    returns [(name, score)], best first
+    """
+    indices, scores = library.query(data_clean, calibration, k)
+    return [(library.names[i], float(score)) for i, score in zip(indices, scores)]
+
+
+def run_batch(samples, workers=BATCH_WORKERS, queue_size=BATCH_QUEUE_SIZE):
+    """
+    acquire the spectrum of every sample on this thread, while a pool of workers cleans up
+    the ones already acquired (sample pipeline) and puts them on the calibrated shift axis.
+    the acquisition only waits for the processing when queue_size spectra are waiting for it
+    this saves at most the processing time of each sample: w/ the sample pipeline (~2 ms) next
+    to the acquisition (~1 s on the mocks, mostly the laser power search), it doesn't show; it
+    pays off w/ heavier processing (peak fitting, library search) or faster acquisitions
+    samples : one prepare() per sample, called before it is acquired (e.g. to bring it in place), or None
+    returns one (data_raw, data_clean, shift [cm^-1]) per sample, in order
+    """
+    shift = calibration.axis                                # read-only, shared by all the results
+    results = [None]*len(samples)
+    errors  = []
+    jobs    = queue.Queue(maxsize=queue_size)
+
+    def work():
+        try:
+            pipeline = Pipeline(sample_pipeline.stages).compile(ccd.CCD_NB_PXL)    # one per thread
+        except Exception as e:
+            errors.append(e)
+            pipeline = None
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            if pipeline is None:                            # keep emptying the queue: the acquisition
+                continue                                    # must not wait on it, it stops on the error
+            i, data_raw, data_s = job
+            try:
+                with span("batch.cleanup", sample=i):
+                    results[i] = (data_raw, pipeline(data_s), shift)
+            except Exception as e:
+                errors.append(e)
+
+    pool = [threading.Thread(target=work, name="batch worker {}".format(i)) for i in range(workers)]
+    for thread in pool:
+        thread.start()
+    try:
+        for i, prepare in enumerate(samples):
+            if errors:
+                break
+            if prepare is not None:
+                prepare()
+            with span("batch.acquire", sample=i):
+                data_raw, data_s = acquire_sample_frames()
+            jobs.put((i, data_raw, data_s))                 # waits while the queue is full
+    finally:
+        for thread in pool:
+            jobs.put(None)
+        for thread in pool:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+# ASYNCHRONOUS ROUTINES
+# same as the routines above, but independent steps overlap: the CCD is set up and the dark
+# library searched while the laser warms up, the dark frames are cleaned up while the laser
+# comes back on, and each routine lets go of the devices before processing its spectrum,
+# so that the next routine is already warming up the laser meanwhile, e.g.
+#   asyncio.run(cycle_async([...]))
+
+def devices():
+    """
+    lock held by the routine using the laser & CCD (routines get it in the order they start)
+    """
+    return device_locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+
+
+async def process(func, *args):
+    """
+    run a processing step on the processing thread
+    """
+    return await asyncio.get_running_loop().run_in_executor(processor, func, *args)
+
+
+async def settle_async(power_W):
+    """
+    wait until the laser output has settled on power_W (at most STABILIZE_DELAY)
+    """
+    with span("laser.settle", power_W=power_W):
+        settled, waited = await aio_laser.wait_settled(power_W, timeout=STABILIZE_DELAY)
+    settle_times.append(waited)
+    return settled
+
+
+async def set_power_async(power_W):
+    """
+    change the laser power and wait for it to settle
+    """
+    await aio_laser.set_power(power_W)
+    await settle_async(power_W)
+
+
+async def warmup_async():
+    """
+    start the laser and give it time to thermally stabilize
+    """
+    await aio_laser.start(power)
+    await settle_async(power)
+
+
+async def dark_frames_async():
+    """
+    take NB_AVGS frames with the laser off (and leave it off)
+    """
+    await aio_laser.stop()
+    await settle_async(0)
+    sample_file = ccd.filename                                                  #TODO: remove this
+    ccd.change_file("./mock_resources/dark_noise.txt")                              #TODO: remove this
+    data_dn     = await aio_ccd.get_frames(NB_AVGS, out=frames)
+    ccd.change_file(sample_file)                                                #TODO: remove this
+    return data_dn.copy()
+
+
+def average_dark(data_dn, int_time):
+    """
+    average dark frames (cleaned of cosmic rays), and store the result in the library
+    """
+    dark = np.mean(reject_spikes(data_dn)[0], 0)
+    darks.store(int_time, dark, nb_frames=NB_AVGS)
+    return dark
+
+
+async def acquire_dark_async():
+    """
+    average NB_AVGS frames with the laser off, then bring the laser back to its power
+    while they are cleaned up & stored in the library
+    """
+    data_dn = await dark_frames_async()
+    dark, _ = await asyncio.gather(process(average_dark, data_dn, integration_time), set_power_async(power))
+    return dark
+
+
+async def get_dark_async():
+    """
+    dark noise for the current integration time, from the library or measured
+    """
+    dark = await process(darks.lookup, integration_time)
+    if dark is None:
+        dark = await acquire_dark_async()
+    return dark
+
+
+@traced("calibrate_async")
+async def calibrate_async():
+    """
+    calibrate the spectrometer on a sample of known composition
+    if the dark noise has to be measured, it is measured last and the laser is left off:
+    the next routine warms it up again while this one finishes processing
+    the dark noise & calibration are published together, holding the devices: a routine
+    overlapping the processing sees either the old ones or the new ones, never a mix
+    """
+    global integration_time
+    global calibration_parameters
+    global calibration
+    global dark_noise
+
+    async with devices():
+        # start laser, set up the CCD meanwhile
+        with span("calibrate.warmup"):
+            await asyncio.gather(warmup_async(), aio_ccd.set_integration_time(integration_time))
+
+        # find optimal integration time on calibration sample
+        with span("calibrate.exposure"):
+            integration_time, data_raw, nb_frames = await aio_ccd.run(auto_exposure, ccd.get_data, ccd.set_integration_time,
+                                                                      integration_time, MIN_INT_TIME, MAX_INT_TIME, applied=True)
+            dark        = await process(darks.lookup, integration_time)
+
+        # 1) get spectrum of calibration sample (w/o a dark frame, the SNR is taken above the
+        #    offset of the last frame, which is the bulk of the dark noise under the peaks)
+        ccd.change_file("./mock_resources/exc785_Sample1_100pc_p2.txt")      #TODO: remove this
+        with span("calibrate.average"):
+            data_c      = await aio_ccd.run(average_frames, np.min(data_raw) if dark is None else dark)
+
+        # measure the dark noise if the library had none
+        if dark is None:
+            with span("calibrate.dark", int_time=integration_time):
+                data_dn = await dark_frames_async()
+
+    if dark is None:
+        dark        = await process(average_dark, data_dn, integration_time)
+    data_c      = data_c - dark
+
+    # 2) cleanup: smooth & remove baseline
+    with span("calibrate.cleanup"):
+        data_clean  = await process(calibration_pipeline, data_c)
+
+    # 3) calculate geometric correction
+    with span("calibrate.correction"):
+        parameters  = await process(fit_calibration, data_clean)
+        result      = Calibration(parameters, ccd.CCD_NB_PXL)
+
+    async with devices():
+        dark_noise, calibration_parameters, calibration = dark, parameters, result
+
+    return data_raw, data_clean, dark, parameters
+
+
+@traced("acquire_sample_spectrum_async")
+async def acquire_sample_spectrum_async(prepare=None):
+    """
+    acquire sample spectra from the CCD
+    prepare() is called once the devices are free (e.g. to bring the sample in place)
+    """
+    global power
+    global dark_noise
+
+    async with devices():
+        if prepare is not None:
+            prepare()
+
+        # start laser, look for the dark noise for this integration time meanwhile
+        with span("acquire.warmup"):
+            _, dark = await asyncio.gather(warmup_async(), process(darks.lookup, integration_time))
+
+        # find optimal laser power for sample (the signal is linear in the power too)
+        with span("acquire.power"):
+            power, data_raw, nb_frames = await aio_ccd.run(auto_exposure, ccd.get_data, set_power,
+                                                           power, MIN_POWER, MAX_POWER, applied=True)
+
+        # measure the dark noise if the library had none
+        with span("acquire.dark", int_time=integration_time):
+            dark_noise  = dark if dark is not None else await acquire_dark_async()
+
+        # get spectrum of sample
+        with span("acquire.average"):
+            data_s      = await aio_ccd.run(average_spectrum, dark_noise)
 
     # cleanup: smooth & remove baseline
-    data_smooth1 = smooth(data_s,       7, "median")
-    data_smooth2 = smooth(data_smooth1, 5, "gaussian")
-    data_clean   = remove_baseline(data_smooth2, [10**5, .05], "AsLS")
+    with span("acquire.cleanup"):
+        data_clean   = await process(sample_pipeline, data_s)
 
     return data_raw, data_clean
 
 
+async def cycle_async(prepares=(None,)):
+    """
+    calibrate, then acquire one sample spectrum per prepare() (see acquire_sample_spectrum_async),
+    each routine warming the laser up while the spectrum of the previous one is processed
+    only the processing and the dark frames overlap the device work: the warm-ups and the
+    power searches still take turns on the devices, so on the mocks a calibration + 2 samples
+    take only 3-4 % less than the serial routines (2.99-3.01 vs 3.11 s)
+    returns the result of calibrate_async and the list of the sample results
+    """
+    calibrating = asyncio.create_task(calibrate_async())   # tasks start in order: the calibration gets the devices first
+    samples = [asyncio.create_task(acquire_sample_spectrum_async(prepare)) for prepare in prepares]
+    return await calibrating, [await sample for sample in samples]
+
+
 def shutdown():
     """
     shut down laser and CCD
@@ -137,11 +519,12 @@ def shutdown():
 
 # DEMO
 if __name__ == "__main__":
-    import re
-    import scipy.interpolate    as interpolate
+    import time
     import matplotlib.pyplot as plt
 
 
+    sim = clock.use(clock.VirtualClock())   # the mock devices answer at once, the hardware time is kept
+    t = time.perf_counter()
     init()  # start up devices
 
     for i in range(1): #number of samples
@@ -149,27 +532,17 @@ if __name__ == "__main__":
         raw_c, clean_c, dark_noise, calibration_parameters = calibrate()
 
         filenames = ["exc785_Sample1_100pc_p3.txt", "exc785_Sample1_100pc_p1.txt"]
-        raw_d, clean_d = [], []
-        for filename in filenames : #number of subsamples
-            ccd.change_file("./mock_resources/" + filename)
-            out_r, out_d = acquire_sample_spectrum()
-            raw_d.append(out_r)
-            clean_d.append(out_d)
+        subsamples = [lambda f=filename: ccd.change_file("./mock_resources/" + f) for filename in filenames]
+        raw_d, clean_d, shifts = zip(*run_batch(subsamples))
 
         laser.stop()
 
+    print("ran in {:.1f} s, would have taken {:.1f} s on the hardware".format(time.perf_counter() - t, sim.elapsed()))
 
     filenames.append("calibration sample")
 
-    # get real calibration values for comparison
-    f = open("./../spectra/MySamples1/exc785_Sample1_100pc_p2.txt", 'r')
-    s = np.array(re.findall(r'(\d+\.\d+)', f.read()), dtype = np.float32)
-    f.close();
-
-    real = []
-    for i in range(int(s.size/2)) :
-        real.append(s[2*i])
-    real = np.flip(np.array(real)[0:-15])
+    # get real calibration values for comparison (already resampled onto the CCD pixels)
+    real = spectrum_io.load_template("./mock_resources/exc785_Sample1_100pc_p2.txt", clean_c.size)[0]
 
     fig, (ax1, ax2) = plt.subplots(2,1, constrained_layout=True)
 
@@ -178,14 +551,14 @@ if __name__ == "__main__":
     ax1.set_xlabel("pixels [px]")
     ax1.legend(filenames)
 
-    [ax2.plot(np.polyval(calibration_parameters, np.linspace(0, cd.size-1, cd.size)), cd) for cd in clean_d]
-    ax2.plot(np.polyval(calibration_parameters, np.linspace(0, clean_c.size-1, clean_c.size)), clean_c)
+    grid, resampled = calibration.resample(np.vstack(clean_d + (clean_c,)))    # one common shift grid
+    [ax2.plot(grid, r) for r in resampled]
     ax2.set_xlabel("shift [cm^-1]")
     ax2.legend(filenames)
 
     plt.figure()
-    plt.plot(np.linspace(0, clean_c.size-1, clean_c.size), np.polyval(calibration_parameters, np.linspace(0, clean_c.size-1, clean_c.size)))
-    plt.plot(np.linspace(0, clean_c.size-1, clean_c.size), interpolate.interp1d(np.linspace(0, clean_c.size-1, real.size), real)(np.linspace(0, clean_c.size-1, clean_c.size)))
+    plt.plot(np.arange(clean_c.size), calibration.axis)
+    plt.plot(np.linspace(0, clean_c.size-1, clean_c.size), real)
     plt.xlabel("pixels [px]")
     plt.ylabel("shift [cm^-1]")
 
@@ -0,0 +1,310 @@
+# Appendable binary archive of spectra: a directory w/ a small JSON header and chunk files of
+# fixed-size records (metadata + raw uint16 frame + processed float32 spectrum), and a table of
+# dark frames the records refer to. uncompressed chunks are memory-mapped, so opening an archive
+# and slicing it costs the same memory whatever its size; full chunks can be zlib-compressed
+# (then they are decompressed one at a time when read).
+#   with SpectrumArchive("./run.spa", "a") as archive:
+#       d = archive.add_dark(dark_noise, integration_time)
+#       archive.append(raw=data_raw, spectrum=data_clean, int_time=integration_time, power=power,
+#                      calibration=calibration_parameters, dark=d)
+#   spectra = SpectrumArchive("./run.spa")[1000:2000]["spectrum"]
+#   python spectrum_archive.py run.spa mock_resources/*.txt     : convert text spectra
+
+import os
+import re
+import json
+import zlib
+import collections
+import numpy as np
+
+import clock
+import spectrum_io
+
+
+# constant declarations
+ARCHIVE_VERSION   = 1
+CCD_NB_PXL        = 3648
+ARCHIVE_CHUNK     = 256         # records per chunk file
+ARCHIVE_OPEN_MAPS = 16          # uncompressed chunks kept mapped at once
+ARCHIVE_OPEN_ZIPS = 2           # compressed chunks kept decompressed at once
+CALIBRATION_DEG   = 4           # max degree of the pixel -> shift polynomial (lower ones are zero-padded)
+ARCHIVE_FILES     = re.compile(r"(header\.json|darks\.bin|chunk_\d{6}\.(bin|zlib))$")    # what an archive is made of
+
+
+def record_dtype(nb_pxl=CCD_NB_PXL):
+    """
+    layout of one spectrum: metadata, raw frame (zeros if not given) and processed spectrum
+    (NaN if not given). dark is the index of the dark frame in the archive (-1 if none)
+    """
+    return np.dtype([("timestamp",   "<f8"),
+                     ("int_time",    "<f8"),                        # [us]
+                     ("power",       "<f8"),                        # [W]
+                     ("calibration", "<f8", (CALIBRATION_DEG+1,)),
+                     ("dark",        "<i8"),
+                     ("raw",         "<u2", (nb_pxl,)),
+                     ("spectrum",    "<f4", (nb_pxl,))])
+
+
+def dark_dtype(nb_pxl=CCD_NB_PXL):
+    return np.dtype([("timestamp",   "<f8"),
+                     ("int_time",    "<f8"),                        # [us]
+                     ("frame",       "<f4", (nb_pxl,))])
+
+
+class SpectrumArchive:
+    """
+    mode "r" : read only
+         "a" : read & append (the archive is created if it doesn't exist)
+         "w" : new, empty archive (replaces an existing one: only its own files are deleted)
+    nb_pxl, chunk_size & compression (None or "zlib") only matter when the archive is created
+    an archive is only created in a new or empty directory
+    """
+    def __init__(self, path, mode="r", nb_pxl=CCD_NB_PXL, chunk_size=ARCHIVE_CHUNK, compression=None):
+        self.path = path
+        self.mode = mode
+        header = os.path.join(path, "header.json")
+        if mode == "w" and os.path.exists(header):
+            for name in sorted(os.listdir(path), key=lambda name: name == "header.json"):   # the header last
+                if ARCHIVE_FILES.match(name):
+                    os.remove(os.path.join(path, name))
+        elif mode != "r" and not os.path.exists(header) and os.path.isdir(path) and os.listdir(path):
+            raise IOError("{} is not an archive, and not empty".format(path))
+        if mode != "r" and not os.path.exists(header):
+            os.makedirs(path, exist_ok=True)
+            with open(header, "w") as f:
+                json.dump(dict(version=ARCHIVE_VERSION, nb_pxl=nb_pxl, chunk_size=chunk_size,
+                               compression=compression), f)
+        with open(header) as f:
+            self.header = json.load(f)
+        if self.header["version"] > ARCHIVE_VERSION:
+            raise ValueError("archive version {} is not supported".format(self.header["version"]))
+        self.nb_pxl      = self.header["nb_pxl"]
+        self.chunk_size  = self.header["chunk_size"]
+        self.compression = self.header["compression"]
+        self.dtype       = record_dtype(self.nb_pxl)
+        self.dark_dtype  = dark_dtype(self.nb_pxl)
+
+        # nb of records: full chunks, plus what the last one holds
+        chunks = sorted(name for name in os.listdir(path) if name.startswith("chunk_"))
+        self.nb_chunks = len(chunks)
+        self.count     = 0
+        if chunks:
+            last = os.path.join(path, chunks[-1])
+            last_len = self.chunk_size if last.endswith(".zlib") else os.path.getsize(last) // self.dtype.itemsize
+            self.count = (self.nb_chunks - 1)*self.chunk_size + last_len
+
+        self.maps   = collections.OrderedDict()     # chunk nb -> mapped / decompressed records
+        self.writer = None                          # file of the chunk being appended to
+        self.darks_map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.count
+
+    def chunk_file(self, c, compressed=False):
+        return os.path.join(self.path, "chunk_{:06d}.{}".format(c, "zlib" if compressed else "bin"))
+
+
+    # writing
+    def append(self, raw=None, spectrum=None, int_time=np.nan, power=np.nan, calibration=None,
+               dark=-1, timestamp=None):
+        """
+        append a spectrum (raw frame and/or processed spectrum, and its metadata), or a block
+        of them (raw/spectrum of shape (k, nb_pxl), all w/ the same metadata)
+        returns the index of the (first) appended record
+        """
+        if self.mode == "r":
+            raise IOError("archive opened read-only")
+        blocks = [np.atleast_2d(a) for a in (raw, spectrum) if a is not None]
+        if not blocks:
+            raise ValueError("nothing to append")
+        records = np.zeros(len(blocks[0]), dtype=self.dtype)
+        records["timestamp"]   = clock.now() if timestamp is None else timestamp
+        records["int_time"]    = int_time
+        records["power"]       = power
+        if calibration is None:
+            records["calibration"] = np.nan
+        else:                                       # leading zeros: same np.polyval
+            records["calibration"][:, CALIBRATION_DEG+1-len(calibration):] = calibration
+        records["dark"]        = dark
+        if raw is not None:
+            records["raw"] = np.atleast_2d(raw)
+        records["spectrum"] = np.nan if spectrum is None else np.atleast_2d(spectrum)
+
+        first = self.count
+        while records.size:
+            c, n = divmod(self.count, self.chunk_size)
+            if self.writer is None:
+                self.writer = open(self.chunk_file(c), "ab")
+                self.nb_chunks = c + 1
+            part, records = records[:self.chunk_size - n], records[self.chunk_size - n:]
+            part.tofile(self.writer)
+            self.count += part.size
+            self.maps.pop(c, None)                  # its map is too short now
+            if self.count % self.chunk_size == 0:
+                self.seal(c)
+        return first
+
+    def seal(self, c):
+        """
+        close the (full) chunk c, and compress it if the archive is compressed
+        """
+        self.writer.close()
+        self.writer = None
+        if self.compression == "zlib":
+            with open(self.chunk_file(c), "rb") as f:
+                data = zlib.compress(f.read(), 1)
+            with open(self.chunk_file(c, True) + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(self.chunk_file(c, True) + ".tmp", self.chunk_file(c, True))
+            os.remove(self.chunk_file(c))
+
+    def add_dark(self, frame, int_time, timestamp=None):
+        """
+        add a dark frame to the archive, returns its index (for append)
+        """
+        if self.mode == "r":
+            raise IOError("archive opened read-only")
+        dark = np.zeros(1, dtype=self.dark_dtype)
+        dark["timestamp"] = clock.now() if timestamp is None else timestamp
+        dark["int_time"]  = int_time
+        dark["frame"]     = frame
+        filename = os.path.join(self.path, "darks.bin")
+        with open(filename, "ab") as f:
+            dark.tofile(f)
+        self.darks_map = None
+        return os.path.getsize(filename) // self.dark_dtype.itemsize - 1
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.maps.clear()
+        self.darks_map = None
+
+
+    # reading
+    def chunk(self, c):
+        """
+        records of chunk c: a read-only memory map, or the decompressed records
+        """
+        if c in self.maps:
+            self.maps.move_to_end(c)
+            return self.maps[c]
+        self.flush()
+        if os.path.exists(self.chunk_file(c)):
+            records = np.memmap(self.chunk_file(c), dtype=self.dtype, mode="r")
+            max_open = ARCHIVE_OPEN_MAPS
+        else:
+            with open(self.chunk_file(c, True), "rb") as f:
+                records = np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype)
+            max_open = ARCHIVE_OPEN_ZIPS
+        self.maps[c] = records
+        zipped = [k for k, r in self.maps.items() if not isinstance(r, np.memmap)]
+        mapped = [k for k, r in self.maps.items() if isinstance(r, np.memmap)]
+        for k in (zipped if max_open == ARCHIVE_OPEN_ZIPS else mapped)[:-max_open]:
+            del self.maps[k]
+        return records
+
+    def __getitem__(self, key):
+        """
+        a record (or a slice of them): a structured array w/ the fields of record_dtype, e.g.
+            archive[i]["spectrum"], archive[i:j]["raw"], archive[-100:]["int_time"]
+        slices within one uncompressed chunk are views of the file (no copy), the others
+        are copies of just the records asked for
+        """
+        if isinstance(key, slice):
+            idx = range(*key.indices(self.count))
+            parts, i = [], 0
+            while i < len(idx):
+                c, s = divmod(idx[i], self.chunk_size)
+                bound = (c+1)*self.chunk_size if idx.step > 0 else c*self.chunk_size - 1
+                n = min(len(range(idx[i], bound, idx.step)), len(idx) - i)
+                parts.append(self.chunk(c)[s::idx.step][:n])
+                i += n
+            if len(parts) == 1:
+                return parts[0]
+            return np.concatenate(parts) if parts else np.empty(0, dtype=self.dtype)
+        i = int(key)
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("record {} out of range ({} records)".format(key, self.count))
+        return self.chunk(i // self.chunk_size)[i % self.chunk_size]
+
+    def darks(self):
+        """
+        the dark frames of the archive (a read-only memory map, fields of dark_dtype)
+        """
+        filename = os.path.join(self.path, "darks.bin")
+        if not os.path.exists(filename):
+            return np.empty(0, dtype=self.dark_dtype)
+        if self.darks_map is None:
+            self.darks_map = np.memmap(filename, dtype=self.dark_dtype, mode="r")
+        return self.darks_map
+
+    def dark(self, i):
+        """
+        the dark frame record i refers to (None if it has none)
+        """
+        d = int(self[i]["dark"])
+        return None if d < 0 else self.darks()[d]["frame"]
+
+    def shift(self, i):
+        """
+        shift axis [cm^-1] of record i, from its calibration parameters
+        """
+        return np.polyval(self[i]["calibration"], np.arange(self.nb_pxl))
+
+
+def convert_text(filenames, path, nb_pxl=None, compression=None, darks=()):
+    """
+    append two-column text spectra (see spectrum_io.read_spectrum) to an archive, laid out on
+    nb_pxl pixels like spectrum_io.load_template, each w/ its wavenumber axis as calibration
+    (polynomial fit). files listed in darks are added as dark frames instead
+    nb_pxl : None to keep the resolution of the first file (or that of an existing archive)
+    returns the number of spectra appended
+    """
+    if nb_pxl is None and os.path.exists(os.path.join(path, "header.json")):
+        nb_pxl = SpectrumArchive(path).nb_pxl
+    elif nb_pxl is None:
+        nb_pxl = spectrum_io.read_spectrum(filenames[0])[1].size - spectrum_io.TRIM_END
+    px = np.arange(nb_pxl)
+    with SpectrumArchive(path, "a", nb_pxl, compression=compression) as archive:
+        for filename in darks:
+            archive.add_dark(spectrum_io.load_template(filename, nb_pxl)[1], np.nan,
+                             timestamp=os.path.getmtime(filename))
+        for filename in filenames:
+            x, y = spectrum_io.load_template(filename, nb_pxl)
+            archive.append(spectrum=y, calibration=np.polyfit(px, x, CALIBRATION_DEG),
+                           timestamp=os.path.getmtime(filename))
+    return len(filenames)
+
+
+
+# CONVERTER
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="convert text spectra to a spectrum archive")
+    parser.add_argument("archive")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--dark", action="append", default=[], help="text file of a dark frame")
+    parser.add_argument("--zlib", action="store_true", help="compress the chunks")
+    parser.add_argument("--pixels", type=int, help="resample onto this nb of pixels (e.g. {})".format(CCD_NB_PXL))
+    args = parser.parse_args()
+
+    n = convert_text(args.files, args.archive, args.pixels, "zlib" if args.zlib else None, args.dark)
+    text_size = sum(os.path.getsize(f) for f in args.files)
+    archive_size = sum(os.path.getsize(os.path.join(args.archive, f)) for f in os.listdir(args.archive))
+    print("{} spectra: {:.1f} kB of text -> {:.1f} kB of archive".format(n, text_size/1e3, archive_size/1e3))
@@ -0,0 +1,53 @@
+import os
+import numpy as np
+
+
+# constant declarations
+CCD_NB_PXL  = 3648
+TRIM_END    = 15        # nb of points at the end of the reference files that fall outside the CCD
+
+
+# parsed & resampled files, keyed by (path, mtime)
+_templates = {}
+
+
+def read_spectrum(filename):
+    """
+    read a two-column text spectrum (wavenumber, intensity), '#' lines are comments
+    returns x, y as float arrays
+    """
+    s = np.loadtxt(filename, comments="#", usecols=(0, 1), ndmin=2)
+    return s[:, 0], s[:, 1]
+
+
+def load_template(filename, n_px=CCD_NB_PXL):
+    """
+    get the spectrum of a file, laid out as the CCD sees it (reversed, trimmed and
+    resampled onto n_px pixels)
+    the result is cached until the file changes on disk, so only the first call parses the file
+    returns x, y : the wavenumber and intensity at each pixel (read-only arrays)
+    """
+    path = os.path.abspath(filename)
+    key  = (path, os.path.getmtime(path), n_px)
+    if key not in _templates:
+        for k in [k for k in _templates if k[0] == path]:   # drop outdated versions of this file
+            del _templates[k]
+
+        x, y = read_spectrum(path)
+        x = np.flip(x[0:-TRIM_END])
+        y = np.flip(y[0:-TRIM_END])
+        px = np.linspace(0, n_px-1, n_px)
+        xp = np.linspace(0, n_px-1, y.size)
+        x, y = np.interp(px, xp, x), np.interp(px, xp, y)
+        x.setflags(write=False)
+        y.setflags(write=False)
+        _templates[key] = (x, y)
+
+    return _templates[key]
+
+
+def clear_cache():
+    """
+    forget all cached templates
+    """
+    _templates.clear()